@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the local (no network) functions on every question's path.
+
+    python bench.py                      # compare against bench_baseline.json (written on first run)
+    python bench.py --save-baseline      # record this host's numbers as the baseline
+    python bench.py --filter chunk       # only cases whose name contains "chunk"
+
+Each case reports ops/sec (best of --repeat timed runs) and the peak memory
+traced by tracemalloc during one call. A case fails when it is more than
+--threshold slower than its baseline, or allocates that much more; the exit
+status is 1 if any case fails. Baselines are per host and not committed:
+the first run on a machine (no --baseline file yet) records one instead of
+comparing.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from langchain_core.documents import Document
+
+from predict import normalize_answer
+from src.RAG.RAG_answerer import (
+    chunk_paragraph,
+    iter_chunk_spans,
+    lexical_prefilter,
+    parse_answer,
+    parse_group_answers,
+    split_qna,
+    topk_retrieve,
+)
+from src.Reasoning.infer import format_context
+from src.STEM.local_solver import local_solve
+from src.STEM.stem_module import extract_answer
+from src.router import extract_label4_and_subtype, format_mcq_for_llm, is_rag_in_question, route_cues
+
+BASELINE_PATH = "bench_baseline.json"
+
+# ------------------ INPUTS ------------------
+_WORDS = (
+    "Việt Nam là một quốc gia nằm ở phía đông bán đảo Đông Dương thuộc khu vực Đông Nam Á "
+    "thủ đô Hà Nội thành phố Hồ Chí Minh kinh tế dân số người năm theo số liệu thống kê "
+    "của Tổng cục cho thấy tỷ lệ tăng trưởng chính sách phát triển bền vững giáo dục y tế "
+    "văn hoá lịch sử triều đại nhà Nguyễn Lý Trần Lê khởi nghĩa chiến thắng hiệp định "
+    "đoạn thông tin dưới đây bảng số liệu câu hỏi đáp án nào sau đúng nhất không phải"
+).split()
+
+
+def _text(n_words, seed):
+    rnd = random.Random(seed)
+    words = [rnd.choice(_WORDS) for _ in range(n_words)]
+    for i in range(12, n_words, 13):
+        words[i] += "."
+    return " ".join(words)
+
+
+def _passage_question(n_words, seed):
+    return (
+        "Đoạn thông tin:\n" + _text(n_words, seed)
+        + "\nCâu hỏi: Theo đoạn thông tin trên, nhận định nào sau đây là đúng?"
+    )
+
+
+def _choices(n, words, seed):
+    return [_text(words, seed + i) for i in range(n)]
+
+
+def _cot_output(n_words, seed, answer=True):
+    body = "### PHÂN TÍCH\n" + _text(n_words, seed)
+    return body + ("\n### ANSWER: C" if answer else "\nKhông xác định được.")
+
+
+def _embeddings(n, dim, seed):
+    rng = np.random.default_rng(seed)
+    return [v for v in rng.standard_normal((n, dim)).astype(np.float32)]
+
+
+def build_cases():
+    """name -> zero-argument callable."""
+    short_q = "Thủ đô của Việt Nam là thành phố nào?"
+    passage_1k = _passage_question(1000, 1)
+    passage_20k = _passage_question(20000, 2)
+    text_1k, text_20k = _text(1000, 3), _text(20000, 4)
+    choices_4, choices_10 = _choices(4, 8, 5), _choices(10, 40, 6)
+    q40, c40 = _embeddings(1, 1024, 7)[0], _embeddings(40, 1024, 8)
+    c400 = _embeddings(400, 1024, 9)
+    chunks40, chunks400 = [f"chunk {i}" for i in range(40)], [f"chunk {i}" for i in range(400)]
+    docs5 = [Document(page_content=_text(400, 10 + i)) for i in range(5)]
+    docs50 = [Document(page_content=_text(400, 20 + i)) for i in range(50)]
+    cot_2k, cot_nohit = _cot_output(400, 11), _cot_output(400, 12, answer=False)
+    rag_out = _text(200, 13) + "\n[ĐÁP ÁN] B"
+    rag_group_out = "\n".join(f"[PHÂN TÍCH {n}]\n{_text(100, 30 + n)}\n[ĐÁP ÁN {n}] C" for n in range(1, 5))
+    text_200k = _text(200000, 14)
+    spans_200k = list(iter_chunk_spans(text_200k))
+    fall_q = "Một vật rơi tự do từ độ cao h = 20 m, lấy g = 10 m/s². Thời gian rơi của vật là:"
+
+    return {
+        "format_mcq_for_llm/4x8w": lambda: format_mcq_for_llm(short_q, choices_4),
+        "format_mcq_for_llm/10x40w": lambda: format_mcq_for_llm(passage_1k, choices_10),
+        "extract_label4_and_subtype/json": lambda: extract_label4_and_subtype('{"label4":"4","subtype":"MD"}'),
+        "extract_label4_and_subtype/chatter": lambda: extract_label4_and_subtype(
+            'Phân loại: ```json\n{"label4": "2", "subtype": "Compulsory"}\n``` vì câu hỏi bắt buộc.'
+        ),
+        "extract_label4_and_subtype/fallback": lambda: extract_label4_and_subtype("label4: 3, subtype: NA"),
+        "is_rag_in_question/short": lambda: is_rag_in_question(short_q),
+        "is_rag_in_question/1k": lambda: is_rag_in_question(passage_1k),
+        "is_rag_in_question/20k": lambda: is_rag_in_question(passage_20k),
+        "route_cues/short+4": lambda: route_cues(short_q, choices_4),
+        "route_cues/1k+10": lambda: route_cues(passage_1k, choices_10),
+        "split_qna/1k": lambda: split_qna(passage_1k),
+        "split_qna/20k": lambda: split_qna(passage_20k),
+        "chunk_paragraph/1k": lambda: chunk_paragraph(text_1k),
+        "chunk_paragraph/20k": lambda: chunk_paragraph(text_20k),
+        "iter_chunk_spans/1k": lambda: list(iter_chunk_spans(text_1k)),
+        "iter_chunk_spans/20k": lambda: list(iter_chunk_spans(text_20k)),
+        "iter_chunk_spans/200k": lambda: list(iter_chunk_spans(text_200k)),
+        "lexical_prefilter/200k": lambda: lexical_prefilter(text_200k, spans_200k, short_q, 40),
+        "topk_retrieve/40x1024": lambda: topk_retrieve(q40, c40, chunks40, k=3),
+        "topk_retrieve/400x1024": lambda: topk_retrieve(q40, c400, chunks400, k=3),
+        "format_context/5x400w": lambda: format_context(docs5),
+        "format_context/50x400w": lambda: format_context(docs50),
+        "local_solve/arithmetic": lambda: local_solve("Tính giá trị biểu thức (2 + 3)^2 : 5 - 1/2", ["4,5", "5", "9/2", "25"]),
+        "local_solve/physics": lambda: local_solve(fall_q, ["1 s", "2 s", "3 s", "4 s"]),
+        "local_solve/miss1k": lambda: local_solve(text_1k, choices_4),
+        "extract_answer/cot": lambda: extract_answer(cot_2k),
+        "extract_answer/fallback": lambda: extract_answer(cot_nohit),
+        "parse_answer/rag": lambda: parse_answer(rag_out),
+        "parse_group_answers/4": lambda: parse_group_answers(rag_group_out, [4, 4, 4, 4]),
+        "normalize_answer/clean": lambda: normalize_answer("B", 4),
+        "normalize_answer/noisy": lambda: normalize_answer("  đáp án: c) vì ...", 4),
+    }
+
+
+# ------------------ MEASURE ------------------
+def measure(fn, min_time=0.2, repeat=3):
+    # Calibrate the loop count so one timed run lasts about min_time / repeat.
+    number, target = 1, min_time / max(1, repeat)
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= target / 4 or number >= 1 << 24:
+            break
+        number *= 4
+    number = max(1, int(number * target / max(elapsed, 1e-9)))
+
+    best = float("inf")
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / number)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ops_per_sec": 1.0 / best, "peak_kib": peak / 1024.0}
+
+
+def compare(name, result, baseline, threshold):
+    """Regression messages for one case ([] when within the threshold)."""
+    base = baseline.get(name)
+    if not base:
+        return []
+    problems = []
+    if result["ops_per_sec"] < base["ops_per_sec"] * (1.0 - threshold):
+        problems.append(f"ops/sec {result['ops_per_sec']:.0f} < baseline {base['ops_per_sec']:.0f}")
+    # 1 KiB slack: tiny allocations vary with interpreter internals.
+    if result["peak_kib"] > base["peak_kib"] * (1.0 + threshold) + 1.0:
+        problems.append(f"peak {result['peak_kib']:.1f} KiB > baseline {base['peak_kib']:.1f} KiB")
+    return problems
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Micro-benchmarks for local hot paths")
+    p.add_argument("--filter", default="", help="only cases whose name contains this")
+    p.add_argument("--min-time", type=float, default=0.5, help="seconds of timing per case")
+    p.add_argument("--repeat", type=int, default=5, help="timed runs per case (best is kept)")
+    p.add_argument("--baseline", default=BASELINE_PATH, help="this host's baseline (recorded if missing)")
+    p.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    p.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown / allocation growth (0.25 = 25%%)")
+    args = p.parse_args(argv)
+
+    baseline = {}
+    if not os.path.exists(args.baseline):
+        print(f"ℹ️ no baseline at {args.baseline}: recording this run as the baseline")
+        args.save_baseline = True
+    elif not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        baseline = saved.get("cases", {})
+        host = (saved.get("python"), saved.get("machine"))
+        if host != (platform.python_version(), platform.machine()):
+            print(f"⚠️ baseline recorded on Python {host[0]} / {host[1]}; numbers may not be comparable")
+
+    results, failures = {}, []
+    print(f"{'case':<40} {'ops/sec':>12} {'us/op':>10} {'peak KiB':>10} {'vs base':>8}")
+    for name, fn in build_cases().items():
+        if args.filter not in name:
+            continue
+        r = measure(fn, args.min_time, args.repeat)
+        results[name] = r
+        base = baseline.get(name)
+        ratio = f"{r['ops_per_sec'] / base['ops_per_sec']:.2f}x" if base else "-"
+        problems = compare(name, r, baseline, args.threshold)
+        flag = "  ❌" if problems else ""
+        print(f"{name:<40} {r['ops_per_sec']:>12.0f} {1e6 / r['ops_per_sec']:>10.2f} {r['peak_kib']:>10.1f} {ratio:>8}{flag}")
+        failures += [f"{name}: {msg}" for msg in problems]
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cases": {k: {m: round(v, 3) for m, v in r.items()} for k, r in results.items()},
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"✅ baseline written to {args.baseline}")
+        return 0
+
+    if failures:
+        print(f"❌ {len(failures)} regression(s) beyond {args.threshold:.0%}:")
+        for msg in failures:
+            print(f"   {msg}")
+        return 1
+    if baseline:
+        print(f"✅ no regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
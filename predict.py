@@ -5,14 +5,41 @@ import os
 import json
 import csv
 import time  # ✅ ADD
+import argparse
+import hashlib
+import math
+import itertools
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------------------------------------
 # Imports (package layout)
 # -------------------------------------------------
-from src.router import classify_one
-from src.RAG.RAG_answerer import solve_rag
+from src.router import classify_and_answer, classify_one
+from src.RAG import RAG_answerer
+from src.RAG.RAG_answerer import passage_key, solve_rag, solve_rag_group
 from src.STEM.stem_module import solve_stem
-from src.Reasoning.infer import solve_reasoning
+from src.Reasoning import infer
+from src.Reasoning.infer import (
+    RETRIEVAL_CACHE,
+    preload_vectorstore,
+    retrieve_contexts_batch,
+    solve_reasoning,
+)
+from src.vnpt_client import (
+    LEDGER,
+    QuotaExceededError,
+    coalesced_calls,
+    prewarm_connections,
+    use_cassette,
+)
+from src import profiling
+from src.run_history import record_run
+from src.scheduling import estimate_cost, report_cost_model
+from src.STEM import stem_module
 
 # -------------------------------------------------
 # Paths (BTC will mount private_test.json here)
@@ -23,6 +50,10 @@ OUTPUT_TIME_PATH = "submission_time.csv"
 
 ROUTER_MODEL = "large"
 
+# Give up on a rate-limited question (answer A) after this long / this many deferrals.
+MAX_QUOTA_WAIT = float(os.getenv("MAX_QUOTA_WAIT") or 3600)
+MAX_QUOTA_DEFERRALS = 50
+
 
 def normalize_answer(ans: str, n_choices: int) -> str:
     if not ans:
@@ -36,58 +67,33 @@ def normalize_answer(ans: str, n_choices: int) -> str:
     return "A"
 
 
-def main():
-    if not os.path.exists(INPUT_PATH):
-        raise FileNotFoundError(f"❌ Missing input file: {INPUT_PATH}")
+# -------------------------------------------------
+# IO helpers
+# -------------------------------------------------
+def load_items(input_path: str) -> list:
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"❌ Missing input file: {input_path}")
 
-    with open(INPUT_PATH, "r", encoding="utf-8") as f:
+    with open(input_path, "r", encoding="utf-8") as f:
         data = json.load(f)
 
     if not isinstance(data, list):
         raise ValueError("❌ private_test.json must be a JSON list")
+    return data
 
-    results = []
-    results_time = []
-
-    for item in data:
-        qid = str(item["qid"])
-        question = (item["question"] or "").strip()
-        choices = item.get("choices") or []
-        if not isinstance(choices, list):
-            choices = []
-
-        start_t = time.time()
-
-        # 1) Route
-        label, subtype = classify_one(question, choices, model=ROUTER_MODEL)
-
-        # 2) Solve
-        if label == "RAG":
-            answer = solve_rag(question, choices)
-        elif label == "STEM":
-            answer = solve_stem(question, choices)
-        else:
-            answer = solve_reasoning(question, choices, subtype=subtype)
 
-        answer = normalize_answer(answer, len(choices))
-
-        elapsed = time.time() - start_t
-
-        results.append({"qid": qid, "answer": answer})
-        results_time.append({  
-            "qid": qid,
-            "answer": answer,
-            "time": f"{elapsed:.6f}"  # string ok; fixed decimals
-        })
+def write_outputs(results: list, results_time: list, output_dir: str = ".") -> None:
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
 
     # Write submission.csv
-    with open(OUTPUT_PATH, "w", newline="", encoding="utf-8") as f:
+    with open(os.path.join(output_dir, OUTPUT_PATH), "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=["qid", "answer"])
         writer.writeheader()
         writer.writerows(results)
 
     # ✅ Write submission_time.csv
-    with open(OUTPUT_TIME_PATH, "w", newline="", encoding="utf-8") as f:
+    with open(os.path.join(output_dir, OUTPUT_TIME_PATH), "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=["qid", "answer", "time"])
         writer.writeheader()
         writer.writerows(results_time)
@@ -96,5 +102,716 @@ def main():
     print(f"✅ submission_time.csv generated with {len(results_time)} rows")
 
 
+# -------------------------------------------------
+# Sharding (several processes / hosts, one slice each)
+# -------------------------------------------------
+def parse_shard(spec: str):
+    """'i/n' -> (i, n) with 0 <= i < n."""
+    try:
+        i_s, n_s = spec.split("/", 1)
+        i, n = int(i_s), int(n_s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"--shard must look like i/n, got {spec!r}")
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"--shard needs 0 <= i < n, got {spec!r}")
+    return i, n
+
+
+def shard_of(qid: str, n_shards: int) -> int:
+    # md5 (not hash()) so every process/host agrees regardless of PYTHONHASHSEED.
+    digest = hashlib.md5(str(qid).encode("utf-8")).hexdigest()
+    return int(digest, 16) % n_shards
+
+
+def select_shard(data: list, shard_index: int, n_shards: int) -> list:
+    if n_shards <= 1:
+        return data
+    return [item for item in data if shard_of(item["qid"], n_shards) == shard_index]
+
+
+def _read_csv_rows(path: str) -> list:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing shard output: {path}")
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def _merge_rows(qids: list, shard_dirs: list, filename: str) -> list:
+    rows_by_qid = {}
+    for shard_dir in shard_dirs:
+        path = os.path.join(shard_dir, filename)
+        for row in _read_csv_rows(path):
+            qid = str(row["qid"])
+            if qid in rows_by_qid:
+                raise ValueError(f"❌ qid {qid} appears more than once ({filename}, again in {path})")
+            rows_by_qid[qid] = row
+
+    missing = [q for q in qids if q not in rows_by_qid]
+    if missing:
+        raise ValueError(f"❌ {len(missing)} qid(s) missing from {filename}, e.g. {missing[:5]}")
+
+    extra = set(rows_by_qid) - set(qids)
+    if extra:
+        raise ValueError(f"❌ {len(extra)} unknown qid(s) in {filename}, e.g. {sorted(extra)[:5]}")
+
+    return [rows_by_qid[q] for q in qids]
+
+
+def merge_shards(input_path: str, shard_dirs: list, output_dir: str = ".") -> None:
+    """
+    Combine per-shard submission.csv / submission_time.csv into one pair,
+    checking every input qid appears exactly once and restoring input order.
+    """
+    qids = [str(item["qid"]) for item in load_items(input_path)]
+    if len(set(qids)) != len(qids):
+        raise ValueError("❌ Duplicate qids in input file")
+
+    results = [
+        {"qid": r["qid"], "answer": r["answer"]}
+        for r in _merge_rows(qids, shard_dirs, OUTPUT_PATH)
+    ]
+    results_time = [
+        {"qid": r["qid"], "answer": r["answer"], "time": r["time"]}
+        for r in _merge_rows(qids, shard_dirs, OUTPUT_TIME_PATH)
+    ]
+    write_outputs(results, results_time, output_dir)
+
+
+# -------------------------------------------------
+# Startup prewarm
+# -------------------------------------------------
+def start_prewarm(workers: int = 2) -> threading.Thread:
+    """
+    In the background: open pooled connections to the small / large / embedding
+    endpoints and load the Reasoning FAISS index, so the first real calls don't
+    absorb cold-start latency. Failures are only reported; the normal code path
+    retries lazily.
+    """
+    def _index():
+        t0 = time.time()
+        try:
+            preload_vectorstore()
+            print(f"🔥 FAISS index loaded in {time.time() - t0:.1f}s")
+        except Exception as e:
+            print(f"[WARN] index prewarm failed: {e}")
+
+    def _connections():
+        urls = [os.getenv("API_URL_SMALL"), os.getenv("API_URL_LARGE"), os.getenv("API_URL_EMBED")]
+        n = prewarm_connections([(u or "").strip() for u in urls], per_host=max(1, min(workers, 4)))
+        print(f"🔥 {n} endpoint connections prewarmed")
+
+    index_t = threading.Thread(target=_index, name="prewarm-index", daemon=True)
+    conn_t = threading.Thread(target=_connections, name="prewarm-conn", daemon=True)
+    index_t.start()
+    conn_t.start()
+    return index_t
+
+
+# -------------------------------------------------
+# Per-question pipeline
+# -------------------------------------------------
+def _prepare(item: dict) -> dict:
+    choices = item.get("choices") or []
+    if not isinstance(choices, list):
+        choices = []
+    return {
+        "qid": str(item["qid"]),
+        "question": (item["question"] or "").strip(),
+        "choices": choices,
+    }
+
+
+def route_job(job: dict, fused: bool = False) -> dict:
+    start_t = time.time()
+    if fused:
+        # Router also proposes an answer; kept only for confident Compulsory questions.
+        job["label"], job["subtype"], job["router_answer"] = classify_and_answer(
+            job["question"], job["choices"], model=ROUTER_MODEL
+        )
+    else:
+        job["label"], job["subtype"] = classify_one(job["question"], job["choices"], model=ROUTER_MODEL)
+    job["elapsed"] = job.get("elapsed", 0.0) + (time.time() - start_t)
+    return job
+
+
+def needs_retrieval(job: dict) -> bool:
+    if job.get("router_answer"):
+        return False
+    return job["label"] not in ("RAG", "STEM") and job["subtype"] != "PC"
+
+
+def rag_units(jobs: list) -> list:
+    """
+    Units of work for the solvers, in input order: RAG jobs that include the
+    same passage are grouped into units {"group": [jobs], ...} answered by a
+    single LLM call each (a passage's questions are split evenly into groups
+    of at most RAG_GROUP_SIZE); every other job is its own unit.
+    """
+    size = max(1, RAG_answerer.RAG_GROUP_SIZE)
+    keys = [
+        passage_key(j["question"]) if size > 1 and j.get("label") == "RAG" and not j.get("router_answer") else None
+        for j in jobs
+    ]
+    by_passage = OrderedDict()
+    for job, key in zip(jobs, keys):
+        if key is not None:
+            by_passage.setdefault(key, []).append(job)
+
+    units = []
+    for job, key in zip(jobs, keys):
+        if key is None:
+            units.append(job)
+            continue
+        members = by_passage.pop(key, None)
+        if members is None:  # already placed with the passage's first question
+            continue
+        n = math.ceil(len(members) / size)
+        for part in (members[len(members) * i // n:len(members) * (i + 1) // n] for i in range(n)):
+            if len(part) == 1:
+                units.append(part[0])
+            else:
+                units.append({"qid": part[0]["qid"], "label": "RAG", "subtype": part[0].get("subtype"), "group": part})
+    return units
+
+
+def unit_jobs(unit: dict) -> list:
+    return unit.get("group") or [unit]
+
+
+def solve_group(unit: dict) -> dict:
+    """solve_job for a unit of RAG jobs sharing one passage; each gets an equal share of the time."""
+    members = unit["group"]
+    start_t = time.time()
+    answers = solve_rag_group([(j["question"], j["choices"]) for j in members])
+    share = (time.time() - start_t) / len(members)
+    for job, answer in zip(members, answers):
+        job["answer"] = normalize_answer(answer, len(job["choices"]))
+        job["solve_time"] = share
+        job["elapsed"] = job.get("elapsed", 0.0) + share
+        job["rag_group"] = len(members)
+    return unit
+
+
+def set_default_answer(unit: dict, error: Exception) -> None:
+    """Answer A for every job of a unit that failed; the error goes to the run history."""
+    for job in unit_jobs(unit):
+        job["answer"] = "A"
+        job["error"] = repr(error)
+
+
+def solve_job(job: dict, context=None) -> dict:
+    if job.get("group"):
+        return solve_group(job)
+    start_t = time.time()
+    question, choices = job["question"], job["choices"]
+
+    if job.get("router_answer"):
+        answer = job["router_answer"]
+    elif job["label"] == "RAG":
+        answer = solve_rag(question, choices)
+    elif job["label"] == "STEM":
+        answer = solve_stem(question, choices)
+    else:
+        answer = solve_reasoning(question, choices, subtype=job["subtype"], context=context)
+
+    job["answer"] = normalize_answer(answer, len(choices))
+    job["solve_time"] = time.time() - start_t
+    job["elapsed"] = job.get("elapsed", 0.0) + job["solve_time"]
+    return job
+
+
+def job_model(job: dict) -> str:
+    """Model a routed job spends its quota on (quota-aware rescheduling)."""
+    if job["label"] == "RAG":
+        return RAG_answerer.RAG_MODEL
+    if job["label"] == "STEM":
+        return "small"
+    return infer.REASONING_MODEL
+
+
+def solve_job_waiting(job: dict, context=None) -> dict:
+    """
+    solve_job, but a rate-limited solver waits until the ledger says its model
+    is available again (bounded by MAX_QUOTA_WAIT) instead of answering A.
+    Any other solver error answers A, as in run_staged.
+    """
+    model = job_model(job)
+    waited = 0.0
+    for _ in range(MAX_QUOTA_DEFERRALS):
+        try:
+            return solve_job(job, context=context)
+        except QuotaExceededError:
+            delay = min(max(1.0, LEDGER.available_in(model)), MAX_QUOTA_WAIT - waited)
+            if delay <= 0:
+                break
+            print(f"⏳ {job['qid']}: {model} quota exhausted, waiting {delay:.0f}s")
+            time.sleep(delay)
+            waited += delay
+        except Exception as e:  # keep the run alive; answer defaults to A
+            print(f"[ERROR] {job['qid']}: {e}")
+            set_default_answer(job, e)
+            return job
+    set_default_answer(job, QuotaExceededError("gave up waiting for quota"))
+    return job
+
+
+def run_sequential(data: list, fused: bool = False) -> list:
+    # Route everything first so questions sharing a passage can be solved together.
+    jobs = [route_job(_prepare(item), fused=fused) for item in data]
+    for unit in rag_units(jobs):
+        solve_job_waiting(unit)
+    return jobs
+
+
+def run_staged(
+    data: list,
+    workers: int = 8,
+    embed_batch: int = 32,
+    fused: bool = False,
+    schedule: str = "ljf",
+    report: bool = True,
+) -> list:
+    """
+    Bulk pipeline: route every question first, then embed + FAISS-search all
+    Reasoning (MD/Compulsory) queries in batches (one multi-query search per
+    batch), while solver workers drain a bounded queue of ready jobs.
+    Per-question time = its own route + solve time + its share of its batch.
+
+    schedule="ljf" orders the solve queue by estimated cost (longest job first)
+    so long STEM / RAG calls don't start last; "fifo" keeps input order.
+
+    Jobs whose model is rate limited (per the quota ledger, or a solver raising
+    QuotaExceededError) are parked and re-queued once that model is available
+    again, so the other model's work keeps the workers busy meanwhile.
+    """
+    jobs = [_prepare(item) for item in data]
+    workers = max(1, workers)
+
+    # Stage 1: route everything
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        jobs = list(ex.map(lambda j: route_job(j, fused=fused), jobs))
+
+    ljf = schedule == "ljf"
+    for job in jobs:
+        job["est_cost"] = estimate_cost(job)
+
+    retrieval_jobs = [j for j in jobs if needs_retrieval(j)]
+    direct_jobs = rag_units([j for j in jobs if not needs_retrieval(j)])
+    for unit in direct_jobs:
+        if unit.get("group"):
+            unit["est_cost"] = sum(j["est_cost"] for j in unit["group"])
+    if ljf:
+        direct_jobs.sort(key=lambda j: j["est_cost"], reverse=True)
+    if report:
+        print(f"🧭 routed {len(jobs)} questions ({len(retrieval_jobs)} need retrieval)")
+
+    # Stage 3 consumers: solvers fed by a bounded (priority) queue
+    ready: "queue.PriorityQueue" = queue.PriorityQueue(maxsize=workers * 2)
+    seq = itertools.count()
+    errors = []
+
+    remaining = [len(retrieval_jobs) + len(direct_jobs)]
+    all_done = threading.Event()
+    deferred = []  # (job, context) waiting for their model's quota
+    state_lock = threading.Lock()
+    if not remaining[0]:
+        all_done.set()
+
+    def _put(job, context):
+        priority = -job["est_cost"] if ljf else 0.0
+        ready.put((priority, next(seq), job, context))
+
+    def _finish():
+        with state_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                all_done.set()
+
+    def _defer(job, context):
+        job["quota_deferrals"] = job.get("quota_deferrals", 0) + 1
+        job.setdefault("deferred_at", time.time())
+        if (
+            job["quota_deferrals"] > MAX_QUOTA_DEFERRALS
+            or time.time() - job["deferred_at"] > MAX_QUOTA_WAIT
+        ):
+            error = QuotaExceededError("gave up waiting for quota")
+            errors.append((job["qid"], error))
+            set_default_answer(job, error)
+            _finish()
+            return
+        with state_lock:
+            deferred.append((job, context))
+
+    def _pump():
+        # Re-queue parked jobs whose model has quota again.
+        while not all_done.wait(0.5):
+            with state_lock:
+                due = [(j, c) for j, c in deferred if not LEDGER.is_throttled(job_model(j))]
+                for item in due:
+                    deferred.remove(item)
+            for job, context in due:
+                _put(job, context)
+
+    def _solver():
+        while True:
+            _, _, job, context = ready.get()
+            if job is None:
+                return
+            if not job.get("router_answer") and LEDGER.is_throttled(job_model(job)):
+                _defer(job, context)
+                continue
+            try:
+                solve_job(job, context=context)
+            except QuotaExceededError:
+                _defer(job, context)
+                continue
+            except Exception as e:  # keep the run alive; answer defaults to A
+                errors.append((job["qid"], e))
+                set_default_answer(job, e)
+            _finish()
+
+    solve_start = time.time()
+    solvers = [threading.Thread(target=_solver, daemon=True) for _ in range(workers)]
+    for t in solvers:
+        t.start()
+    threading.Thread(target=_pump, daemon=True).start()
+
+    # Stage 2 producer: bulk embed + batched FAISS search
+    def _retrieve():
+        step = max(1, embed_batch)
+        for i in range(0, len(retrieval_jobs), step):
+            batch = retrieval_jobs[i:i + step]
+            start_t = time.time()
+            contexts = retrieve_contexts_batch([j["question"] for j in batch])
+            share = (time.time() - start_t) / len(batch)
+            for job, context in zip(batch, contexts):
+                job["elapsed"] += share
+                _put(job, context)
+
+    retriever = threading.Thread(target=_retrieve, daemon=True)
+    retriever.start()
+
+    for job in direct_jobs:
+        _put(job, None)
+
+    retriever.join()
+    all_done.wait()
+    for _ in solvers:
+        ready.put((math.inf, next(seq), None, None))
+    for t in solvers:
+        t.join()
+    solve_wall = time.time() - solve_start
+
+    for qid, e in errors:
+        print(f"[ERROR] {qid}: {e}")
+    parked = sum(len(unit_jobs(u)) for u in retrieval_jobs + direct_jobs if u.get("quota_deferrals"))
+    if parked:
+        print(f"⏳ {parked} questions rescheduled around rate limits")
+    grouped = [u for u in direct_jobs if u.get("group")]
+    if grouped and report:
+        print(f"📚 {sum(len(u['group']) for u in grouped)} RAG questions answered in {len(grouped)} passage groups")
+    if report:
+        report_cost_model(jobs, workers, solve_wall)
+    return jobs
+
+
+# -------------------------------------------------
+# Process pool (all cores; one shared read-only index)
+# -------------------------------------------------
+_PROC_OPTS = {}
+
+
+def memory_kb() -> dict:
+    """Rss / Pss / Shared_* (kB) of this process; Pss splits shared pages between sharers."""
+    mem = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[0] in ("Rss:", "Pss:", "Shared_Clean:", "Shared_Dirty:"):
+                    mem[parts[0][:-1]] = int(parts[1])
+    except OSError:  # not Linux: peak RSS only
+        import resource
+        mem["Rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return mem
+
+
+def _proc_init(opts: dict) -> None:
+    _PROC_OPTS.update(opts)
+    # No-op after fork (inherited); spawn-started workers load (mmap) their own.
+    try:
+        preload_vectorstore()
+    except Exception as e:
+        print(f"[WARN] worker {os.getpid()} index load failed: {e}")
+
+
+def _proc_chunk(chunk):
+    indices, items = chunk
+    jobs = run_staged(items, report=False, **_PROC_OPTS)
+    slim = [
+        {k: j[k] for k in ("qid", "answer", "elapsed", "router_answer", "label", "subtype", "error") if k in j}
+        for j in jobs
+    ]
+    stats = {
+        "coalesced": coalesced_calls(),
+        "cache_hits": RETRIEVAL_CACHE.hits,
+        "cache_misses": RETRIEVAL_CACHE.misses,
+    }
+    return indices, slim, os.getpid(), memory_kb(), stats
+
+
+def passage_order(data: list) -> list:
+    """
+    Input indices with questions that include the same passage moved next to
+    the first one, so they land in one worker chunk (and one passage group).
+    """
+    slots = OrderedDict()
+    for i, item in enumerate(data):
+        key = passage_key(item.get("question") or "") or i
+        slots.setdefault(key, []).append(i)
+    return [i for indices in slots.values() for i in indices]
+
+
+def run_processes(
+    data: list,
+    procs: int = 0,
+    workers: int = 8,
+    embed_batch: int = 32,
+    fused: bool = False,
+    schedule: str = "ljf",
+    chunk_size: int = 32,
+) -> list:
+    """
+    Process-pool pipeline: the parent loads the Reasoning index once, then
+    forks `procs` workers that share its pages copy-on-write (with
+    FAISS_MMAP=1 the vectors are a read-only mapping of the index file). Each
+    worker runs the staged pipeline on chunks of `chunk_size` questions with
+    `workers` threads; results stream back and are reassembled in input order.
+    """
+    procs = procs or os.cpu_count() or 1
+    try:
+        preload_vectorstore()
+    except Exception as e:
+        print(f"[WARN] index preload failed: {e}")
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+    opts = {"workers": workers, "embed_batch": embed_batch, "fused": fused, "schedule": schedule}
+    order = passage_order(data)
+    step = max(1, chunk_size)
+    chunks = [(order[i:i + step], [data[k] for k in order[i:i + step]]) for i in range(0, len(order), step)]
+
+    jobs = [None] * len(data)
+    per_worker = {}
+    done = 0
+    with ctx.Pool(procs, initializer=_proc_init, initargs=(opts,)) as pool:
+        for indices, slim, pid, mem, stats in pool.imap_unordered(_proc_chunk, chunks):
+            for i, job in zip(indices, slim):
+                jobs[i] = job
+            per_worker[pid] = (mem, stats)
+            done += len(slim)
+            print(f"🧩 {done}/{len(data)} questions done")
+
+    print("🧠 memory per process (kB; Pss counts shared pages proportionally)")
+    print(f"   {'pid':>8} {'Rss':>10} {'Pss':>10} {'Shared':>10} {'cache_hit':>10} {'coalesced':>10}")
+    parent = memory_kb()
+    shared = parent.get("Shared_Clean", 0) + parent.get("Shared_Dirty", 0)
+    print(f"   {'parent':>8} {parent.get('Rss', 0):>10} {parent.get('Pss', 0):>10} {shared:>10}")
+    for pid, (mem, stats) in sorted(per_worker.items()):
+        shared = mem.get("Shared_Clean", 0) + mem.get("Shared_Dirty", 0)
+        print(
+            f"   {pid:>8} {mem.get('Rss', 0):>10} {mem.get('Pss', 0):>10} {shared:>10} "
+            f"{stats['cache_hits']:>10} {stats['coalesced']:>10}"
+        )
+    return jobs
+
+
+# -------------------------------------------------
+# Run history
+# -------------------------------------------------
+def pipeline_config(args) -> dict:
+    """CLI options plus the solver tunables (see sweep.KNOBS) of this run."""
+    config = {k: v for k, v in vars(args).items() if k not in ("history", "no_history", "run_label")}
+    config.update({
+        "router_model": ROUTER_MODEL,
+        "rag_model": RAG_answerer.RAG_MODEL,
+        "rag_top_k": RAG_answerer.RAG_TOP_K,
+        "rag_chunk_tokens": RAG_answerer.RAG_CHUNK_TOKENS,
+        "rag_chunk_overlap_tokens": RAG_answerer.RAG_CHUNK_OVERLAP_TOKENS,
+        "rag_prefilter_k": RAG_answerer.RAG_PREFILTER_K,
+        "rag_max_tokens": RAG_answerer.RAG_MAX_TOKENS,
+        "rag_group_size": RAG_answerer.RAG_GROUP_SIZE,
+        "reasoning_model": infer.REASONING_MODEL,
+        "retrieval_k": infer.RETRIEVAL_K,
+        "shard_top_n": infer.SHARD_TOP_N,
+        "reasoning_max_tokens": infer.REASONING_MAX_TOKENS,
+        "stem_max_tokens": stem_module.STEM_MAX_TOKENS,
+        "stem_local_solver": stem_module.STEM_LOCAL_SOLVER,
+    })
+    return config
+
+
+def save_run_history(args, jobs: list, started: float) -> None:
+    stats = {
+        "tokens": {m: {"requests": r, "tokens": t} for m, (r, t) in LEDGER.totals().items()},
+        "fused_answers": sum(1 for j in jobs if j.get("router_answer")),
+    }
+    if args.pipeline != "processes":
+        stats.update(
+            coalesced=coalesced_calls(),
+            stem_local=stem_module.LOCAL_SOLVED,
+            cache_hits=RETRIEVAL_CACHE.hits,
+            cache_misses=RETRIEVAL_CACHE.misses,
+        )
+    try:
+        run_id = record_run(
+            jobs, pipeline_config(args), started, time.time() - started,
+            extra_stats=stats, label=args.run_label, path=args.history,
+        )
+    except Exception as e:  # history is best effort; the submission is already written
+        print(f"[WARN] run history not saved to {args.history}: {e}")
+        return
+    print(f"🗃️ run {run_id} saved to {args.history} (python -m src.run_history diff -2 -1)")
+
+
+# -------------------------------------------------
+# Main
+# -------------------------------------------------
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="VNPT AI MCQ pipeline")
+    p.add_argument("--input", default=INPUT_PATH, help="private_test.json path")
+    p.add_argument("--output-dir", default=".", help="where submission*.csv are written")
+    p.add_argument(
+        "--shard", type=parse_shard, default=None, metavar="i/n",
+        help="only process qids whose stable hash falls in shard i of n (0-based)",
+    )
+    p.add_argument(
+        "--merge", nargs="+", default=None, metavar="SHARD_DIR",
+        help="merge shard output directories into --output-dir instead of predicting",
+    )
+    p.add_argument(
+        "--pipeline", choices=["sequential", "staged", "processes"], default="sequential",
+        help="sequential: one question at a time; staged: route-all, bulk retrieval, concurrent solve; "
+             "processes: staged pipeline in a pool of worker processes sharing one index",
+    )
+    p.add_argument("--workers", type=int, default=8, help="concurrent API workers (staged pipeline, per process)")
+    p.add_argument("--procs", type=int, default=0, help="worker processes for --pipeline processes (0 = all cores)")
+    p.add_argument("--chunk-size", type=int, default=32, help="questions per work unit for --pipeline processes")
+    p.add_argument(
+        "--schedule", choices=["ljf", "fifo"], default="ljf",
+        help="staged solve order: longest (estimated) job first, or input order",
+    )
+    p.add_argument("--embed-batch", type=int, default=32, help="Reasoning queries per bulk embed/FAISS search")
+    p.add_argument("--record", default=None, metavar="CASSETTE", help="record all API traffic to a cassette (.jsonl[.gz])")
+    p.add_argument("--replay", default=None, metavar="CASSETTE", help="serve API calls from a recorded cassette (offline)")
+    p.add_argument("--replay-latency", action="store_true", help="sleep the recorded latency for each replayed call")
+    p.add_argument(
+        "--no-prewarm", action="store_true",
+        help="skip background FAISS index loading / connection warm-up at startup",
+    )
+    p.add_argument(
+        "--profile", default=None, metavar="DIR",
+        help="write per-stage cProfile/pstats, collapsed stacks and tracemalloc reports to DIR",
+    )
+    p.add_argument(
+        "--fused-router", action="store_true",
+        help="router also answers confident Compulsory questions (skips the Reasoning solver call)",
+    )
+    p.add_argument(
+        "--history", default=(os.getenv("RUN_HISTORY_DB") or "").strip() or None, metavar="DB",
+        help="record this run in a SQLite history store (off by default; also RUN_HISTORY_DB). "
+             "With --pipeline processes the per-model token totals are empty: "
+             "the workers' quota ledgers are not sent back",
+    )
+    p.add_argument("--no-history", action="store_true", help="do not record this run, even with --history / RUN_HISTORY_DB")
+    p.add_argument("--run-label", default=None, help="free-text label stored with the run")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.merge:
+        merge_shards(args.input, args.merge, args.output_dir)
+        return
+
+    started = time.time()
+    if args.profile:
+        profiling.enable(args.profile)
+
+    if args.record and args.replay:
+        raise ValueError("❌ --record and --replay are mutually exclusive")
+    if args.pipeline == "processes" and (args.record or args.profile):
+        raise ValueError("❌ --record / --profile only cover one process; not supported with --pipeline processes")
+    cassette = None
+    if args.record:
+        cassette = use_cassette(args.record, "record")
+    elif args.replay:
+        cassette = use_cassette(args.replay, "replay", replay_latency=args.replay_latency)
+
+    # The process pool loads the index itself before forking (no threads may be
+    # running then); workers open their own connections.
+    if not args.no_prewarm and args.pipeline != "processes":
+        start_prewarm(workers=args.workers if args.pipeline == "staged" else 1)
+
+    data = load_items(args.input)
+    if args.shard:
+        shard_index, n_shards = args.shard
+        data = select_shard(data, shard_index, n_shards)
+        print(f"🔀 shard {shard_index}/{n_shards}: {len(data)} questions")
+
+    with profiling.memory_checkpoint("results"):
+        if args.pipeline == "staged":
+            jobs = run_staged(
+                data,
+                workers=args.workers,
+                embed_batch=args.embed_batch,
+                fused=args.fused_router,
+                schedule=args.schedule,
+            )
+        elif args.pipeline == "processes":
+            jobs = run_processes(
+                data,
+                procs=args.procs,
+                workers=args.workers,
+                embed_batch=args.embed_batch,
+                fused=args.fused_router,
+                schedule=args.schedule,
+                chunk_size=args.chunk_size,
+            )
+        else:
+            jobs = run_sequential(data, fused=args.fused_router)
+
+    fused_answers = sum(1 for j in jobs if j.get("router_answer"))
+    if args.fused_router:
+        print(f"⚡ {fused_answers} questions answered directly by the fused router")
+
+    results = [{"qid": j["qid"], "answer": j["answer"]} for j in jobs]
+    results_time = [
+        {
+            "qid": j["qid"],
+            "answer": j["answer"],
+            "time": f"{j['elapsed']:.6f}"  # string ok; fixed decimals
+        }
+        for j in jobs
+    ]
+
+    write_outputs(results, results_time, args.output_dir)
+    if args.pipeline != "processes":  # worker processes report their own
+        print(f"🔁 {coalesced_calls()} duplicate in-flight API calls coalesced")
+        print(f"🧮 {stem_module.LOCAL_SOLVED} STEM questions solved locally (no LLM call)")
+        print(f"🗂️ retrieval cache: {RETRIEVAL_CACHE.hits} hits / {RETRIEVAL_CACHE.misses} misses")
+    for line in LEDGER.summary():
+        print(f"🎫 quota {line}")
+    for model in ("small", "large"):
+        eta = LEDGER.predict_exhaustion(model)
+        if eta is not None:
+            print(f"🎫 {model} budget exhausted in ~{eta / 60:.0f} min at the current rate")
+    if cassette is not None and cassette.mode == "replay":
+        print(f"📼 replayed from {cassette.path} ({cassette.misses} cassette misses)")
+    if args.history and not args.no_history:
+        save_run_history(args, jobs, started)
+    profiling.write_reports()
+
+
 if __name__ == "__main__":
     main()
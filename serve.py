@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running HTTP server around the predict.py pipeline (stdlib only).
+
+The FAISS index, connection pools, caches and circuit breakers stay warm
+across requests. Questions arriving within --batch-window-ms of each other
+(from any number of concurrent requests) are solved as one micro-batch:
+routed concurrently, Reasoning retrieval embedded + FAISS-searched in one
+bulk call, then solved concurrently.
+
+    POST /predict   {"question": ..., "choices": [...]}  or a list of them
+                    (also {"items": [...]}); "qid" is optional
+    GET  /health    liveness + readiness (index loaded, breaker states)
+    GET  /metrics   Prometheus text format
+
+    python serve.py --port 8080 --workers 8
+"""
+import argparse
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import predict
+from src.Reasoning import infer
+from src.Reasoning.infer import RETRIEVAL_CACHE, retrieve_contexts_batch
+from src.vnpt_client import LEDGER, breaker_for, coalesced_calls
+
+REQUEST_TIMEOUT = 15 * 60
+
+
+# -------------------------------------------------
+# Metrics
+# -------------------------------------------------
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.bad_requests = 0
+        self.questions = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_size_sum = 0
+        self.latency_sum = 0.0
+        self.in_flight = 0
+        self.routes = {}
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def add_route(self, label: str) -> None:
+        with self._lock:
+            self.routes[label] = self.routes.get(label, 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                f"vnpt_uptime_seconds {time.time() - self.started:.1f}",
+                f"vnpt_requests_total {self.requests}",
+                f"vnpt_bad_requests_total {self.bad_requests}",
+                f"vnpt_questions_total {self.questions}",
+                f"vnpt_question_errors_total {self.errors}",
+                f"vnpt_questions_in_flight {self.in_flight}",
+                f"vnpt_batches_total {self.batches}",
+                f"vnpt_batch_size_sum {self.batch_size_sum}",
+                f"vnpt_question_seconds_sum {self.latency_sum:.6f}",
+                f"vnpt_question_seconds_count {self.questions}",
+            ]
+            for label, n in sorted(self.routes.items()):
+                lines.append(f'vnpt_routed_total{{route="{label}"}} {n}')
+        lines.append(f"vnpt_retrieval_cache_hits_total {RETRIEVAL_CACHE.hits}")
+        lines.append(f"vnpt_retrieval_cache_misses_total {RETRIEVAL_CACHE.misses}")
+        lines.append(f"vnpt_coalesced_calls_total {coalesced_calls()}")
+        for model, (req, tok) in sorted(LEDGER.totals().items()):
+            lines.append(f'vnpt_api_requests_total{{model="{model}"}} {req}')
+            lines.append(f'vnpt_api_tokens_total{{model="{model}"}} {tok}')
+        for model in ("small", "large", "embed"):
+            lines.append(f'vnpt_circuit_open{{model="{model}"}} {int(breaker_for(model).state != "closed")}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+# -------------------------------------------------
+# Micro-batching
+# -------------------------------------------------
+class _Pending:
+    __slots__ = ("item", "job", "done")
+
+    def __init__(self, item: dict):
+        self.item = item
+        self.job = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Collects questions for up to `window` seconds (or `max_batch` questions)
+    after the first one arrives, then solves them together. Batches run on
+    their own threads, so the next batch is collected while one is solving.
+    """
+
+    def __init__(self, workers: int = 8, window: float = 0.02, max_batch: int = 64, fused: bool = False):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.fused = fused
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="solve")
+        self._batches = ThreadPoolExecutor(max_workers=4, thread_name_prefix="batch")
+        threading.Thread(target=self._collect, name="micro-batcher", daemon=True).start()
+
+    def submit(self, items: list) -> list:
+        pending = [_Pending(item) for item in items]
+        METRICS.add(in_flight=len(pending))
+        for p in pending:
+            self._queue.put(p)
+        deadline = time.time() + REQUEST_TIMEOUT
+        for p in pending:
+            p.done.wait(max(0.0, deadline - time.time()))
+        return pending
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._batches.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list) -> None:
+        METRICS.add(batches=1, batch_size_sum=len(batch))
+        try:
+            for p in batch:
+                p.job = predict._prepare(p.item)
+            jobs = [p.job for p in batch]
+            list(self._pool.map(lambda j: predict.route_job(j, fused=self.fused), jobs))
+
+            retrieval_jobs = [j for j in jobs if predict.needs_retrieval(j)]
+            contexts = {}
+            if retrieval_jobs:
+                start_t = time.time()
+                found = retrieve_contexts_batch([j["question"] for j in retrieval_jobs])
+                share = (time.time() - start_t) / len(retrieval_jobs)
+                for job, context in zip(retrieval_jobs, found):
+                    job["elapsed"] += share
+                    contexts[id(job)] = context
+
+            list(self._pool.map(self._solve, jobs, [contexts.get(id(j)) for j in jobs]))
+        except Exception as e:
+            print(f"[ERROR] batch of {len(batch)}: {e}")
+            for p in batch:
+                if p.job is not None:
+                    p.job.setdefault("answer", "A")
+                    p.job.setdefault("error", str(e))
+        finally:
+            for p in batch:
+                job = p.job or {}
+                METRICS.add(
+                    in_flight=-1,
+                    questions=1,
+                    errors=int("error" in job),
+                    latency_sum=job.get("elapsed", 0.0),
+                )
+                if "label" in job:
+                    METRICS.add_route(job["label"])
+                p.done.set()
+
+    @staticmethod
+    def _solve(job: dict, context) -> None:
+        try:
+            predict.solve_job_waiting(job, context=context)
+        except Exception as e:  # keep the batch alive; answer defaults to A
+            job["answer"] = "A"
+            job["error"] = str(e)
+
+
+# -------------------------------------------------
+# HTTP
+# -------------------------------------------------
+_QID_SEQ = itertools.count(1)
+
+
+def _parse_items(body: bytes):
+    """Request body -> (items, single). Raises ValueError on malformed input."""
+    payload = json.loads(body.decode("utf-8"))
+    single = isinstance(payload, dict) and "items" not in payload
+    items = [payload] if single else payload.get("items") if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise ValueError("expected a question object, a list of them, or {\"items\": [...]}")
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("question"), str):
+            raise ValueError("every item needs a \"question\" string")
+        item.setdefault("qid", f"req-{next(_QID_SEQ)}")
+    return items, single
+
+
+def _result(p: _Pending) -> dict:
+    job = p.job or {}
+    out = {
+        "qid": str(p.item["qid"]),
+        "answer": job.get("answer", "A"),
+        "route": job.get("label"),
+        "subtype": job.get("subtype"),
+        "time": round(job.get("elapsed", 0.0), 6),
+    }
+    if not p.done.is_set():
+        out["error"] = "timeout"
+    elif "error" in job:
+        out["error"] = job["error"]
+    return out
+
+
+def make_handler(batcher: MicroBatcher):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code: int, body: str, content_type: str = "application/json") -> None:
+            data = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_json(self, code: int, obj) -> None:
+            self._send(code, json.dumps(obj, ensure_ascii=False))
+
+        def do_GET(self):
+            if self.path == "/health":
+                ready = infer._VECTORSTORE is not None
+                self._send_json(200, {
+                    "status": "ok",
+                    "ready": ready,
+                    "breakers": {m: breaker_for(m).state for m in ("small", "large", "embed")},
+                })
+            elif self.path == "/metrics":
+                self._send(200, METRICS.render(), "text/plain; version=0.0.4")
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "not found"})
+                return
+            METRICS.add(requests=1)
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                items, single = _parse_items(self.rfile.read(length))
+            except (ValueError, UnicodeDecodeError) as e:
+                METRICS.add(bad_requests=1)
+                self._send_json(400, {"error": str(e)})
+                return
+            results = [_result(p) for p in batcher.submit(items)]
+            self._send_json(200, results[0] if single else {"results": results})
+
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default listen backlog (5) resets bursts of clients.
+    request_queue_size = 256
+
+
+# -------------------------------------------------
+# Main
+# -------------------------------------------------
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="VNPT AI MCQ pipeline as an HTTP service")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=8080)
+    p.add_argument("--workers", type=int, default=8, help="concurrent API workers")
+    p.add_argument("--batch-window-ms", type=float, default=20.0, help="micro-batch collection window")
+    p.add_argument("--max-batch", type=int, default=64, help="questions per micro-batch at most")
+    p.add_argument("--fused-router", action="store_true", help="see predict.py --fused-router")
+    p.add_argument("--no-prewarm", action="store_true", help="load the index lazily on first use")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.no_prewarm:
+        predict.start_prewarm(workers=args.workers)
+
+    batcher = MicroBatcher(
+        workers=args.workers,
+        window=args.batch_window_ms / 1000.0,
+        max_batch=args.max_batch,
+        fused=args.fused_router,
+    )
+    server = Server((args.host, args.port), make_handler(batcher))
+    print(f"🛰️ serving on http://{args.host}:{args.port} (POST /predict, GET /health, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
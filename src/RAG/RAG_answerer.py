@@ -1,15 +1,32 @@
+import hashlib
 import os
 import re
-from typing import List, Tuple
-import math
-import requests
+import threading
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 import argparse
+import math
+
+import numpy as np
+
+from src.profiling import profile_stage
+from src.vnpt_client import (
+    STREAM_COMPLETIONS,
+    QuotaExceededError,
+    credential_headers,
+    embedding_vectors,
+    failover_chain,
+    http_post,
+    post_embeddings,
+    raise_if_quota_exhausted,
+    record_result,
+    should_fail_over,
+    singleflight,
+    stream_chat_completion,
+)
 
 
 API_URL_EMBED = os.getenv("API_URL_EMBED")
-AUTH_EMBED = os.getenv("AUTH_EMBED")
-TOKEN_ID_EMBED = os.getenv("TOKEN_ID_EMBED")
-TOKEN_KEY_EMBED = os.getenv("TOKEN_KEY_EMBED")
 
 # SMALL LLM
 API_URL_SMALL = os.getenv("API_URL_SMALL")
@@ -29,38 +46,83 @@ HEADERS_LARGE = {
     "Content-Type": "application/json",
 }
 
+# Tunables (module globals read at call time, so sweep.py can override them)
+RAG_MODEL = "large"
+RAG_TOP_K = 3
+RAG_CHUNK_TOKENS = 600
+RAG_CHUNK_OVERLAP_TOKENS = 150
+# Most chunks embedded per question; longer passages are narrowed by lexical_prefilter.
+RAG_PREFILTER_K = 40
+RAG_MAX_TOKENS = 1000
+# Most questions about one passage answered by a single LLM call (1 = one call per question).
+RAG_GROUP_SIZE = 4
+
 
 # CALL VNPT LLM
-def query_llm(prompt, model="large"):
-    if model == "small":
-        payload = {
-            "model": "vnptai_hackathon_small",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.0,
-            "top_p": 1.0,
-            "top_k": 20,
-            "max_completion_tokens": 1000,
-            "n": 1
-        }
-        resp = requests.post(API_URL_SMALL, headers=HEADERS_SMALL, json=payload)
-    else:
+# Streaming mode stops reading once "[ĐÁP ÁN] X" is complete (see parse_answer).
+ANSWER_STOP_PAT = re.compile(r"\[ĐÁP ÁN\]\s*[A-Z](?=\W)", re.IGNORECASE)
+
+_LLM_ENDPOINTS = {
+    "small": ("vnptai_hackathon_small", API_URL_SMALL, HEADERS_SMALL),
+    "large": ("vnptai_hackathon_large", API_URL_LARGE, HEADERS_LARGE),
+}
+
+
+@singleflight
+def query_llm(prompt, model="large", max_tokens=None, stop_pattern=ANSWER_STOP_PAT):
+    """
+    Call the requested model, failing over (large -> small) while its circuit
+    breaker is open. Returns None if no endpoint answers; raises
+    QuotaExceededError if that is because every candidate is rate limited.
+    `max_tokens` defaults to RAG_MAX_TOKENS; `stop_pattern` ends a streamed
+    answer early.
+    """
+    model = "small" if model == "small" else "large"
+    statuses = []
+    for current in failover_chain(model):
+        model_id, api_url, headers = _LLM_ENDPOINTS[current]
         payload = {
-            "model": "vnptai_hackathon_large",
+            "model": model_id,
             "messages": [{"role": "user", "content": prompt}],
             "temperature": 0.0,
             "top_p": 1.0,
             "top_k": 20,
-            "max_completion_tokens": 1000,
+            "max_completion_tokens": max_tokens or RAG_MAX_TOKENS,
             "n": 1
         }
-        resp = requests.post(API_URL_LARGE, headers=HEADERS_LARGE, json=payload)
+        try:
+            if STREAM_COMPLETIONS:
+                status, content, _ = stream_chat_completion(
+                    api_url, headers, payload, stop_pattern=stop_pattern, timeout=120
+                )
+            else:
+                resp = http_post(api_url, headers=headers, json=payload)
+                status = resp.status_code
+        except Exception as e:
+            record_result(current, None)
+            statuses.append(None)
+            print("ERROR:", e)
+            continue
+        record_result(current, status)
+        statuses.append(status)
+
+        if STREAM_COMPLETIONS:
+            if status == 200:
+                return content.strip()
+            print("ERROR:", content)
+            if not should_fail_over(status):
+                return None
+            continue
 
-    try:
-        content = resp.json()["choices"][0]["message"]["content"]
-        return content.strip()
-    except Exception:
-        print("ERROR:", resp.text)
-        return None
+        try:
+            content = resp.json()["choices"][0]["message"]["content"]
+            return content.strip()
+        except Exception:
+            print("ERROR:", resp.text)
+            if not should_fail_over(resp.status_code):
+                return None
+    raise_if_quota_exhausted(model, statuses)
+    return None
 
 
 def split_qna(text: str) -> Tuple[str, str]:
@@ -109,7 +171,97 @@ def chunk_paragraph(paragraph: str, chunk_size: int = 400, overlap: int = 100) -
     return chunks
 
 
-def create_embeddings(chunks: List[str]) -> List[List[float]]:
+# Same estimate as scheduling.CHARS_PER_TOKEN (VNPT tokenizer, Vietnamese text).
+_CHARS_PER_TOKEN = 3.5
+# Sentence end: terminal punctuation (plus closing quotes / brackets) and
+# whitespace, or a line break.
+_SENTENCE_BREAK = re.compile(r"[.!?…]+[\"'”’)\]]*\s+|\n\s*")
+_TERM = re.compile(r"\w+")
+
+
+def _sentence_spans(text: str) -> Iterator[Tuple[int, int]]:
+    start = 0
+    for m in _SENTENCE_BREAK.finditer(text):
+        yield start, m.end()
+        start = m.end()
+    if start < len(text):
+        yield start, len(text)
+
+
+def _bounded_spans(text: str, max_chars: int) -> Iterator[Tuple[int, int]]:
+    """Sentence spans, with sentences longer than max_chars wrapped at whitespace."""
+    for start, end in _sentence_spans(text):
+        while end - start > max_chars:
+            cut = text.rfind(" ", start + 1, start + max_chars)
+            if cut <= start:
+                cut = start + max_chars
+            yield start, cut
+            start = cut
+        if start < end:
+            yield start, end
+
+
+def _trimmed(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def iter_chunk_spans(
+    text: str,
+    max_tokens: int = 600,
+    overlap_tokens: int = 150,
+) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (start, end) offsets into `text` of chunks made of whole sentences,
+    each at most ~max_tokens (estimated from characters); consecutive chunks
+    share up to ~overlap_tokens of trailing sentences. Every character of the
+    text is covered, nothing is copied, and work is linear in len(text).
+    """
+    max_chars = max(1, int(max_tokens * _CHARS_PER_TOKEN))
+    overlap_chars = max(0, int(overlap_tokens * _CHARS_PER_TOKEN))
+    window = deque()  # sentence spans of the chunk being built
+    for start, end in _bounded_spans(text, max_chars):
+        if window and end - window[0][0] > max_chars:
+            s, e = _trimmed(text, window[0][0], window[-1][1])
+            if s < e:
+                yield s, e
+            last = window[-1][1]
+            while window and (last - window[0][0] > overlap_chars or end - window[0][0] > max_chars):
+                window.popleft()
+        window.append((start, end))
+    if window:
+        s, e = _trimmed(text, window[0][0], window[-1][1])
+        if s < e:
+            yield s, e
+
+
+def lexical_prefilter(
+    text: str,
+    spans: List[Tuple[int, int]],
+    query: str,
+    keep: int,
+) -> List[Tuple[int, int]]:
+    """
+    Keep the `keep` spans sharing the most (IDF-weighted) terms with `query`,
+    in passage order. Cheap enough to run over every chunk of any passage, so
+    only the embedding step is bounded, not the part of the passage considered.
+    """
+    if len(spans) <= keep:
+        return spans
+    q_terms = set(_TERM.findall(query.casefold()))
+    chunk_terms = [set(_TERM.findall(text[s:e].casefold())) & q_terms for s, e in spans]
+    df = Counter(t for terms in chunk_terms for t in terms)
+    n = len(spans)
+    idf = {t: math.log(1.0 + n / c) for t, c in df.items()}
+    scores = [sum(idf[t] for t in terms) for terms in chunk_terms]
+    best = sorted(range(n), key=lambda i: (-scores[i], i))[:keep]
+    return [spans[i] for i in sorted(best)]
+
+
+def create_embeddings(chunks: List[str]) -> List[np.ndarray]:
     """
     Returns embeddings for each chunk using VNPT AI embedding API.
     Calls the API once per chunk.
@@ -117,79 +269,157 @@ def create_embeddings(chunks: List[str]) -> List[List[float]]:
     if not chunks:
         return []
 
-    if not all([API_URL_EMBED, AUTH_EMBED, TOKEN_ID_EMBED, TOKEN_KEY_EMBED]):
+    # Any key of the embedding credential pool (http_post picks the actual one).
+    headers = credential_headers("embed")
+    if not (API_URL_EMBED and all(headers.values())):
         raise EnvironmentError("Missing embedding environment variables")
 
     # keep as you had (embedding auth normalization is OK to keep)
-    auth_value = AUTH_EMBED.strip()
+    auth_value = headers["Authorization"]
     if not auth_value.lower().startswith("bearer "):
-        auth_value = f"Bearer {auth_value}"
-
-    headers = {
-        "Authorization": auth_value,
-        "Token-id": TOKEN_ID_EMBED,
-        "Token-key": TOKEN_KEY_EMBED,
-        "Content-Type": "application/json",
-    }
+        headers["Authorization"] = f"Bearer {auth_value}"
 
-    embeddings: List[List[float]] = []
+    embeddings: List[np.ndarray] = []
 
     for idx, chunk in enumerate(chunks):
         text = (chunk or "").strip()
         if not text:
             raise ValueError(f"Empty chunk at index {idx}")
 
-        payload = {
-            "model": "vnptai_hackathon_embedding",
-            "input": text,
-            "encoding_format": "float",
-        }
+        try:
+            vec = _embed_text(text, headers)
+        except RuntimeError as e:
+            raise RuntimeError(f"Embedding API error at index {idx}: {e}")
 
-        resp = requests.post(API_URL_EMBED, headers=headers, json=payload, timeout=60)
+        embeddings.append(vec)
 
-        if resp.status_code != 200:
-            raise RuntimeError(
-                f"Embedding API error at index {idx}: "
-                f"HTTP {resp.status_code} - {resp.text}"
-            )
+    return embeddings
 
-        data = resp.json()
 
-        try:
-            vec = data["data"][0]["embedding"]
-        except Exception:
-            raise RuntimeError(f"Unexpected embedding response at index {idx}: {data}")
+@singleflight
+def _embed_text(text: str, headers: dict) -> np.ndarray:
+    resp = post_embeddings(API_URL_EMBED, headers, text, timeout=60)
 
-        embeddings.append(vec)
+    if resp.status_code != 200:
+        raise RuntimeError(f"HTTP {resp.status_code} - {resp.text}")
 
-    return embeddings
+    data = resp.json()
+
+    try:
+        return embedding_vectors(data)[0]
+    except Exception:
+        raise RuntimeError(f"Unexpected embedding response: {data}")
 
 
 # ============================
 # Cosine similarity and top-k retrieval
-def l2_norm(v: List[float]) -> float:
-    return math.sqrt(sum(x * x for x in v))
+def l2_norm(v: np.ndarray) -> float:
+    return float(np.linalg.norm(v))
 
 
-def cosine_sim(a: List[float], b: List[float]) -> float:
+def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
     na, nb = l2_norm(a), l2_norm(b)
     if na == 0.0 or nb == 0.0:
         return 0.0
-    return sum(x * y for x, y in zip(a, b)) / (na * nb)
+    return float(np.dot(a, b)) / (na * nb)
 
 
 def topk_retrieve(
-    question_emb: List[float],
-    chunk_embs: List[List[float]],
+    question_emb: np.ndarray,
+    chunk_embs: List[np.ndarray],
     chunks: List[str],
     k: int = 5
 ) -> List[Tuple[int, float, str]]:
-    scored = []
-    for i, emb in enumerate(chunk_embs):
-        s = cosine_sim(question_emb, emb)
-        scored.append((i, s, chunks[i]))
-    scored.sort(key=lambda x: x[1], reverse=True)
-    return scored[:k]
+    if not chunk_embs:
+        return []
+    # One matrix-vector product instead of a Python loop per chunk.
+    mat = np.vstack(chunk_embs).astype(np.float32, copy=False)
+    q = np.asarray(question_emb, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=1) * np.linalg.norm(q)
+    scores = np.divide(mat @ q, norms, out=np.zeros(len(chunk_embs), dtype=np.float32), where=norms > 0)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [(int(i), float(scores[i]), chunks[i]) for i in order]
+
+
+# ============================
+# Passage index (shared by every question about the same passage)
+PASSAGE_CACHE_SIZE = 64
+
+
+def passage_key(question: str) -> Optional[str]:
+    """Hash of the passage a question includes (whitespace-insensitive), None without one."""
+    context, _ = split_qna(question)
+    if not context.strip():
+        return None
+    return hashlib.sha1(" ".join(context.split()).encode("utf-8")).hexdigest()
+
+
+class PassageIndex:
+    """
+    Chunk spans of one passage and the embeddings computed for them so far:
+    chunking happens once and every chunk is embedded at most once, however
+    many questions about the passage are retrieved against it.
+    """
+
+    def __init__(self, context: str, max_tokens: int, overlap_tokens: int):
+        self.context = context
+        with profile_stage("chunking"):
+            self.spans = list(iter_chunk_spans(context, max_tokens, overlap_tokens))
+        self._embs: Dict[Tuple[int, int], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def embeddings(self, spans: List[Tuple[int, int]]) -> List[np.ndarray]:
+        with self._lock:
+            missing = [s for s in spans if s not in self._embs]
+        if missing:
+            vecs = create_embeddings([self.context[s:e] for s, e in missing])
+            with self._lock:
+                self._embs.update(zip(missing, vecs))
+        return [self._embs[s] for s in spans]
+
+    def retrieve(self, q: str, choices: list, k: int) -> List[Tuple[int, int]]:
+        """Spans of the k chunks closest to the question, best first."""
+        with profile_stage("chunking"):
+            query = " ".join([q] + [str(c) for c in choices])
+            spans = lexical_prefilter(self.context, self.spans, query, RAG_PREFILTER_K)
+            chunks = [self.context[s:e] for s, e in spans]
+
+        chunk_embs = self.embeddings(spans)
+        q_emb = create_embeddings([q])[0]
+
+        with profile_stage("cosine"):
+            hits = topk_retrieve(q_emb, chunk_embs, chunks, k=k)
+        return [spans[i] for i, _, _ in hits]
+
+
+_PASSAGES: "OrderedDict[Tuple[str, int, int], PassageIndex]" = OrderedDict()
+_PASSAGES_LOCK = threading.Lock()
+
+
+def passage_index(context: str) -> PassageIndex:
+    """The (LRU-cached) PassageIndex of a passage for the current chunk settings."""
+    key = (
+        hashlib.sha1(" ".join(context.split()).encode("utf-8")).hexdigest(),
+        RAG_CHUNK_TOKENS,
+        RAG_CHUNK_OVERLAP_TOKENS,
+    )
+    with _PASSAGES_LOCK:
+        index = _PASSAGES.get(key)
+        if index is not None:
+            _PASSAGES.move_to_end(key)
+            return index
+    index = PassageIndex(context, RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP_TOKENS)
+    with _PASSAGES_LOCK:
+        index = _PASSAGES.setdefault(key, index)
+        while len(_PASSAGES) > PASSAGE_CACHE_SIZE:
+            _PASSAGES.popitem(last=False)
+    return index
+
+
+def clear_passage_cache() -> None:
+    """Forget every PassageIndex (and its chunk embeddings), e.g. between sweep configs."""
+    with _PASSAGES_LOCK:
+        _PASSAGES.clear()
 
 
 # ============================
@@ -239,6 +469,62 @@ def parse_answer(llm_response: str):
         return match.group(1).upper()
     return "A"
 
+
+def build_RAG_group_prompt(questions: Sequence[Tuple[str, list]], context):
+    blocks = []
+    for n, (question, choices) in enumerate(questions, 1):
+        formatted_choices = "\n".join(f"{chr(ord('A') + i)}. {choice}" for i, choice in enumerate(choices))
+        blocks.append(f"[CÂU {n}]\n{question}\n{formatted_choices}")
+    formatted_questions = "\n\n".join(blocks)
+
+    prompt = f"""
+Bạn là chuyên gia đọc hiểu và suy luận đáp án từ đoạn thông tin được cung cấp.
+Nhiệm vụ của bạn là trả lời {len(questions)} câu hỏi trắc nghiệm dựa trên cùng một đoạn thông tin.
+Nếu không có đủ thông tin, hãy chọn đáp án phù hợp nhất với đoạn thông tin.
+
+---
+
+Hướng dẫn xử lý:
+- Trả lời lần lượt từng câu, mỗi câu độc lập với các câu khác.
+- Đối chiếu câu hỏi với các chi tiết trong "Đoạn thông tin" để tìm bằng chứng chính xác.
+- [QUAN TRỌNG] Phân tích ngắn gọn, không lặp lại, tối đa 150 từ cho mỗi PHÂN TÍCH.
+
+Định dạng trả về bắt buộc, lặp lại cho từng câu theo đúng thứ tự (n là số thứ tự câu):
+[PHÂN TÍCH n]
+(Suy luận ngắn gọn cho câu n)
+[ĐÁP ÁN n] (Duy nhất một chữ cái, không giải thích thêm)
+
+---
+
+Các câu hỏi:
+{formatted_questions}
+
+Đoạn thông tin:
+{context}
+""".strip()
+    return prompt
+
+
+_GROUP_ANSWER = re.compile(r"\[ĐÁP ÁN\s*(\d+)\]\s*([A-Z])(?![A-Za-z])", re.IGNORECASE)
+
+
+def parse_group_answers(llm_response: str, n_choices: Sequence[int]) -> Dict[int, str]:
+    """
+    {question index (0-based): letter} from a build_RAG_group_prompt answer.
+    Numbers out of range, letters beyond a question's choices and questions
+    answered twice with different letters are left out.
+    """
+    found: Dict[int, str] = {}
+    conflicts = set()
+    for m in _GROUP_ANSWER.finditer(llm_response or ""):
+        i, letter = int(m.group(1)) - 1, m.group(2).upper()
+        if not 0 <= i < len(n_choices) or ord(letter) - ord("A") >= n_choices[i]:
+            continue
+        if found.get(i, letter) != letter:
+            conflicts.add(i)
+        found[i] = letter
+    return {i: a for i, a in found.items() if i not in conflicts}
+
 # ==============================
 # Adapter for predict.py
 # ==============================
@@ -252,18 +538,59 @@ def solve_rag(question: str, choices: list) -> str:
 
     if not context.strip():
         prompt = build_RAG_prompt(q, "", choices)
-        raw = query_llm(prompt, model="large")
+        raw = query_llm(prompt, model=RAG_MODEL)
         return parse_answer(raw or "") or "A"
 
-    chunks = chunk_paragraph(context)[:40]
+    # Chunks and their embeddings are cached per passage (see PassageIndex).
+    index = passage_index(context)
+    top_spans = index.retrieve(q, choices, RAG_TOP_K)
+    compact_context = "\n\n".join(context[s:e] for s, e in top_spans)
 
-    chunk_embs = create_embeddings(chunks)
-    q_emb = create_embeddings([q])[0]
+    prompt = build_RAG_prompt(q, compact_context, choices)
+    raw = query_llm(prompt, model=RAG_MODEL)
+    return parse_answer(raw or "") or "A"
 
-    hits = topk_retrieve(q_emb, chunk_embs, chunks, k=3)
-    top_texts = [txt for _, _, txt in hits]
-    compact_context = "\n\n".join(top_texts)
 
-    prompt = build_RAG_prompt(q, compact_context, choices)
-    raw = query_llm(prompt, model="large")
-    return parse_answer(raw or "") or "A"
\ No newline at end of file
+def solve_rag_group(items: Sequence[Tuple[str, list]]) -> List[str]:
+    """
+    Solve several RAG questions that include the same passage (see
+    passage_key): the passage is chunked and embedded once, each question
+    retrieves its own top chunks, and one LLM call answers all of them from
+    the union of those chunks. Questions the reply does not answer
+    unambiguously, or all of them when the grouped call fails, fall back to
+    solve_rag (reusing the cached passage index). QuotaExceededError is
+    raised as is, so the scheduler reschedules the whole group.
+    Return: one letter per item.
+    """
+    if len(items) == 1:
+        return [solve_rag(*items[0])]
+    context, _ = split_qna(items[0][0])
+    if not context.strip():
+        return [solve_rag(question, choices) for question, choices in items]
+
+    try:
+        index = passage_index(context)
+        questions, picked = [], set()
+        for question, choices in items:
+            _, q = split_qna(question)
+            questions.append((q, choices))
+            picked.update(index.retrieve(q, choices, RAG_TOP_K))
+        # Chunks overlap; keep passage order so the context reads as the passage does.
+        compact_context = "\n\n".join(context[s:e] for s, e in sorted(picked))
+
+        prompt = build_RAG_group_prompt(questions, compact_context)
+        last = re.compile(rf"\[ĐÁP ÁN\s*{len(items)}\]\s*[A-Z](?=\W)", re.IGNORECASE)
+        raw = query_llm(prompt, model=RAG_MODEL, max_tokens=RAG_MAX_TOKENS * len(items), stop_pattern=last)
+    except QuotaExceededError:
+        raise
+    except Exception as e:
+        print(f"[RAG] grouped call failed ({e}); asking one by one")
+        return [solve_rag(question, choices) for question, choices in items]
+    answers = parse_group_answers(raw or "", [len(choices) for _, choices in items])
+
+    missing = [i for i in range(len(items)) if i not in answers]
+    if missing:
+        print(f"[RAG] grouped answer incomplete ({len(missing)}/{len(items)} missing); asking one by one")
+    for i in missing:
+        answers[i] = solve_rag(*items[i])
+    return [answers[i] for i in range(len(items))]
\ No newline at end of file
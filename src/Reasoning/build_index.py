@@ -0,0 +1,347 @@
+"""
+Build / update the RAG_model_4 knowledge index used by the Reasoning solver.
+
+    python -m src.Reasoning.build_index --input kb/ extra.jsonl [--index-dir RAG_model_4]
+
+- Documents are streamed from files / directories: .txt / .md (one document
+  per file), .jsonl (one {"text": ..., "id"?: ..., "source"?: ...} per line)
+  and .json (a list of such objects).
+- Each document is chunked (chunk_paragraph, word windows) and every chunk is
+  identified by a hash of its normalized text: chunks already in the index
+  (or seen earlier in this run) are not embedded again, so re-running on an
+  updated knowledge base only embeds new / changed chunks.
+- Embeddings are requested in concurrent batches; every finished batch is
+  appended to a checkpoint file next to the index, so an interrupted build
+  resumes where it stopped.
+- The updated index is written to a temporary directory and swapped in at the
+  end (the Reasoning retrieval cache invalidates itself on the new files).
+- With --shards (automatic when the index already had shards) the index is
+  then split into domain shards (see shards.py): a record's "domain" field
+  when given, else the domain its text has most cue phrases for.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from src.RAG.RAG_answerer import chunk_paragraph
+from src.Reasoning.infer import (
+    API_URL_EMBED,
+    HEADERS_EMBED,
+    RAG_INDEX_DIR,
+    VNPTEmbeddings,
+    _embed_batch,
+)
+from src.Reasoning.retrieval_cache import normalize_query
+from src.Reasoning.shards import MANIFEST, SHARDS_DIR, document_domain
+
+EMBED_RETRIES = 3
+
+
+# =========================
+# DOCUMENTS
+# =========================
+def _records_from_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f):
+                line = line.strip()
+                if line:
+                    yield _record(json.loads(line), path, n)
+    elif ext == ".json":
+        with open(path, "r", encoding="utf-8") as f:
+            for n, rec in enumerate(json.load(f)):
+                yield _record(rec, path, n)
+    elif ext in (".txt", ".md"):
+        with open(path, "r", encoding="utf-8") as f:
+            yield path, f.read(), {"source": path}
+
+
+def _record(rec, path, n):
+    meta = {"source": rec.get("source") or path}
+    if rec.get("domain"):
+        meta["domain"] = str(rec["domain"])
+    return str(rec.get("id", f"{path}:{n}")), rec.get("text") or "", meta
+
+
+def iter_documents(paths):
+    """(doc_id, text, metadata) for every document under `paths`, one at a time."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield from _records_from_file(os.path.join(root, name))
+        else:
+            yield from _records_from_file(path)
+
+
+def chunk_hash(text):
+    return hashlib.sha1(normalize_query(text).encode("utf-8")).hexdigest()
+
+
+def iter_chunks(paths, chunk_size, overlap):
+    """(hash, text, metadata) per chunk, streaming over the documents."""
+    for doc_id, text, doc_meta in iter_documents(paths):
+        for i, chunk in enumerate(chunk_paragraph(text, chunk_size, overlap)):
+            chunk = chunk.strip()
+            if chunk:
+                yield chunk_hash(chunk), chunk, dict(doc_meta, doc_id=doc_id, chunk=i)
+
+
+# =========================
+# CHECKPOINT
+# =========================
+class Checkpoint:
+    """Append-only JSONL of embedded chunks (vector as base64 float32)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break  # torn last line of an interrupted run
+                vec = np.frombuffer(base64.b64decode(rec["vec"]), dtype="<f4")
+                entries.append((rec["id"], rec["text"], rec["metadata"], vec))
+        return entries
+
+    def append(self, entries):
+        lines = [
+            json.dumps({
+                "id": h,
+                "text": text,
+                "metadata": meta,
+                "vec": base64.b64encode(np.asarray(vec, dtype="<f4").tobytes()).decode("ascii"),
+            }, ensure_ascii=False)
+            for h, text, meta, vec in entries
+        ]
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# =========================
+# BUILD
+# =========================
+def _embed_with_retry(texts):
+    for attempt in range(EMBED_RETRIES):
+        try:
+            return _embed_batch(API_URL_EMBED, HEADERS_EMBED, texts)
+        except Exception:
+            if attempt == EMBED_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+class _Index:
+    """The vectorstore being built (created lazily from the first vectors)."""
+
+    def __init__(self, vs):
+        self.vs = vs
+        self._lock = threading.Lock()
+
+    def add(self, entries):
+        if not entries:
+            return
+        pairs = [(text, vec) for _, text, _, vec in entries]
+        metas = [meta for _, _, meta, _ in entries]
+        ids = [h for h, _, _, _ in entries]
+        with self._lock:
+            if self.vs is None:
+                self.vs = FAISS.from_embeddings(pairs, VNPTEmbeddings(API_URL_EMBED, HEADERS_EMBED), metas, ids)
+            else:
+                self.vs.add_embeddings(pairs, metas, ids)
+
+
+def _save(vs, index_dir):
+    """Write next to index_dir, then swap directories."""
+    tmp, old = index_dir + ".tmp", index_dir + ".old"
+    shutil.rmtree(tmp, ignore_errors=True)
+    vs.save_local(tmp)
+    if os.path.exists(index_dir):
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(index_dir, old)
+    os.replace(tmp, index_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _vectors(vs):
+    """All stored vectors, in index order (flat indexes)."""
+    return vs.index.reconstruct_n(0, vs.index.ntotal)
+
+
+def shard_index(vs, index_dir):
+    """Write vs's domain shards (index_dir/shards/<domain>/) and shards.json."""
+    vecs = _vectors(vs)
+    groups = {}
+    for pos in range(vs.index.ntotal):
+        doc_id = vs.index_to_docstore_id[pos]
+        groups.setdefault(document_domain(vs.docstore.search(doc_id)), []).append(pos)
+
+    shards_dir = os.path.join(index_dir, SHARDS_DIR)
+    tmp = shards_dir + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    manifest = {"metric": "ip" if vs.index.metric_type == 0 else "l2", "shards": {}}
+    embeddings = VNPTEmbeddings(API_URL_EMBED, HEADERS_EMBED)
+    for name, positions in sorted(groups.items()):
+        ids = [vs.index_to_docstore_id[p] for p in positions]
+        docs = [vs.docstore.search(i) for i in ids]
+        shard = FAISS.from_embeddings(
+            [(d.page_content, vecs[p]) for d, p in zip(docs, positions)],
+            embeddings,
+            [d.metadata for d in docs],
+            ids,
+            distance_strategy=vs.distance_strategy,
+            normalize_L2=getattr(vs, "_normalize_L2", False),
+        )
+        shard.save_local(os.path.join(tmp, name))
+        unit = vecs[positions] / np.maximum(np.linalg.norm(vecs[positions], axis=1, keepdims=True), 1e-12)
+        manifest["shards"][name] = {"size": len(positions), "centroid": unit.mean(axis=0).tolist()}
+
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    os.replace(tmp, shards_dir)
+    with open(os.path.join(index_dir, MANIFEST + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(index_dir, MANIFEST + ".tmp"), os.path.join(index_dir, MANIFEST))
+    sizes = ", ".join(f"{n}={s['size']}" for n, s in manifest["shards"].items())
+    print(f"🗂️ {index_dir}: {len(groups)} domain shards ({sizes})")
+
+
+def build_index(
+    paths,
+    index_dir=RAG_INDEX_DIR,
+    chunk_size=400,
+    overlap=100,
+    batch_size=64,
+    workers=8,
+    rebuild=False,
+    shards=False,
+):
+    start = time.time()
+    shards = shards or os.path.exists(os.path.join(index_dir, MANIFEST))
+    index = _Index(None)
+    known = set()
+    if not rebuild and os.path.exists(os.path.join(index_dir, "index.faiss")):
+        vs = FAISS.load_local(
+            index_dir,
+            VNPTEmbeddings(API_URL_EMBED, HEADERS_EMBED),
+            allow_dangerous_deserialization=True
+        )
+        index.vs = vs
+        # Older indexes use random docstore ids: hash their text instead.
+        known = {chunk_hash(doc.page_content) for doc in vs.docstore._dict.values()}
+        print(f"📚 appending to {index_dir} ({len(known)} chunks)")
+
+    checkpoint = Checkpoint(index_dir.rstrip("/\\") + ".checkpoint.jsonl")
+    if rebuild:
+        checkpoint.remove()
+    resumed = [e for e in checkpoint.load() if e[0] not in known]
+    index.add(resumed)
+    resumed_ids = {e[0] for e in resumed}
+    if resumed:
+        print(f"📚 resumed {len(resumed)} embedded chunks from {checkpoint.path}")
+
+    stats = {"chunks": 0, "duplicates": 0, "embedded": 0}
+
+    def _run(batch):
+        vecs = _embed_with_retry([text for _, text, _ in batch])
+        entries = [(h, text, meta, vec) for (h, text, meta), vec in zip(batch, vecs)]
+        checkpoint.append(entries)
+        index.add(entries)
+        return len(entries)
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        def _drain(limit):
+            nonlocal in_flight
+            while len(in_flight) > limit:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    stats["embedded"] += fut.result()
+                print(f"📚 {stats['embedded']} chunks embedded ({stats['duplicates']} unchanged skipped)")
+
+        batch = []
+        for h, text, meta in iter_chunks(paths, chunk_size, overlap):
+            stats["chunks"] += 1
+            if h in resumed_ids:
+                resumed_ids.discard(h)
+                known.add(h)
+                continue
+            if h in known:
+                stats["duplicates"] += 1
+                continue
+            known.add(h)
+            batch.append((h, text, meta))
+            if len(batch) >= batch_size:
+                in_flight.add(ex.submit(_run, batch))
+                batch = []
+                _drain(workers * 2)  # bounded: the corpus is never held in memory
+        if batch:
+            in_flight.add(ex.submit(_run, batch))
+        _drain(0)
+
+    if index.vs is None:
+        print("📚 nothing to index")
+        return None
+    changed = bool(stats["embedded"] or resumed or rebuild)
+    if changed:
+        _save(index.vs, index_dir)
+    checkpoint.remove()
+    if shards and (changed or not os.path.exists(os.path.join(index_dir, MANIFEST))):
+        shard_index(index.vs, index_dir)
+    print(
+        f"✅ {index_dir}: {index.vs.index.ntotal} vectors "
+        f"({stats['embedded'] + len(resumed)} new incl. {len(resumed)} resumed, "
+        f"{stats['duplicates']} unchanged of {stats['chunks']} chunks) "
+        f"in {time.time() - start:.1f}s"
+    )
+    return index.vs
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Build / update the Reasoning knowledge index (RAG_model_4)")
+    p.add_argument("--input", nargs="+", required=True, help="files / directories (.txt .md .jsonl .json)")
+    p.add_argument("--index-dir", default=RAG_INDEX_DIR)
+    p.add_argument("--chunk-size", type=int, default=400, help="words per chunk")
+    p.add_argument("--overlap", type=int, default=100, help="words shared by consecutive chunks")
+    p.add_argument("--batch-size", type=int, default=64, help="chunks per embedding request")
+    p.add_argument("--workers", type=int, default=8, help="concurrent embedding requests")
+    p.add_argument("--rebuild", action="store_true", help="ignore the existing index and checkpoint")
+    p.add_argument("--shards", action="store_true", help="also write domain shards (kept once the index has them)")
+    args = p.parse_args(argv)
+    build_index(
+        args.input,
+        index_dir=args.index_dir,
+        chunk_size=args.chunk_size,
+        overlap=args.overlap,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        rebuild=args.rebuild,
+        shards=args.shards,
+    )
+
+
+if __name__ == "__main__":
+    main()
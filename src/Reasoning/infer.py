@@ -1,18 +1,34 @@
 import json
 import random
-import requests
 import argparse
 import time
 import os
 from dotenv import load_dotenv
 import csv
 from collections import Counter
-import re
+import threading
 
+import numpy as np
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import FAISS
 from tqdm import tqdm
 
+from src.heuristics import ENGINE
+from src.profiling import memory_checkpoint, profile_stage
+from src.Reasoning.retrieval_cache import RetrievalCache, index_fingerprint, normalize_query
+from src.Reasoning.shards import ShardedIndex
+from src.vnpt_client import (
+    embedding_vectors,
+    failover_chain,
+    http_post,
+    post_embeddings,
+    raise_if_quota_exhausted,
+    record_result,
+    should_fail_over,
+    singleflight,
+)
+
 load_dotenv()
 
 # =========================
@@ -51,6 +67,17 @@ _PROJECT_ROOT = os.path.abspath(os.path.join(_THIS_DIR, "..", ".."))
 RAG_INDEX_DIR = os.path.join(_PROJECT_ROOT, "RAG_model_4")
 
 _VECTORSTORE = None
+_VECTORSTORE_LOCK = threading.Lock()
+# Memory-map the FAISS vectors read-only instead of copying them onto the heap,
+# so worker processes share one page-cache copy (predict.py --pipeline processes).
+INDEX_MMAP = (os.getenv("FAISS_MMAP") or "").strip().lower() in {"1", "true", "yes", "on"}
+
+# Tunables (module globals read at call time, so sweep.py can override them)
+REASONING_MODEL = "large"
+RETRIEVAL_K = 5
+REASONING_MAX_TOKENS = 5
+# Domain shards searched per query when RAG_model_4 is sharded (0 = all shards).
+SHARD_TOP_N = int(os.getenv("SHARD_TOP_N") or 2)
 
 # =========================
 # EMBEDDINGS
@@ -61,20 +88,47 @@ class VNPTEmbeddings(Embeddings):
         self.headers = headers
 
     def embed_documents(self, texts):
-        return [self._embed(t) for t in texts]
+        return _embed_batch(self.api_url, self.headers, list(texts))
 
     def embed_query(self, text):
         return self._embed(text)
 
     def _embed(self, text):
-        payload = {
-            "model": "vnptai_hackathon_embedding",
-            "input": text
-        }
-        resp = requests.post(self.api_url, headers=self.headers, json=payload, timeout=60)
-        if resp.status_code != 200:
-            raise RuntimeError(f"Embedding API error {resp.status_code}: {resp.text}")
-        return resp.json()["data"][0]["embedding"]
+        return _embed_text(self.api_url, self.headers, text)
+
+
+@singleflight
+def _embed_text(api_url, headers, text):
+    resp = post_embeddings(api_url, headers, text, timeout=60)
+    if resp.status_code != 200:
+        raise RuntimeError(f"Embedding API error {resp.status_code}: {resp.text}")
+    return embedding_vectors(resp.json())[0]
+
+
+# None = not probed yet; flips to False once the endpoint rejects list input.
+_BATCH_EMBED_SUPPORTED = None
+
+
+def _embed_batch(api_url, headers, texts):
+    """
+    Embed many texts with one request ("input": [...]) when the endpoint
+    accepts it, otherwise fall back to one request per text.
+    """
+    global _BATCH_EMBED_SUPPORTED
+    if len(texts) > 1 and _BATCH_EMBED_SUPPORTED is not False:
+        try:
+            resp = post_embeddings(api_url, headers, texts, timeout=120)
+            if resp.status_code == 200:
+                body = resp.json()
+                if len(body.get("data") or []) == len(texts):
+                    _BATCH_EMBED_SUPPORTED = True
+                    return embedding_vectors(body)
+                _BATCH_EMBED_SUPPORTED = False
+            elif 400 <= resp.status_code < 500 and resp.status_code != 429:
+                _BATCH_EMBED_SUPPORTED = False
+        except Exception:
+            pass
+    return [_embed_text(api_url, headers, t) for t in texts]
 
 
 def _get_vectorstore():
@@ -82,22 +136,142 @@ def _get_vectorstore():
     if _VECTORSTORE is not None:
         return _VECTORSTORE
 
-    embeddings = VNPTEmbeddings(API_URL_EMBED, HEADERS_EMBED)
-    _VECTORSTORE = FAISS.load_local(
-        RAG_INDEX_DIR,
+    # A prewarm thread may already be loading it: wait instead of loading twice.
+    with _VECTORSTORE_LOCK:
+        if _VECTORSTORE is not None:
+            return _VECTORSTORE
+
+        embeddings = VNPTEmbeddings(API_URL_EMBED, HEADERS_EMBED)
+        with memory_checkpoint("index_load"), profile_stage("index_load"):
+            vs = _load_index(embeddings)
+        # Cached retrieval results are only valid for this exact index (and,
+        # sharded, for this number of shards searched).
+        fingerprint = index_fingerprint(RAG_INDEX_DIR)
+        if isinstance(vs, ShardedIndex):
+            fingerprint += f":top{SHARD_TOP_N}"
+        RETRIEVAL_CACHE.bind(fingerprint)
+        _VECTORSTORE = vs
+    return _VECTORSTORE
+
+
+def _load_index(embeddings):
+    """The domain shards of RAG_model_4 when it has them, else the full index."""
+    sharded = ShardedIndex.load(RAG_INDEX_DIR, lambda path: _load_faiss(path, embeddings), _search_faiss)
+    if sharded is not None:
+        print(f"📚 {RAG_INDEX_DIR}: {len(sharded.names)} shards ({sharded.ntotal} vectors), top {SHARD_TOP_N} per query")
+        return sharded
+    return _load_faiss(RAG_INDEX_DIR, embeddings)
+
+
+def _load_faiss(path, embeddings):
+    if INDEX_MMAP:
+        import faiss
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return FAISS.load_local(
+                path,
+                embeddings,
+                allow_dangerous_deserialization=True,
+                io_flags=flags,
+            )
+        except (TypeError, RuntimeError) as e:
+            # Older langchain-community (no io_flags) or an index type faiss can't map.
+            print(f"[WARN] mmap index load failed ({e}), loading into memory")
+    return FAISS.load_local(
+        path,
         embeddings,
         allow_dangerous_deserialization=True
     )
-    return _VECTORSTORE
+
+
+def preload_vectorstore():
+    """Load RAG_model_4 ahead of the first Reasoning question (startup prewarm)."""
+    vs = _get_vectorstore()
+    if isinstance(vs, ShardedIndex):
+        vs.load_all()
 
 
 # =========================
 # RETRIEVAL
 # =========================
+RETRIEVAL_CACHE = RetrievalCache()
+
+
+def _search_ids(vs, vecs, k, questions=None):
+    """Multi-query FAISS search -> per query [(docstore_id, distance), ...]."""
+    if isinstance(vs, ShardedIndex):
+        return vs.search(vecs, k, questions, top_n=SHARD_TOP_N)
+    return _search_faiss(vs, vecs, k)
+
+
+def _search_faiss(vs, vecs, k):
+    x = np.asarray(vecs, dtype=np.float32)
+    if getattr(vs, "_normalize_L2", False):
+        import faiss
+        faiss.normalize_L2(x)
+
+    with profile_stage("faiss_search"):
+        scores, ids = vs.index.search(x, k)
+    return [
+        [(vs.index_to_docstore_id[i], float(sc)) for sc, i in zip(srow, irow) if i != -1]
+        for srow, irow in zip(scores, ids)
+    ]
+
+
+def _docs_for(vs, hits):
+    lookup = vs.document if isinstance(vs, ShardedIndex) else vs.docstore.search
+    docs = []
+    for doc_id, _ in hits:
+        doc = lookup(doc_id)
+        if isinstance(doc, Document):
+            docs.append(doc)
+    return docs
+
+
 def safe_retrieve_with_score(question, k=5):
     vs = _get_vectorstore()
-    results = vs.similarity_search_with_score(question, k=k)
-    return [doc for doc, _ in results]
+    hits = RETRIEVAL_CACHE.get(question, k)
+    if hits is None:
+        vec = _embed_text(API_URL_EMBED, HEADERS_EMBED, question)
+        hits = _search_ids(vs, [vec], k, [question])[0]
+        RETRIEVAL_CACHE.put(question, k, hits)
+    return _docs_for(vs, hits)
+
+
+def similarity_search_batch(questions, k=5):
+    """
+    Bulk variant of safe_retrieve_with_score: one embedding pass for all
+    uncached questions, then a single multi-query FAISS search (nq > 1).
+    """
+    if not questions:
+        return []
+    vs = _get_vectorstore()
+
+    hits = [RETRIEVAL_CACHE.get(q, k) for q in questions]
+    # Normalized-identical misses are embedded and searched once.
+    pending = {}
+    for q, h in zip(questions, hits):
+        if h is None:
+            pending.setdefault(normalize_query(q), q)
+
+    if pending:
+        misses = list(pending.values())
+        vecs = _embed_batch(API_URL_EMBED, HEADERS_EMBED, misses)
+        found = dict(zip(pending, _search_ids(vs, vecs, k, misses)))
+        for q, h in zip(misses, found.values()):
+            RETRIEVAL_CACHE.put(q, k, h)
+        hits = [h if h is not None else found[normalize_query(q)] for q, h in zip(questions, hits)]
+
+    return [_docs_for(vs, h) for h in hits]
+
+
+def retrieve_contexts_batch(questions, k=None):
+    """format_context() for many questions at once; "" for all on failure."""
+    k = RETRIEVAL_K if k is None else k
+    try:
+        return [format_context(docs) for docs in similarity_search_batch(questions, k=k)]
+    except Exception:
+        return [""] * len(questions)
 
 
 def format_context(docs, max_chars=20000):
@@ -181,52 +355,72 @@ Trả lời:
 # =========================
 # CALL VNPT LLM
 # =========================
-def query_llm_safe(prompt, model="large"):
-    api_url = API_URL_LARGE if model == "large" else API_URL_SMALL
-    headers = HEADERS_LARGE if model == "large" else HEADERS_SMALL
-    model_id = "vnptai_hackathon_large" if model == "large" else "vnptai_hackathon_small"
+_LLM_ENDPOINTS = {
+    "small": ("vnptai_hackathon_small", API_URL_SMALL, HEADERS_SMALL),
+    "large": ("vnptai_hackathon_large", API_URL_LARGE, HEADERS_LARGE),
+}
 
-    payload = {
-        "model": model_id,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.0,
-        "max_completion_tokens": 5,
-    }
 
-    try:
-        r = requests.post(api_url, headers=headers, json=payload, timeout=30)
-        if r.status_code == 200:
-            return r.json()["choices"][0]["message"]["content"].strip()
-    except Exception:
-        pass
+@singleflight
+def query_llm_safe(prompt, model="large"):
+    model = "large" if model == "large" else "small"
+
+    # Fails over large -> small while the large breaker is open; None when every
+    # endpoint is short-circuited so callers fall back to local heuristics.
+    # Rate limits on every candidate raise QuotaExceededError (rescheduled upstream).
+    statuses = []
+    for current in failover_chain(model):
+        model_id, api_url, headers = _LLM_ENDPOINTS[current]
+        payload = {
+            "model": model_id,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.0,
+            "max_completion_tokens": REASONING_MAX_TOKENS,
+        }
+
+        try:
+            r = http_post(api_url, headers=headers, json=payload, timeout=30)
+        except Exception:
+            record_result(current, None)
+            statuses.append(None)
+            continue
+        record_result(current, r.status_code)
+        statuses.append(r.status_code)
+
+        try:
+            if r.status_code == 200:
+                return r.json()["choices"][0]["message"]["content"].strip()
+        except Exception:
+            pass
+        if not should_fail_over(r.status_code):
+            return None
+    raise_if_quota_exhausted(model, statuses)
     return None
 
 
 # =========================
 # REFUSAL HEURISTIC (FALLBACK)
 # =========================
-_REFUSAL_PAT = re.compile(
-    r"^(tôi không thể|tôi không được phép|xin lỗi[, ]|không thể cung cấp)",
-    re.I
-)
-
+# Refusal phrasings are the "refusal" rules of src/heuristics.py.
 def heuristic_pick_refusal(choices):
-    for i, c in enumerate(choices):
-        if _REFUSAL_PAT.search(str(c).strip()):
-            return chr(ord("A") + i)
-    return "A"
+    hits = ENGINE.scan("", choices).choices("refusal")
+    return chr(ord("A") + hits[0]) if hits else "A"
 
 
 # =========================
 # SOLVER (USED BY predict.py)
 # =========================
-def solve_reasoning(question: str, choices: list, subtype: str = "MD") -> str:
+def solve_reasoning(question: str, choices: list, subtype: str = "MD", context=None) -> str:
+    """
+    `context` may be passed in when retrieval already happened in bulk
+    (see retrieve_contexts_batch); otherwise it is retrieved here.
+    """
     valid = [chr(ord("A") + i) for i in range(len(choices))]
 
     # -------- PC: LLM VALIDATOR --------
     if subtype == "PC":
         prompt = build_pc_validator_prompt(question, choices)
-        raw = query_llm_safe(prompt, model="large")
+        raw = query_llm_safe(prompt, model=REASONING_MODEL)
 
         if raw and raw[0] in valid:
             return raw[0]
@@ -234,14 +428,15 @@ def solve_reasoning(question: str, choices: list, subtype: str = "MD") -> str:
         return heuristic_pick_refusal(choices)
 
     # -------- MD / Compulsory --------
-    try:
-        docs = safe_retrieve_with_score(question, k=5)
-        context = format_context(docs)
-    except Exception:
-        context = ""
+    if context is None:
+        try:
+            docs = safe_retrieve_with_score(question, k=RETRIEVAL_K)
+            context = format_context(docs)
+        except Exception:
+            context = ""
 
     prompt = build_prompt(question, choices, context)
-    raw = query_llm_safe(prompt, model="large")
+    raw = query_llm_safe(prompt, model=REASONING_MODEL)
 
     if raw and raw[0] in valid:
         return raw[0]
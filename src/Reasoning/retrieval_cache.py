@@ -0,0 +1,126 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# =========================
+# CONFIG
+# =========================
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE") or 4096)
+# Optional JSON file so the cache survives between runs (empty = memory only).
+RETRIEVAL_CACHE_PATH = (os.getenv("RETRIEVAL_CACHE_PATH") or "").strip()
+
+_WS = re.compile(r"\s+")
+
+
+# =========================
+# KEYS / FINGERPRINT
+# =========================
+def normalize_query(text):
+    """
+    Queries that differ only in Unicode form (NFC vs NFD Vietnamese diacritics),
+    casing or whitespace share one cache entry.
+    """
+    t = unicodedata.normalize("NFC", text or "")
+    return _WS.sub(" ", t).strip().casefold()
+
+
+def index_fingerprint(index_dir):
+    """Cheap identity of the on-disk index: file names, sizes and mtimes."""
+    h = hashlib.sha1()
+    if os.path.isdir(index_dir):
+        for name in sorted(os.listdir(index_dir)):
+            st = os.stat(os.path.join(index_dir, name))
+            h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode("utf-8"))
+    return h.hexdigest()
+
+
+# =========================
+# LRU CACHE
+# =========================
+class RetrievalCache:
+    """
+    LRU map: (normalized query, k) -> [(docstore_id, score), ...].
+
+    Entries belong to one index fingerprint; binding a different fingerprint
+    (index rebuilt / replaced) drops everything.
+    """
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_SIZE, path=RETRIEVAL_CACHE_PATH):
+        self.max_entries = max(1, max_entries)
+        self.path = path
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            atexit.register(self.save)
+
+    @staticmethod
+    def _key(query, k):
+        return f"{k}|{normalize_query(query)}"
+
+    def bind(self, fingerprint):
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            self._entries.clear()
+            self.fingerprint = fingerprint
+            if self.path:
+                self._load_locked()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, query, k):
+        key = self._key(query, k)
+        with self._lock:
+            hits = self._entries.get(key)
+            if hits is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return hits
+
+    def put(self, query, k, hits):
+        key = self._key(query, k)
+        with self._lock:
+            self._entries[key] = [(str(i), float(s)) for i, s in hits]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load_locked(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("fingerprint") != self.fingerprint:
+            return
+        for key, hits in data.get("entries", [])[-self.max_entries:]:
+            self._entries[key] = [(str(i), float(s)) for i, s in hits]
+
+    def save(self):
+        if not self.path or self.fingerprint is None:
+            return
+        with self._lock:
+            data = {
+                "fingerprint": self.fingerprint,
+                "entries": [[key, hits] for key, hits in self._entries.items()],
+            }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
@@ -0,0 +1,145 @@
+"""
+Domain shards of the Reasoning knowledge index (RAG_model_4).
+
+RAG_model_4/shards/<domain>/ holds one FAISS index per knowledge domain (law,
+history, geography, culture, general), with the same docstore ids as the full
+index, and RAG_model_4/shards.json their sizes and centroids. Each query
+searches only the shards whose centroids are closest to it (plus shards the
+question's domain cues name) and the per-shard top-k lists are merged, so
+search cost and the index memory touched scale with the shards searched.
+Shards are loaded on first use.
+
+Written by `python -m src.Reasoning.build_index ... --shards` (see
+build_index.shard_index); without shards.json the full index is used.
+"""
+import json
+import os
+import threading
+from collections import Counter
+
+import numpy as np
+
+from src.heuristics import DOMAIN_ENGINE
+
+DOMAINS = ("law", "history", "geography", "culture", "general")
+MANIFEST = "shards.json"
+SHARDS_DIR = "shards"
+
+
+# =========================
+# DOMAINS
+# =========================
+def document_domain(doc):
+    """metadata["domain"] when given, else the domain with most cue phrases."""
+    domain = (getattr(doc, "metadata", None) or {}).get("domain")
+    if domain in DOMAINS:
+        return domain
+    votes = Counter(rule.kind for rule in DOMAIN_ENGINE.scan(getattr(doc, "page_content", "") or "").rules())
+    if not votes:
+        return "general"
+    return max(DOMAINS, key=lambda d: (votes.get(d, 0), -DOMAINS.index(d)))
+
+
+def question_domains(question):
+    return {rule.kind for rule in DOMAIN_ENGINE.scan(question or "").rules()}
+
+
+def _unit(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+# =========================
+# SHARDED INDEX
+# =========================
+class ShardedIndex:
+    """
+    The shards of one index directory. `load_fn(path)` loads one FAISS
+    vectorstore and `search_fn(vs, x, k)` searches it (per query
+    [(docstore_id, score), ...]); both come from infer so that shards are
+    loaded (mmap) and searched exactly like the full index.
+    """
+
+    def __init__(self, index_dir, manifest, load_fn, search_fn):
+        self.index_dir = index_dir
+        self.names = sorted(manifest["shards"])
+        self.sizes = {n: manifest["shards"][n]["size"] for n in self.names}
+        self.centroids = _unit([manifest["shards"][n]["centroid"] for n in self.names])
+        self.higher_is_better = manifest.get("metric") == "ip"
+        self._load_fn = load_fn
+        self._search_fn = search_fn
+        self._shards = {}
+        self._owner = {}  # docstore id -> shard name, for the loaded shards
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, index_dir, load_fn, search_fn):
+        """None when index_dir has no shards."""
+        path = os.path.join(index_dir, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if not manifest.get("shards"):
+            return None
+        return cls(index_dir, manifest, load_fn, search_fn)
+
+    @property
+    def ntotal(self):
+        return sum(self.sizes.values())
+
+    def shard(self, name):
+        vs = self._shards.get(name)
+        if vs is not None:
+            return vs
+        with self._lock:
+            if name not in self._shards:
+                vs = self._load_fn(os.path.join(self.index_dir, SHARDS_DIR, name))
+                self._owner.update((doc_id, name) for doc_id in vs.index_to_docstore_id.values())
+                self._shards[name] = vs
+        return self._shards[name]
+
+    def load_all(self):
+        for name in self.names:
+            self.shard(name)
+
+    def select(self, vecs, questions=None, top_n=2):
+        """Shard names to search, per query vector."""
+        if top_n <= 0 or top_n >= len(self.names):
+            return [list(self.names) for _ in range(len(vecs))]
+        sims = _unit(vecs) @ self.centroids.T
+        out = []
+        for i, row in enumerate(sims):
+            chosen = [self.names[j] for j in np.argsort(-row, kind="stable")[:top_n]]
+            if questions is not None:
+                chosen += [d for d in sorted(question_domains(questions[i])) if d in self.sizes and d not in chosen]
+            out.append(chosen)
+        return out
+
+    def search(self, vecs, k, questions=None, top_n=2):
+        """Per query [(docstore_id, score), ...]: top k over its selected shards."""
+        x = np.asarray(vecs, dtype=np.float32)
+        selected = self.select(x, questions, top_n)
+        by_shard = {}
+        for qi, names in enumerate(selected):
+            for name in names:
+                by_shard.setdefault(name, []).append(qi)
+
+        merged = [[] for _ in range(len(x))]
+        for name, rows in by_shard.items():
+            found = self._search_fn(self.shard(name), x[rows], k)
+            for qi, hits in zip(rows, found):
+                merged[qi].extend(hits)
+        return [
+            sorted(hits, key=lambda h: -h[1] if self.higher_is_better else h[1])[:k]
+            for hits in merged
+        ]
+
+    def document(self, doc_id):
+        name = self._owner.get(doc_id)
+        if name is None:
+            # Retrieval cache hit from a shard not loaded in this process yet.
+            self.load_all()
+            name = self._owner.get(doc_id)
+        return self._shards[name].docstore.search(doc_id) if name else None
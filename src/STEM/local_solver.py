@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local fast path for STEM questions, tried before the chain-of-thought call.
+
+Three kinds of problems are computed here with exact rational arithmetic
+(fractions.Fraction; expressions are parsed by a small recursive-descent
+parser, never eval'd):
+
+- arithmetic expressions:      "Tính 12 + 3 × 4"            -> 24
+- one-variable linear equations: "Giải phương trình 2x + 3 = 7" -> 2
+- single-formula physics / chemistry problems with units (FORMULAS):
+  "Một vật rơi tự do từ độ cao h = 20 m, lấy g = 10 m/s². Thời gian rơi là"
+  with choices "1 s" ... "4 s" -> t = √(2h/g) = 2 s; plain unit conversions
+  ("Đổi 2,5 km ra m") too.
+
+local_solve() returns the letter only when the value matches exactly one
+choice; anything it does not fully understand (a number it did not use, a
+negated question, several possible computations, non-numeric choices) gives
+None and the question goes to the LLM as before. A formula is used only
+when the question names its output quantity ("quãng đường", "thời gian" ...),
+and a physics question with a cue no formula models ("nhanh dần", "giây thứ",
+"trung bình", "ném", "tần số góc" ...) is never computed here.
+
+    python -m src.STEM.local_solver     # check EXAMPLES
+"""
+from __future__ import annotations
+import math
+import re
+import unicodedata
+from decimal import Decimal, localcontext
+from fractions import Fraction
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from src.heuristics import SOLVER_ENGINE, Cues
+
+
+class _Unsolvable(Exception):
+    """The problem is outside what this module can compute exactly."""
+
+
+# ------------------ VALUES ------------------
+_MAX_EXPONENT = 64
+_MAX_BITS = 4096
+
+
+def _check_size(x: Fraction) -> Fraction:
+    if x.numerator.bit_length() > _MAX_BITS or x.denominator.bit_length() > _MAX_BITS:
+        raise _Unsolvable("number too large")
+    return x
+
+
+class _Lin:
+    """
+    a·u + b for the (at most one) unknown u of an equation; a = 0 for plain
+    numbers. `exact` turns False once an irrational square root is involved.
+    """
+
+    __slots__ = ("a", "b", "exact")
+
+    def __init__(self, a: Fraction, b: Fraction, exact: bool = True):
+        self.a = _check_size(a)
+        self.b = _check_size(b)
+        self.exact = exact
+
+    @classmethod
+    def const(cls, x, exact: bool = True) -> "_Lin":
+        return cls(Fraction(0), Fraction(x), exact)
+
+    @property
+    def is_const(self) -> bool:
+        return self.a == 0
+
+    @staticmethod
+    def _lift(x) -> "_Lin":
+        return x if isinstance(x, _Lin) else _Lin.const(x)
+
+    def __neg__(self) -> "_Lin":
+        return _Lin(-self.a, -self.b, self.exact)
+
+    def __add__(self, other) -> "_Lin":
+        other = self._lift(other)
+        return _Lin(self.a + other.a, self.b + other.b, self.exact and other.exact)
+
+    __radd__ = __add__
+
+    def __sub__(self, other) -> "_Lin":
+        return self + -self._lift(other)
+
+    def __rsub__(self, other) -> "_Lin":
+        return self._lift(other) - self
+
+    def __mul__(self, other) -> "_Lin":
+        other = self._lift(other)
+        if not self.is_const and not other.is_const:
+            raise _Unsolvable("not linear")
+        return _Lin(
+            self.a * other.b + other.a * self.b,
+            self.b * other.b,
+            self.exact and other.exact,
+        )
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other) -> "_Lin":
+        other = self._lift(other)
+        if not other.is_const or other.b == 0:
+            raise _Unsolvable("division by an unknown or by zero")
+        return _Lin(self.a / other.b, self.b / other.b, self.exact and other.exact)
+
+    def __rtruediv__(self, other) -> "_Lin":
+        return self._lift(other) / self
+
+    def __pow__(self, other) -> "_Lin":
+        other = self._lift(other)
+        if not other.is_const:
+            raise _Unsolvable("unknown exponent")
+        e = other.b
+        if e == Fraction(1, 2):
+            return _sqrt(self)
+        if e.denominator != 1 or abs(e) > _MAX_EXPONENT:
+            raise _Unsolvable("unsupported exponent")
+        if not self.is_const:
+            if e == 1:
+                return self
+            raise _Unsolvable("not linear")
+        if self.b == 0 and e < 0:
+            raise _Unsolvable("division by zero")
+        return _Lin.const(self.b ** int(e), self.exact and other.exact)
+
+
+def _exact_root(n: int) -> Optional[int]:
+    r = math.isqrt(n)
+    return r if r * r == n else None
+
+
+def _sqrt(x: "_Lin") -> "_Lin":
+    if not x.is_const or x.b < 0:
+        raise _Unsolvable("square root of an unknown or a negative number")
+    num, den = _exact_root(x.b.numerator), _exact_root(x.b.denominator)
+    if num is not None and den is not None:
+        return _Lin.const(Fraction(num, den), x.exact)
+    with localcontext() as ctx:
+        ctx.prec = 40
+        root = (Decimal(x.b.numerator) / Decimal(x.b.denominator)).sqrt()
+    return _Lin.const(Fraction(root), exact=False)
+
+
+# ------------------ TEXT ------------------
+_SUPERSCRIPTS = str.maketrans({"⁰": "0", "¹": "1", "²": "2", "³": "3", "⁴": "4", "⁵": "5",
+                               "⁶": "6", "⁷": "7", "⁸": "8", "⁹": "9", "⁻": "-"})
+_SUPERSCRIPT_RUN = re.compile(r"[⁻]?[⁰¹²³⁴⁵⁶⁷⁸⁹]+")
+# Vietnamese scientific notation "2,5.10^3": the dot before 10^ multiplies.
+_SCI_DOT = re.compile(r"(?<=\d)\s*[.]\s*(?=10\^)")
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFC", text or "")
+    text = _SUPERSCRIPT_RUN.sub(lambda m: "^" + m.group(0).translate(_SUPERSCRIPTS), text)
+    text = text.replace("−", "-").replace("–", "-")
+    text = re.sub(r"[×·∙]", "*", text).replace("÷", "/")
+    text = text.replace("**", "^")
+    return _SCI_DOT.sub("*", text)
+
+
+_NUMBER = r"\d+(?:[.,]\d+)*"
+
+
+def parse_number(literal: str) -> Tuple[Fraction, int]:
+    """
+    A number as written in Vietnamese or English: "2,5" / "2.5" (decimal),
+    "1.000.000" (thousands). Returns (value, decimals written). A single
+    separator followed by exactly three digits ("1.000", "1,500") is
+    ambiguous and raises _Unsolvable.
+    """
+    parts = re.split(r"[.,]", literal)
+    if len(parts) == 1:
+        return Fraction(int(literal)), 0
+    seps = set(re.findall(r"[.,]", literal))
+    if len(parts) > 2:
+        if seps == {"."} and all(len(p) == 3 for p in parts[1:]):
+            return Fraction(int("".join(parts))), 0
+        raise _Unsolvable(f"ambiguous number {literal!r}")
+    if len(parts[1]) == 3:
+        raise _Unsolvable(f"ambiguous number {literal!r}")
+    return Fraction(f"{parts[0]}.{parts[1]}"), len(parts[1])
+
+
+# ------------------ EXPRESSIONS ------------------
+_TOKEN = re.compile(
+    rf"(?P<num>{_NUMBER})|(?P<sqrt>√|sqrt)|(?P<op>[-+*/:^=%()])"
+    r"|(?P<word>[^\W\d_]+)|(?P<space>\s+)|(?P<other>.)",
+    re.DOTALL,
+)
+_VARIABLE = re.compile(r"[A-Za-z]")
+
+
+class _Tok(NamedTuple):
+    kind: str      # "num" | "sqrt" | "op" | "var"
+    text: str
+    start: int
+
+
+def _math_runs(text: str) -> List[List[_Tok]]:
+    """Maximal stretches of numbers, operators and one-letter variables."""
+    runs: List[List[_Tok]] = []
+    current: List[_Tok] = []
+    for m in _TOKEN.finditer(text):
+        kind, tok = m.lastgroup, m.group()
+        if kind == "space":
+            continue
+        if kind == "word" and _VARIABLE.fullmatch(tok):
+            kind = "var"
+        if kind in {"num", "sqrt", "op", "var"}:
+            current.append(_Tok(kind, tok, m.start()))
+            continue
+        if current:
+            runs.append(current)
+        current = []
+    if current:
+        runs.append(current)
+    return [r for r in (_trim(run) for run in runs) if r]
+
+
+def _trim(run: List[_Tok]) -> List[_Tok]:
+    # "Tính: 3 + 4" / "x = 2," leave stray operators at the edges.
+    while run and run[0].kind == "op" and run[0].text not in "-(":
+        run = run[1:]
+    while run and run[-1].kind == "op" and run[-1].text not in ")%=":
+        run = run[:-1]
+    return run
+
+
+class _Parser:
+    """
+    expr  := term (("+" | "-") term)*
+    term  := unary (("*" | "/" | ":") unary | implicit unary)*
+    unary := ("-" | "+") unary | power
+    power := atom ("^" unary)?
+    atom  := number "%"? | variable | "(" expr ")" | "√" atom | "sqrt" "(" expr ")"
+
+    Implicit multiplication ("3x", "2(x + 1)", "2√3") never joins two
+    numbers. Known variables are substituted; at most one unknown is allowed
+    and stays symbolic (see _Lin).
+    """
+
+    def __init__(self, tokens: Sequence[_Tok], known: Dict[str, _Lin]):
+        self.tokens = list(tokens)
+        self.pos = 0
+        self.known = known
+        self.unknown: Optional[str] = None
+
+    def parse(self) -> _Lin:
+        if not self.tokens:
+            raise _Unsolvable("empty expression")
+        value = self._expr()
+        if self.pos != len(self.tokens):
+            raise _Unsolvable(f"unexpected {self.tokens[self.pos].text!r}")
+        return value
+
+    def _peek(self) -> Optional[_Tok]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _take(self, text: Optional[str] = None) -> _Tok:
+        tok = self._peek()
+        if tok is None or (text is not None and tok.text != text):
+            raise _Unsolvable(f"expected {text or 'a token'}")
+        self.pos += 1
+        return tok
+
+    def _expr(self) -> _Lin:
+        value = self._term()
+        while self._peek() is not None and self._peek().text in "+-":
+            op = self._take().text
+            rhs = self._term()
+            value = value + rhs if op == "+" else value - rhs
+        return value
+
+    def _starts_atom(self, tok: Optional[_Tok]) -> bool:
+        return tok is not None and (tok.kind in {"var", "sqrt"} or tok.text == "(")
+
+    def _term(self) -> _Lin:
+        value = self._unary()
+        while True:
+            tok = self._peek()
+            if tok is not None and tok.text in "*/:":
+                self._take()
+                rhs = self._unary()
+                value = value * rhs if tok.text == "*" else value / rhs
+            elif self._starts_atom(tok):
+                value = value * self._power()
+            else:
+                return value
+
+    def _unary(self) -> _Lin:
+        tok = self._peek()
+        if tok is not None and tok.text in "+-":
+            self._take()
+            value = self._unary()
+            return -value if tok.text == "-" else value
+        return self._power()
+
+    def _power(self) -> _Lin:
+        base = self._atom()
+        if self._peek() is not None and self._peek().text == "^":
+            self._take()
+            return base ** self._unary()
+        return base
+
+    def _atom(self) -> _Lin:
+        tok = self._take()
+        if tok.kind == "num":
+            value = _Lin.const(parse_number(tok.text)[0])
+            if self._peek() is not None and self._peek().text == "%":
+                self._take()
+                value = value / 100
+            return value
+        if tok.kind == "var":
+            if tok.text in self.known:
+                return self.known[tok.text]
+            if self.unknown not in (None, tok.text):
+                raise _Unsolvable("more than one unknown")
+            self.unknown = tok.text
+            return _Lin(Fraction(1), Fraction(0))
+        if tok.kind == "sqrt":
+            if tok.text == "sqrt":
+                self._take("(")
+                inner = self._expr()
+                self._take(")")
+                return _sqrt(inner)
+            return _sqrt(self._atom())
+        if tok.text == "(":
+            value = self._expr()
+            self._take(")")
+            return value
+        raise _Unsolvable(f"unexpected {tok.text!r}")
+
+
+def evaluate(expression: str, known: Optional[Dict[str, _Lin]] = None) -> _Lin:
+    """Exact value of an arithmetic expression (raises _Unsolvable)."""
+    runs = _math_runs(_normalize(expression))
+    if len(runs) != 1:
+        raise _Unsolvable("not a single expression")
+    return _Parser(runs[0], dict(known or {})).parse()
+
+
+def _has_operation(tokens: Sequence[_Tok]) -> bool:
+    return any(t.kind == "sqrt" or (t.kind == "op" and t.text not in "()") for t in tokens)
+
+
+def _split_equals(run: List[_Tok]) -> List[List[_Tok]]:
+    sides: List[List[_Tok]] = [[]]
+    for tok in run:
+        if tok.text == "=":
+            sides.append([])
+        else:
+            sides[-1].append(tok)
+    return sides
+
+
+def _question_value(question: str) -> Optional[_Lin]:
+    """
+    The one quantity the question asks to compute: an expression, an
+    "A = <expression>" line or the root of a linear equation. Assignments
+    ("x = 2") feed later runs. None when there is no or more than one such
+    computation, or when a number is left unused.
+    """
+    known: Dict[str, _Lin] = {}
+    results: List[_Lin] = []
+    for run in _math_runs(_normalize(question)):
+        sides = _split_equals(run)
+        if len(sides) > 2:
+            raise _Unsolvable("chained equalities")
+        left = sides[0]
+        if len(sides) == 1 or not sides[1]:
+            # "3 + 4" or "3 + 4 = ?"
+            if not _has_operation(left):
+                if any(t.kind == "num" for t in left):
+                    raise _Unsolvable("a number outside any computation")
+                continue  # a variable named in the text ("Tìm x biết ...")
+            value = _Parser(left, known).parse()
+            if not value.is_const:
+                raise _Unsolvable("expression with an unknown")
+            results.append(value)
+            continue
+
+        right = sides[1]
+        if len(left) == 1 and left[0].kind == "var" and left[0].text not in known:
+            parser = _Parser(right, known)
+            value = parser.parse()
+            if value.is_const:
+                known[left[0].text] = value
+                if _has_operation(right):
+                    results.append(value)
+                continue
+        # Linear equation in one unknown.
+        parser = _Parser(left, known)
+        lhs = parser.parse()
+        rparser = _Parser(right, known)
+        rparser.unknown = parser.unknown
+        diff = lhs - rparser.parse()
+        if diff.is_const:
+            raise _Unsolvable("equation without an unknown")
+        results.append(_Lin.const(-diff.b / diff.a, diff.exact))
+    return results[0] if len(results) == 1 else None
+
+
+# ------------------ UNITS ------------------
+# Dimension = exponents of (metre, kilogram, second, ampere, mole).
+Dim = Tuple[int, int, int, int, int]
+
+
+def _dim(m: int = 0, kg: int = 0, s: int = 0, a: int = 0, mol: int = 0) -> Dim:
+    return (m, kg, s, a, mol)
+
+
+LENGTH, MASS, TIME, CURRENT, AMOUNT = _dim(m=1), _dim(kg=1), _dim(s=1), _dim(a=1), _dim(mol=1)
+AREA, VOLUME = _dim(m=2), _dim(m=3)
+VELOCITY, ACCELERATION = _dim(m=1, s=-1), _dim(m=1, s=-2)
+FREQUENCY = _dim(s=-1)
+FORCE = _dim(m=1, kg=1, s=-2)
+ENERGY = _dim(m=2, kg=1, s=-2)
+POWER = _dim(m=2, kg=1, s=-3)
+MOMENTUM = _dim(m=1, kg=1, s=-1)
+PRESSURE = _dim(m=-1, kg=1, s=-2)
+DENSITY = _dim(m=-3, kg=1)
+VOLTAGE = _dim(m=2, kg=1, s=-3, a=-1)
+RESISTANCE = _dim(m=2, kg=1, s=-3, a=-2)
+MOLAR_MASS = _dim(kg=1, mol=-1)
+CONCENTRATION = _dim(m=-3, mol=1)
+
+# symbol -> (factor to SI, dimension). Matched case-sensitively, longest first.
+UNITS: Dict[str, Tuple[Fraction, Dim]] = {
+    "mm": (Fraction(1, 1000), LENGTH), "cm": (Fraction(1, 100), LENGTH), "dm": (Fraction(1, 10), LENGTH),
+    "m": (Fraction(1), LENGTH), "km": (Fraction(1000), LENGTH),
+    "mm^2": (Fraction(1, 10**6), AREA), "cm^2": (Fraction(1, 10**4), AREA), "m^2": (Fraction(1), AREA),
+    "cm^3": (Fraction(1, 10**6), VOLUME), "dm^3": (Fraction(1, 1000), VOLUME), "m^3": (Fraction(1), VOLUME),
+    "ml": (Fraction(1, 10**6), VOLUME), "mL": (Fraction(1, 10**6), VOLUME),
+    "l": (Fraction(1, 1000), VOLUME), "L": (Fraction(1, 1000), VOLUME), "lít": (Fraction(1, 1000), VOLUME),
+    "mg": (Fraction(1, 10**6), MASS), "g": (Fraction(1, 1000), MASS), "gam": (Fraction(1, 1000), MASS),
+    "kg": (Fraction(1), MASS), "tấn": (Fraction(1000), MASS),
+    "ms": (Fraction(1, 1000), TIME), "s": (Fraction(1), TIME), "giây": (Fraction(1), TIME),
+    "min": (Fraction(60), TIME), "phút": (Fraction(60), TIME), "h": (Fraction(3600), TIME), "giờ": (Fraction(3600), TIME),
+    "m/s": (Fraction(1), VELOCITY), "km/h": (Fraction(5, 18), VELOCITY), "km/giờ": (Fraction(5, 18), VELOCITY),
+    "m/s^2": (Fraction(1), ACCELERATION),
+    "Hz": (Fraction(1), FREQUENCY), "kHz": (Fraction(1000), FREQUENCY),
+    "N": (Fraction(1), FORCE), "kN": (Fraction(1000), FORCE),
+    "J": (Fraction(1), ENERGY), "kJ": (Fraction(1000), ENERGY),
+    "W": (Fraction(1), POWER), "kW": (Fraction(1000), POWER),
+    "kg.m/s": (Fraction(1), MOMENTUM), "kg*m/s": (Fraction(1), MOMENTUM),
+    "Pa": (Fraction(1), PRESSURE), "kPa": (Fraction(1000), PRESSURE), "N/m^2": (Fraction(1), PRESSURE),
+    "kg/m^3": (Fraction(1), DENSITY), "g/cm^3": (Fraction(1000), DENSITY), "g/ml": (Fraction(1000), DENSITY),
+    "A": (Fraction(1), CURRENT), "mA": (Fraction(1, 1000), CURRENT),
+    "V": (Fraction(1), VOLTAGE), "mV": (Fraction(1, 1000), VOLTAGE), "kV": (Fraction(1000), VOLTAGE),
+    "Ω": (Fraction(1), RESISTANCE), "ohm": (Fraction(1), RESISTANCE), "kΩ": (Fraction(1000), RESISTANCE),
+    "mol": (Fraction(1), AMOUNT), "mmol": (Fraction(1, 1000), AMOUNT),
+    "g/mol": (Fraction(1, 1000), MOLAR_MASS),
+    "M": (Fraction(1000), CONCENTRATION), "mol/l": (Fraction(1000), CONCENTRATION), "mol/L": (Fraction(1000), CONCENTRATION),
+}
+
+_UNIT_ALT = "|".join(re.escape(u) for u in sorted(UNITS, key=len, reverse=True))
+_QUANTITY = re.compile(
+    rf"(?<![\w.,^])(?P<num>{_NUMBER})(?:\s*\*\s*10\^\s*(?P<exp>-?\d+))?\s*(?P<unit>{_UNIT_ALT})(?![\w/^])"
+)
+# "lấy g = 10" without a unit.
+_GRAVITY = re.compile(rf"(?<![\w])g\s*=\s*(?P<num>{_NUMBER})(?!\d|[.,]\d)(?!\s*(?:{_UNIT_ALT})(?![\w/^]))")
+_ANY_NUMBER = re.compile(rf"(?<![\w.,^]){_NUMBER}")
+
+
+class Quantity(NamedTuple):
+    value: _Lin        # SI
+    dim: Dim
+    tolerance: Fraction  # SI; half a unit of the last digit written (0 = exact)
+
+
+def _quantity(m: "re.Match") -> Quantity:
+    value, decimals = parse_number(m.group("num"))
+    scale = Fraction(10) ** int(m.group("exp") or 0)
+    if abs(int(m.group("exp") or 0)) > _MAX_EXPONENT:
+        raise _Unsolvable("unsupported exponent")
+    factor, dim = UNITS[m.group("unit")]
+    tol = Fraction(1, 2 * 10**decimals) * scale * factor if decimals else Fraction(0)
+    return Quantity(_Lin.const(value * scale * factor), dim, tol)
+
+
+def _quantities(text: str) -> List[Quantity]:
+    """Every measured quantity in the question; raises if a number is left over."""
+    found: List[Quantity] = []
+    covered: List[Tuple[int, int]] = []
+    for m in _QUANTITY.finditer(text):
+        found.append(_quantity(m))
+        covered.append(m.span())
+    for m in _GRAVITY.finditer(text):
+        found.append(Quantity(_Lin.const(parse_number(m.group("num"))[0]), ACCELERATION, Fraction(0)))
+        covered.append(m.span())
+    for m in _ANY_NUMBER.finditer(text):
+        if not any(s <= m.start() < e for s, e in covered):
+            raise _Unsolvable(f"number {m.group()!r} without a unit")
+    return found
+
+
+# ------------------ FORMULAS ------------------
+class Formula(NamedTuple):
+    name: str
+    output: Dim
+    inputs: Tuple[Dim, ...]   # distinct dimensions, in the order fn takes them
+    fn: Callable[..., _Lin]
+    cues: Tuple[str, ...]     # SOLVER_RULES kinds the question must all match
+
+
+# Units alone do not say what is asked ("quãng đường trong giây thứ tư" is a
+# length too), so every formula needs a cue naming its output quantity, and
+# the free-fall ones a free-fall cue.
+FORMULAS: List[Formula] = [
+    # Uniform motion
+    Formula("s = v·t", LENGTH, (VELOCITY, TIME), lambda v, t: v * t, ("asks.length",)),
+    Formula("v = s/t", VELOCITY, (LENGTH, TIME), lambda s, t: s / t, ("asks.velocity",)),
+    Formula("t = s/v", TIME, (LENGTH, VELOCITY), lambda s, v: s / v, ("asks.time",)),
+    # Free fall
+    Formula("h = g·t²/2", LENGTH, (ACCELERATION, TIME), lambda g, t: g * t ** 2 / 2, ("free_fall", "asks.length")),
+    Formula("t = √(2h/g)", TIME, (LENGTH, ACCELERATION), lambda h, g: _sqrt(2 * h / g), ("free_fall", "asks.time")),
+    Formula("v = √(2gh)", VELOCITY, (LENGTH, ACCELERATION), lambda h, g: _sqrt(2 * g * h), ("free_fall", "asks.velocity")),
+    Formula("v = g·t", VELOCITY, (ACCELERATION, TIME), lambda g, t: g * t, ("free_fall", "asks.velocity")),
+    # Dynamics
+    Formula("F = m·a", FORCE, (MASS, ACCELERATION), lambda m, a: m * a, ("asks.force",)),
+    Formula("a = F/m", ACCELERATION, (FORCE, MASS), lambda f, m: f / m, ("asks.acceleration",)),
+    Formula("m = F/a", MASS, (FORCE, ACCELERATION), lambda f, a: f / a, ("asks.mass",)),
+    Formula("p = m·v", MOMENTUM, (MASS, VELOCITY), lambda m, v: m * v, ("asks.momentum",)),
+    Formula("Wđ = m·v²/2", ENERGY, (MASS, VELOCITY), lambda m, v: m * v ** 2 / 2, ("asks.kinetic_energy",)),
+    Formula("Wt = m·g·h", ENERGY, (MASS, ACCELERATION, LENGTH), lambda m, g, h: m * g * h, ("asks.potential_energy",)),
+    Formula("A = F·s", ENERGY, (FORCE, LENGTH), lambda f, s: f * s, ("asks.work",)),
+    Formula("P = A/t", POWER, (ENERGY, TIME), lambda a, t: a / t, ("asks.power",)),
+    Formula("A = P·t", ENERGY, (POWER, TIME), lambda p, t: p * t, ("asks.work",)),
+    Formula("p = F/S", PRESSURE, (FORCE, AREA), lambda f, s: f / s, ("asks.pressure",)),
+    Formula("D = m/V", DENSITY, (MASS, VOLUME), lambda m, v: m / v, ("asks.density",)),
+    Formula("m = D·V", MASS, (DENSITY, VOLUME), lambda d, v: d * v, ("asks.mass",)),
+    Formula("f = 1/T", FREQUENCY, (TIME,), lambda t: 1 / t, ("asks.frequency",)),
+    Formula("T = 1/f", TIME, (FREQUENCY,), lambda f: 1 / f, ("asks.time",)),
+    # Electricity
+    Formula("U = I·R", VOLTAGE, (CURRENT, RESISTANCE), lambda i, r: i * r, ("asks.voltage",)),
+    Formula("I = U/R", CURRENT, (VOLTAGE, RESISTANCE), lambda u, r: u / r, ("asks.current",)),
+    Formula("R = U/I", RESISTANCE, (VOLTAGE, CURRENT), lambda u, i: u / i, ("asks.resistance",)),
+    Formula("P = U·I", POWER, (VOLTAGE, CURRENT), lambda u, i: u * i, ("asks.power",)),
+    Formula("P = U²/R", POWER, (VOLTAGE, RESISTANCE), lambda u, r: u ** 2 / r, ("asks.power",)),
+    Formula("P = I²·R", POWER, (CURRENT, RESISTANCE), lambda i, r: i ** 2 * r, ("asks.power",)),
+    # Chemistry
+    Formula("n = m/M", AMOUNT, (MASS, MOLAR_MASS), lambda m, mm: m / mm, ("asks.amount",)),
+    Formula("m = n·M", MASS, (AMOUNT, MOLAR_MASS), lambda n, mm: n * mm, ("asks.mass",)),
+    Formula("C = n/V", CONCENTRATION, (AMOUNT, VOLUME), lambda n, v: n / v, ("asks.concentration",)),
+    Formula("n = C·V", AMOUNT, (CONCENTRATION, VOLUME), lambda c, v: c * v, ("asks.amount",)),
+]
+
+
+def _physics_value(question: str, target: Dim, cues: Cues) -> Optional[_Lin]:
+    """
+    The value (SI) of the `target` dimension computed from the question's
+    quantities by a formula that uses every one of them and whose cues the
+    question matches. A question with a single quantity of the target
+    dimension is a unit conversion when it says so ("đổi ...").
+    """
+    quantities = _quantities(question)
+    if not quantities:
+        return None
+    by_dim: Dict[Dim, Quantity] = {}
+    for q in quantities:
+        if q.dim in by_dim:
+            raise _Unsolvable("two quantities of the same dimension")
+        by_dim[q.dim] = q
+
+    if cues.has("conversion") and len(quantities) == 1 and quantities[0].dim == target:
+        return quantities[0].value
+    if cues.has("unmodelled"):
+        return None
+
+    values: List[_Lin] = []
+    for formula in FORMULAS:
+        if formula.output != target or sorted(formula.inputs) != sorted(by_dim):
+            continue
+        if all(cues.has(kind) for kind in formula.cues):
+            values.append(formula.fn(*(by_dim[d].value for d in formula.inputs)))
+    distinct = {(v.b, v.exact) for v in values}
+    return values[0] if len(distinct) == 1 else None
+
+
+# ------------------ CHOICES ------------------
+_CHOICE_PREFIX = re.compile(r"^\s*(?:[A-Za-z]\s*=)\s*")
+
+
+class _Choice(NamedTuple):
+    value: _Lin
+    tolerance: Fraction
+    dim: Optional[Dim]
+
+
+def _parse_choice(text: str) -> _Choice:
+    text = _CHOICE_PREFIX.sub("", _normalize(str(text)).strip()).rstrip(" .")
+    m = _QUANTITY.fullmatch(text)
+    if m:
+        q = _quantity(m)
+        return _Choice(q.value, q.tolerance, q.dim)
+    value = evaluate(text)
+    if not value.is_const:
+        raise _Unsolvable("choice with an unknown")
+    tol = Fraction(0)
+    if re.fullmatch(rf"-?\s*{_NUMBER}", text):
+        decimals = parse_number(text.lstrip("- "))[1]
+        tol = Fraction(1, 2 * 10**decimals) if decimals else Fraction(0)
+    return _Choice(value, tol, None)
+
+
+def _matches(value: _Lin, choice: _Choice) -> bool:
+    diff = abs(value.b - choice.value.b)
+    if value.exact and choice.value.exact and diff == 0:
+        return True
+    tol = choice.tolerance
+    if not (value.exact and choice.value.exact):
+        # An irrational value compared with a rounded or irrational choice.
+        tol = max(tol, abs(choice.value.b) * Fraction(1, 10**9))
+    return diff <= tol and tol > 0
+
+
+# ------------------ SOLVER ------------------
+def local_solve(question: str, choices: Sequence) -> Optional[str]:
+    """
+    The letter of the only choice equal to the value computed from the
+    question, or None when the question should go to the LLM.
+    """
+    if not choices or not question:
+        return None
+    cues = SOLVER_ENGINE.scan(question)
+    if cues.has("negation"):
+        return None
+    try:
+        parsed = [_parse_choice(c) for c in choices]
+        dims = {c.dim for c in parsed}
+        if len(dims) != 1:
+            return None
+        target = dims.pop()
+        text = _normalize(question)
+        if target is None:
+            value = _question_value(text)
+        else:
+            value = _physics_value(text, target, cues)
+    except (_Unsolvable, ValueError, ZeroDivisionError, OverflowError):
+        return None
+    if value is None:
+        return None
+
+    hits = [i for i, c in enumerate(parsed) if _matches(value, c)]
+    return chr(ord("A") + hits[0]) if len(hits) == 1 else None
+
+
+# ------------------ EXAMPLES ------------------
+# (question, choices, expected letter or None). Regressions go here.
+EXAMPLES: List[Tuple[str, List[str], Optional[str]]] = [
+    ("Tính giá trị biểu thức (2 + 3)^2 : 5 - 1/2", ["4,5", "5", "9/2", "25"], None),  # A and C equal
+    ("Giải phương trình 2x + 3 = 7", ["1", "2", "3", "4"], "B"),
+    ("Một vật rơi tự do từ độ cao h = 20 m, lấy g = 10 m/s². Thời gian rơi của vật là:",
+     ["1 s", "2 s", "3 s", "4 s"], "B"),
+    ("Một xe chuyển động thẳng đều với vận tốc 36 km/h trong 10 s. Quãng đường xe đi được là",
+     ["10 m", "36 m", "100 m", "360 m"], "C"),
+    ("Đổi 2,5 km ra m", ["25 m", "250 m", "2500 m", "25000 m"], "C"),
+    # Accelerated from rest: s = v·t/2, not v·t.
+    ("Một đoàn tàu bắt đầu chuyển động nhanh dần đều, sau 10 s đạt vận tốc 20 m/s. "
+     "Quãng đường tàu đi được là", ["100 m", "200 m", "20 m", "2 m"], None),
+    # Braking to rest: s = v·t/2, not v·t.
+    ("Một ô tô chạy với vận tốc 72 km/h, hãm phanh sau 4 s thì dừng. Quãng đường hãm phanh là",
+     ["40 m", "80 m", "20 m", "288 m"], None),
+    # ω = 2π/T, not 1/T.
+    ("Một vật dao động điều hòa với chu kì 0,5 s. Tần số góc của vật là",
+     ["2 Hz", "4 Hz", "0,5 Hz", "1 Hz"], None),
+    ("Một vật dao động điều hòa với chu kì 0,5 s. Tần số dao động của vật là",
+     ["2 Hz", "4 Hz", "0,5 Hz", "1 Hz"], "A"),
+    # Distance in one second of the fall (35 m), not over the whole fall (80 m).
+    ("Một vật rơi tự do trong 4 s, g = 10 m/s². Quãng đường vật rơi trong giây thứ tư là",
+     ["80 m", "35 m", "45 m", "20 m"], None),
+    ("Một vật rơi tự do trong 3 s, g = 10 m/s². Quãng đường vật rơi trong giây cuối cùng là",
+     ["45 m", "25 m", "15 m", "5 m"], None),
+    # Average speed (10 m/s), not the final speed √(2gh) = 20 m/s.
+    ("Một vật rơi tự do từ độ cao 20 m, g = 10 m/s². Vận tốc trung bình của vật trong quá trình rơi là",
+     ["20 m/s", "10 m/s", "5 m/s", "40 m/s"], None),
+    ("Một vật được ném thẳng đứng lên cao với vận tốc 20 m/s, g = 10 m/s². Độ cao cực đại là",
+     ["20 m", "40 m", "10 m", "80 m"], None),
+    # No asked quantity named: units alone do not pick a formula.
+    ("Cho v = 10 m/s và t = 5 s. Kết quả là", ["50 m", "2 m", "15 m", "5 m"], None),
+    ("Một vật có khối lượng 2 kg chịu tác dụng của gia tốc 3 m/s². Lực tác dụng lên vật là",
+     ["6 N", "5 N", "1,5 N", "0,67 N"], "A"),
+]
+
+
+if __name__ == "__main__":
+    import sys
+
+    failed = 0
+    for question, choices, expected in EXAMPLES:
+        got = local_solve(question, choices)
+        if got != expected:
+            failed += 1
+            print(f"FAIL {question[:60]!r}: got {got}, expected {expected}")
+    print(f"{len(EXAMPLES) - failed}/{len(EXAMPLES)} examples ok")
+    sys.exit(1 if failed else 0)
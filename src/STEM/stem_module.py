@@ -2,11 +2,25 @@ import json
 import re
 import time
 import csv
-import requests
 import os
+import threading
 # from dotenv import load_dotenv
 from tqdm import tqdm
 
+from src.profiling import profile_stage
+from src.STEM.local_solver import local_solve
+from src.vnpt_client import (
+    LEDGER,
+    STREAM_COMPLETIONS,
+    CircuitOpenError,
+    QuotaExceededError,
+    breaker_for,
+    http_post,
+    record_result,
+    singleflight,
+    stream_chat_completion,
+)
+
 # =====================
 # LOAD ENV
 # =====================
@@ -21,6 +35,13 @@ HEADERS_SMALL = {
 }
 WAIT_TIME_ON_QUOTA = 60 * 60
 MODEL_NAME = "vnptai_hackathon_small"
+# Read at call time, so sweep.py can override them.
+STEM_MAX_TOKENS = 2048
+# Try src/STEM/local_solver.py before the chain-of-thought call.
+STEM_LOCAL_SOLVER = True
+# Questions answered by the local solver in this process (worker threads).
+LOCAL_SOLVED = 0
+_LOCAL_SOLVED_LOCK = threading.Lock()
 
 # =====================
 # FILE CONFIG
@@ -95,28 +116,58 @@ SUY LUẬN:
 # =====================
 # API CALL
 # =====================
+# Streaming mode hangs up once the final answer line is complete (the letter
+# must be followed by another character so "### ANSWER: B" isn't cut mid-token).
+ANSWER_STOP_PAT = re.compile(r"### ANSWER:\s*[A-Z](?=\W)", re.IGNORECASE)
+
+
+@singleflight
 def query_llm(prompt):
     payload = {
         "model": MODEL_NAME,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.0,
-        "max_completion_tokens": 2048,
+        "max_completion_tokens": STEM_MAX_TOKENS,
     }
 
-    r = requests.post(
-        API_URL_SMALL,
-        headers=HEADERS_SMALL,
-        json=payload,
-        timeout=300
-    )
+    # Known-throttled quota: hand the question back to the scheduler untouched.
+    if LEDGER.is_throttled("small"):
+        raise QuotaExceededError("RATE_LIMIT_REACHED")
+
+    # STEM has no model to fail over to: while the small breaker is open we
+    # short-circuit so solve_stem answers locally instead of waiting on timeouts.
+    if not breaker_for("small").allow_request():
+        raise CircuitOpenError("CIRCUIT_OPEN: small")
 
-    if r.status_code in (429, 403):
-        raise RuntimeError("RATE_LIMIT_REACHED")
+    try:
+        if STREAM_COMPLETIONS:
+            status, content, _ = stream_chat_completion(
+                API_URL_SMALL, HEADERS_SMALL, payload,
+                stop_pattern=ANSWER_STOP_PAT, timeout=300,
+            )
+        else:
+            r = http_post(
+                API_URL_SMALL,
+                headers=HEADERS_SMALL,
+                json=payload,
+                timeout=300
+            )
+            status, content = r.status_code, r.text
+    except Exception:
+        record_result("small", None)
+        raise
+    record_result("small", status)
 
-    if r.status_code == 200:
-        return r.json()["choices"][0]["message"]["content"]
+    # Only a rate limit is worth rescheduling; an auth 403 fails the same way
+    # on every retry, so it is an ordinary "API Error 403" unless the ledger
+    # says otherwise.
+    if status == 429 or (status == 403 and LEDGER.is_throttled("small")):
+        raise QuotaExceededError("RATE_LIMIT_REACHED")
 
-    raise RuntimeError(f"API Error {r.status_code}: {r.text}")
+    if status == 200:
+        return content if STREAM_COMPLETIONS else r.json()["choices"][0]["message"]["content"]
+
+    raise RuntimeError(f"API Error {status}: {content}")
 
 
 # =====================
@@ -228,9 +279,11 @@ def run_stem_worker(input_file: str):
             i += 1
 
         except RuntimeError as e:
-            if "Rate limit exceed" in str(e):
-                print("Rate limit reached. Sleeping 61 minutes...")
-                time.sleep(WAIT_TIME_ON_QUOTA)
+            if isinstance(e, QuotaExceededError):
+                # Sleep only until the ledger expects the quota back, not a blind hour.
+                wait = min(WAIT_TIME_ON_QUOTA, max(1.0, LEDGER.available_in("small")))
+                print(f"Rate limit reached. Sleeping {wait:.0f}s...")
+                time.sleep(wait)
                 print("Resume working...")
             else:
                 print(f"[ERROR] {qid}: {e}")
@@ -245,11 +298,25 @@ def solve_stem(question: str, choices: list) -> str:
     """
     Solve ONE STEM question.
     Return: "A" | "B" | "C" | "D"
-    - Docker-safe: không để crash predict.py nếu gặp RATE_LIMIT/HTTP lỗi
+    - Bài tính được chính xác tại chỗ (local_solver) trả lời luôn, không gọi LLM
+    - Docker-safe: không để crash predict.py nếu gặp HTTP lỗi
+    - RATE_LIMIT được ném ra (QuotaExceededError) để predict.py xếp lịch lại câu hỏi
     """
+    global LOCAL_SOLVED
+    if STEM_LOCAL_SOLVER:
+        with profile_stage("stem_local"):
+            local = local_solve(question, choices)
+        if local is not None:
+            with _LOCAL_SOLVED_LOCK:
+                LOCAL_SOLVED += 1
+            return local
+
     prompt = build_cot_prompt(question, choices)
     try:
         raw = query_llm(prompt)
+    except QuotaExceededError:
+        # let the scheduler retry it later / on another model's turn
+        raise
     except Exception:
         # fallback an toàn để pipeline không sập
         return "A"
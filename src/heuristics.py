@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled route cues: every rule is matched in one pass over a question and
+its choices, whatever the number of rules.
+
+Rule phrases are written folded (lowercase, no Vietnamese diacritics, đ -> d)
+and match every casing / accenting of themselves, so "doan thong tin" finds
+"Đoạn thông tin", "ĐOẠN THÔNG TIN" and "doan thong tin"; a space matches any
+run of whitespace. All phrases are compiled into one prefix-trie regex (each
+folded letter becomes a class of its accented forms) and found in a single
+scan over "question <sep> choice A <sep> choice B ..."; the text itself is
+never copied letter by letter. The few regex rules are searched per segment
+and keep diacritics (case-insensitive only): use one when a folded phrase
+would collide with another word ("đoán thông tin", "Sài Gòn").
+scan() returns every rule that matches, with where it matched.
+
+    cues = ENGINE.scan(question, choices)
+    cues.route()               # fast-path route ("RAG") or None
+    cues.has("stem")           # any rule of that kind matched
+    cues.choices("refusal")    # indices of choices matched by that kind
+"""
+from __future__ import annotations
+import re
+import unicodedata
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+# ------------------ FOLDING ------------------
+_SEP = "\x00"  # between question and choices (not whitespace, not a word character)
+
+
+def _letter_classes() -> Dict[str, str]:
+    """Folded letter -> regex class of every Latin letter folding to it."""
+    variants: Dict[str, Set[str]] = {}
+    for cp in list(range(0x41, 0x5B)) + list(range(0x61, 0x7B)) + list(range(0xC0, 0x250)) + list(range(0x1E00, 0x1F00)):
+        ch = chr(cp)
+        base = "".join(c for c in unicodedata.normalize("NFD", ch) if not unicodedata.combining(c)).casefold()
+        if len(base) == 1 and "a" <= base <= "z":
+            variants.setdefault(base, set()).add(ch)
+    variants["d"] |= {"đ", "Đ"}
+    return {b: "[" + "".join(sorted(v)) + "]" for b, v in variants.items()}
+
+
+_LETTER_CLASSES = _letter_classes()
+
+
+def _phrase_regex(ch: str) -> str:
+    if ch == " ":
+        return r"\s+"
+    return _LETTER_CLASSES.get(ch, re.escape(ch))
+
+
+# ------------------ RULES ------------------
+class Rule(NamedTuple):
+    name: str
+    kind: str                     # "passage" | "refusal" | "stem" | ...
+    pattern: str                  # folded phrase, or a regex (case-insensitive, not folded) if regex=True
+    target: str = "question"      # "question" | "choice" | "any"
+    regex: bool = False
+    start: bool = False           # only at the start of the question / a choice
+    route: Optional[str] = None   # route taken without the LLM when this rule matches
+
+
+ROUTE_RULES: List[Rule] = [
+    # Passage / table / data included in the question -> RAG (no LLM call).
+    # Accents kept: folded, "Hãy đoán thông tin sau" ("guess") would match.
+    Rule("passage.doan_thong_tin", "passage", r"\bđoạn\s+thông\s+tin\b", regex=True, route="RAG"),
+
+    # Refusal phrasings at the start of a choice (PC fallback answer).
+    Rule("refusal.toi_khong_the", "refusal", "toi khong the", target="choice", start=True),
+    Rule("refusal.toi_khong_duoc_phep", "refusal", "toi khong duoc phep", target="choice", start=True),
+    Rule("refusal.xin_loi_comma", "refusal", "xin loi,", target="choice", start=True),
+    Rule("refusal.xin_loi_space", "refusal", "xin loi ", target="choice", start=True),
+    Rule("refusal.khong_the_cung_cap", "refusal", "khong the cung cap", target="choice", start=True),
+
+    # Math / formula signals (STEM).
+    # (Regex rules start with a character class so the search can skip ahead.)
+    Rule("stem.arithmetic", "stem", r"\d\s*[+*/^=<>×÷]\s*\d", regex=True),  # not "-": year ranges
+    Rule("stem.power_or_root", "stem", r"[\^√]", regex=True),
+    Rule("stem.function", "stem", r"\(\s*x\s*\)", regex=True),
+    Rule("stem.unit", "stem", r"\d\s*(?:cm|mm|km|kg|mol|ml|m/s|m\^?2|m\^?3|°c)(?!\w)", regex=True),
+    Rule("stem.tinh_gia_tri", "stem", "tinh gia tri"),
+    Rule("stem.phuong_trinh", "stem", "phuong trinh"),
+    Rule("stem.bat_phuong_trinh", "stem", "bat phuong trinh"),
+    Rule("stem.dao_ham", "stem", "dao ham"),
+    Rule("stem.tich_phan", "stem", "tich phan"),
+    Rule("stem.xac_suat", "stem", "xac suat"),
+    Rule("stem.nong_do", "stem", "nong do"),
+    Rule("stem.van_toc", "stem", "van toc"),
+    Rule("stem.gia_toc", "stem", "gia toc"),
+    Rule("stem.dien_tro", "stem", "dien tro"),
+    Rule("stem.khoi_luong_mol", "stem", "khoi luong mol"),
+]
+
+
+# Knowledge domains (Reasoning index shards, src/Reasoning/shards.py). Matched
+# anywhere in a document / question; the kind is the domain name.
+DOMAIN_RULES: List[Rule] = [
+    Rule(f"{kind}.{phrase.replace(' ', '_')}", kind, phrase, target="any")
+    for kind, phrases in [
+        ("law", [
+            "luat", "phap luat", "bo luat", "hien phap", "nghi dinh", "thong tu", "nghi quyet",
+            "quoc hoi", "chinh phu", "toa an", "vien kiem sat", "uy ban nhan dan", "co quan nha nuoc",
+            "can bo", "cong chuc", "xu phat", "vi pham hanh chinh", "thu tuc hanh chinh", "hop dong",
+            "quyen va nghia vu", "nghia vu quan su",
+        ]),
+        ("history", [
+            "lich su", "trieu dai", "nha nguyen", "nha tran", "nha ly", "nha ho", "nha mac",
+            "khoi nghia", "khang chien", "chien dich", "chien thang", "hiep dinh", "cach mang",
+            "phong kien", "thuc dan", "de quoc", "the chien", "tran danh",
+        ]),
+        ("geography", [
+            "dia ly", "dia hinh", "khi hau", "dong bang", "cao nguyen", "trung du", "mien nui",
+            "luu vuc", "dan so", "mat do dan so", "lanh tho", "tai nguyen", "khoang san",
+            "vung kinh te", "duyen hai", "thoi tiet", "gio mua",
+        ]),
+        ("culture", [
+            "van hoa", "le hoi", "phong tuc", "tin nguong", "ton giao", "am thuc", "nghe thuat",
+            "di san", "van hoc", "tac pham", "tac gia", "nha tho", "ca dao", "tuc ngu", "am nhac",
+            "dan toc thieu so", "trang phuc", "kien truc",
+        ]),
+    ]
+    for phrase in phrases
+]
+
+
+# Question cues for the local STEM solver (src/STEM/local_solver.py): a
+# negated question is left to the LLM; a conversion cue lets a single
+# quantity be answered in other units; an "unmodelled" cue (varying motion,
+# one second of a fall, averages, throws, angular quantities ...) means no
+# FORMULAS entry models the question, however well its units fit. The
+# "asks.*" kinds name the quantity a formula computes: a formula is only
+# used when the question mentions it.
+SOLVER_RULES: List[Rule] = [
+    Rule(f"{kind}.{phrase.replace(' ', '_')}", kind, phrase)
+    for kind, phrases in [
+        ("negation", [
+            "khong dung", "khong phai", "khong bang", "khong chinh xac", "ngoai tru",
+        ]),
+        ("conversion", ["doi ra", "doi sang", "doi thanh", "chuyen doi", "bang bao nhieu"]),
+        ("unmodelled", [
+            "nhanh dan", "cham dan", "bien doi deu", "tang toc", "giam toc", "ham phanh",
+            "dung lai", "thi dung", "van toc dau", "tan so goc", "van toc goc", "toc do goc",
+            "giay thu", "giay cuoi", "cuoi cung", "trung binh", "sau khi",
+        ]),
+        ("free_fall", ["roi tu do", "tha roi", "buong roi"]),
+        ("asks.length", ["quang duong", "do cao", "chieu cao", "chieu dai", "do dai", "khoang cach"]),
+        ("asks.time", ["thoi gian", "bao lau", "chu ki", "chu ky"]),
+        ("asks.velocity", ["van toc", "toc do"]),
+        ("asks.acceleration", ["gia toc"]),
+        ("asks.mass", ["khoi luong"]),
+        ("asks.momentum", ["dong luong"]),
+        ("asks.kinetic_energy", ["dong nang"]),
+        ("asks.potential_energy", ["the nang"]),
+        ("asks.work", ["cong", "dien nang", "nang luong"]),
+        ("asks.power", ["cong suat"]),
+        ("asks.pressure", ["ap suat"]),
+        ("asks.density", ["khoi luong rieng"]),
+        ("asks.frequency", ["tan so"]),
+        ("asks.current", ["cuong do dong dien", "cuong do"]),
+        ("asks.voltage", ["hieu dien the", "dien ap"]),
+        ("asks.resistance", ["dien tro"]),
+        ("asks.amount", ["so mol"]),
+        ("asks.concentration", ["nong do"]),
+    ]
+    for phrase in phrases
+] + [
+    # "Đổi 2,5 km ra m". Folded, "Đối với ..." matches too; harmless, since
+    # the conversion still needs one quantity already in the asked dimension.
+    Rule("conversion.doi_start", "conversion", "doi ", start=True),
+    # Accents kept: folded, "Sài Gòn" would read as "sai", "lực" as "lúc" and
+    # "nêm" as "ném".
+    Rule("negation.sai", "negation", r"\bsai\b", regex=True),
+    Rule("unmodelled.luc", "unmodelled", r"\blúc\b", regex=True),
+    Rule("unmodelled.nem", "unmodelled", r"\bném\b", regex=True),
+    Rule("asks.force.luc", "asks.force", r"\blực\b", regex=True),
+]
+
+
+# ------------------ MATCHES ------------------
+class Cues(dict):
+    """rule name -> sorted segment indices (0 = question, i + 1 = choice i)."""
+
+    def __init__(self, matches: Dict[str, Set[int]], rules: Dict[str, Rule]):
+        super().__init__((name, sorted(segs)) for name, segs in matches.items())
+        self._rules = rules
+
+    def rules(self, kind: Optional[str] = None) -> List[Rule]:
+        return [self._rules[n] for n in self if kind is None or self._rules[n].kind == kind]
+
+    def has(self, kind: str) -> bool:
+        return any(self._rules[n].kind == kind for n in self)
+
+    def choices(self, kind: str) -> List[int]:
+        return sorted({s - 1 for n, segs in self.items() if self._rules[n].kind == kind for s in segs if s > 0})
+
+    def route(self) -> Optional[str]:
+        # First matching routed rule in rule order.
+        for rule in self._rules.values():
+            if rule.route and rule.name in self:
+                return rule.route
+        return None
+
+
+# ------------------ ENGINE ------------------
+_WORD = re.compile(r"\w")
+
+
+def _is_word(ch: str) -> bool:
+    return bool(_WORD.match(ch))
+
+
+class _TrieRegex:
+    """
+    One regex for all literal phrases, factored by common prefix so the scan
+    costs the same for 5 or 500 phrases. Every phrase ends in its own empty
+    group; match.lastindex tells which phrase matched (the longest one at
+    that position).
+    """
+
+    def __init__(self, rules: Sequence[Rule]):
+        self.group_rule: Dict[int, Rule] = {}
+        trie: dict = {}
+        for rule in rules:
+            node = trie
+            for ch in rule.pattern:
+                node = node.setdefault(ch, {})
+            node.setdefault("", rule)
+        self.pattern = re.compile(self._emit_root(trie)) if rules else None
+
+    def _emit_root(self, trie: dict) -> str:
+        # One class for every first letter, then lookbehinds to pick the
+        # branch: a pattern starting with a class lets re skip ahead to
+        # candidate positions instead of trying every branch at every one.
+        firsts = "".join(_phrase_regex(ch).strip("[]") if ch in _LETTER_CLASSES else re.escape(ch) for ch in trie)
+        alts = [f"(?<={_phrase_regex(ch)})" + self._emit(child) for ch, child in sorted(trie.items())]
+        return f"[{firsts}]" + (alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")")
+
+    def _emit(self, node: dict) -> str:
+        alts = [_phrase_regex(ch) + self._emit(child) for ch, child in sorted(node.items()) if ch]
+        rule = node.get("")
+        if rule is not None:  # the phrase ending here is tried after longer ones
+            self.group_rule[len(self.group_rule) + 1] = rule
+            alts.append((r"\b" if _is_word(rule.pattern[-1]) else "") + "()")
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+
+
+class HeuristicEngine:
+    """
+    Literal rules are matched together in one pass (_TrieRegex); regex rules
+    are matched one by one per segment, so keep those few and put the long
+    tail of cues in literals.
+    """
+
+    def __init__(self, rules: Sequence[Rule]):
+        names = [r.name for r in rules]
+        if len(set(names)) != len(names):
+            raise ValueError("duplicate rule names")
+        if not all(r.pattern for r in rules):
+            raise ValueError("empty rule pattern")
+        self.rules: Dict[str, Rule] = {r.name: r for r in rules}
+
+        literals = [r for r in rules if not r.regex]
+        self._trie = _TrieRegex(literals)
+        self._regex_rules = [(r, re.compile(r.pattern, re.IGNORECASE)) for r in rules if r.regex]
+
+        # The trie reports one phrase per position, the longest; the same
+        # phrase in other rules and its prefixes ending on a word boundary
+        # match there too.
+        self._implied: Dict[str, List[Rule]] = {r.name: [] for r in literals}
+        for long in literals:
+            for short in literals:
+                n = len(short.pattern)
+                if short is long or not long.pattern.startswith(short.pattern):
+                    continue
+                if n == len(long.pattern) or not _is_word(short.pattern[-1]) or not _is_word(long.pattern[n]):
+                    self._implied[long.name].append(short)
+
+    @staticmethod
+    def _targets(rule: Rule, seg: int) -> bool:
+        if rule.target == "question":
+            return seg == 0
+        if rule.target == "choice":
+            return seg > 0
+        return True
+
+    def scan(self, question: str, choices: Sequence = ()) -> Cues:
+        # NFC so decomposed (NFD) diacritics meet the precomposed letter classes.
+        segments = [unicodedata.normalize("NFC", s).strip() for s in [question or ""] + [str(c) for c in (choices or ())]]
+        text = _SEP.join(segments)
+        spans, pos = [], 0
+        for seg_text in segments:
+            spans.append((pos, pos + len(seg_text)))
+            pos += len(seg_text) + 1
+        matches: Dict[str, Set[int]] = {}
+
+        search = self._trie.pattern.search if self._trie.pattern is not None else None
+        seg, pos = 0, 0
+        while search is not None:
+            m = search(text, pos)
+            if m is None:
+                break
+            p = m.start()
+            while spans[seg][1] < p:
+                seg += 1
+            rule = self._trie.group_rule[m.lastindex]
+            word_start = p > 0 and _is_word(text[p - 1])
+            for r in [rule] + self._implied[rule.name]:
+                if word_start and _is_word(r.pattern[0]):
+                    continue
+                if r.start and p != spans[seg][0]:
+                    continue
+                if self._targets(r, seg):
+                    matches.setdefault(r.name, set()).add(seg)
+            pos = p + 1
+
+        for rule, rx in self._regex_rules:
+            for seg, (s, e) in enumerate(spans):
+                if not self._targets(rule, seg):
+                    continue
+                hit = rx.match(text, s, e) if rule.start else rx.search(text, s, e)
+                if hit:
+                    matches.setdefault(rule.name, set()).add(seg)
+        return Cues(matches, self.rules)
+
+
+ENGINE = HeuristicEngine(ROUTE_RULES)
+DOMAIN_ENGINE = HeuristicEngine(DOMAIN_RULES)
+SOLVER_ENGINE = HeuristicEngine(SOLVER_RULES)
+
+
+# ------------------ EXAMPLES ------------------
+# (engine, question, kind, whether a rule of that kind must match). Regressions go here.
+EXAMPLES: List[Tuple[HeuristicEngine, str, str, bool]] = [
+    (ENGINE, "Đoạn thông tin:\nNăm 1010, Lý Công Uẩn dời đô ra Thăng Long.\nCâu hỏi: ...", "passage", True),
+    (ENGINE, "ĐOẠN THÔNG TIN: ...", "passage", True),
+    (ENGINE, "Hãy đoán thông tin sau nói về nhân vật nào?", "passage", False),
+    (SOLVER_ENGINE, "Phát biểu nào sau đây sai?", "negation", True),
+    (SOLVER_ENGINE, "Sài Gòn được đổi tên thành Thành phố Hồ Chí Minh vào năm nào?", "negation", False),
+]
+
+
+if __name__ == "__main__":
+    import sys
+
+    failed = 0
+    for engine, question, kind, expected in EXAMPLES:
+        got = engine.scan(question).has(kind)
+        if got != expected:
+            failed += 1
+            print(f"FAIL {question[:60]!r}: {kind} matched={got}, expected {expected}")
+    print(f"{len(EXAMPLES) - failed}/{len(EXAMPLES)} examples ok")
+    sys.exit(1 if failed else 0)
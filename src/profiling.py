@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling for real pipeline runs (predict.py --profile DIR).
+
+- profile_stage(name): marks a hot section (router parsing, chunking, cosine
+  scoring, FAISS search, JSON decode, ...). When profiling is on, each stage gets
+  a deterministic cProfile (merged into <stage>.pstats / <stage>.txt) and the
+  sampling profiler attributes its stacks to the stage.
+- memory_checkpoint(label): tracemalloc snapshots before/after a block, the
+  top allocation growth is written to memory_<label>.txt.
+- A background sampler records every thread's stack; written as
+  flamegraph-compatible collapsed stacks (collapsed.txt, stage name as root).
+
+Everything is a no-op until enable() is called.
+"""
+from __future__ import annotations
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional
+
+_NULL = contextlib.nullcontext()
+
+
+class _Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = ""
+        self.sample_interval = 0.005
+        self._lock = threading.Lock()
+        # Only one cProfile may be active at a time (3.12+ enforces it process-wide);
+        # concurrent stages are still covered by the sampler.
+        self._cprofile_lock = threading.Lock()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._stage_calls: Counter = Counter()
+        self._stage_time: Counter = Counter()
+        self._active: Dict[int, List[str]] = {}
+        self._samples: Counter = Counter()
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._mem_reports: List[str] = []
+
+    # ---------- stages ----------
+    def push(self, name: str) -> None:
+        self._active.setdefault(threading.get_ident(), []).append(name)
+
+    def pop(self, name: str, elapsed: float, prof: Optional[cProfile.Profile]) -> None:
+        stack = self._active.get(threading.get_ident())
+        if stack:
+            stack.pop()
+        with self._lock:
+            self._stage_calls[name] += 1
+            self._stage_time[name] += elapsed
+            if prof is not None:
+                if name in self._stats:
+                    self._stats[name].add(prof)
+                else:
+                    self._stats[name] = pstats.Stats(prof)
+
+    # ---------- sampler ----------
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            for tid, frame in frames.items():
+                if tid == me:
+                    continue
+                stages = self._active.get(tid)
+                root = stages[-1] if stages else "(no stage)"
+                parts = []
+                f = frame
+                while f is not None:
+                    code = f.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    f = f.f_back
+                parts.append(root)
+                self._samples[";".join(reversed(parts))] += 1
+
+    def start(self, output_dir: str, sample_interval: float) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+        self._sampler.start()
+
+    # ---------- reports ----------
+    def write_reports(self) -> None:
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+        out = self.output_dir
+        with self._lock:
+            stats = dict(self._stats)
+            calls, total = dict(self._stage_calls), dict(self._stage_time)
+
+        for name, st in stats.items():
+            st.dump_stats(os.path.join(out, f"{name}.pstats"))
+            buf = io.StringIO()
+            pstats.Stats(os.path.join(out, f"{name}.pstats"), stream=buf).sort_stats("cumulative").print_stats(30)
+            with open(os.path.join(out, f"{name}.txt"), "w", encoding="utf-8") as f:
+                f.write(buf.getvalue())
+
+        with open(os.path.join(out, "collapsed.txt"), "w", encoding="utf-8") as f:
+            for stack, n in self._samples.most_common():
+                f.write(f"{stack} {n}\n")
+
+        with open(os.path.join(out, "stages.txt"), "w", encoding="utf-8") as f:
+            f.write(f"{'stage':<20} {'calls':>8} {'total_s':>10} {'mean_ms':>10}\n")
+            for name in sorted(total, key=total.get, reverse=True):
+                mean_ms = 1000.0 * total[name] / max(1, calls[name])
+                f.write(f"{name:<20} {calls[name]:>8} {total[name]:>10.3f} {mean_ms:>10.3f}\n")
+
+        print(f"📈 profile written to {out}")
+
+
+PROFILER = _Profiler()
+
+
+class _Stage:
+    __slots__ = ("name", "t0", "prof")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.t0 = 0.0
+        self.prof: Optional[cProfile.Profile] = None
+
+    def __enter__(self):
+        PROFILER.push(self.name)
+        if PROFILER._cprofile_lock.acquire(blocking=False):
+            self.prof = cProfile.Profile()
+            try:
+                self.prof.enable()
+            except ValueError:  # some other profiler is active
+                self.prof = None
+                PROFILER._cprofile_lock.release()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        if self.prof is not None:
+            self.prof.disable()
+            PROFILER._cprofile_lock.release()
+        PROFILER.pop(self.name, elapsed, self.prof)
+        return False
+
+
+def profile_stage(name: str):
+    """Context manager marking a profiled stage; free when profiling is off."""
+    if not PROFILER.enabled:
+        return _NULL
+    return _Stage(name)
+
+
+@contextlib.contextmanager
+def _memory_checkpoint(label: str):
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"# {label}: traced current={current / 2**20:.1f} MiB peak={peak / 2**20:.1f} MiB",
+            "# top allocation growth by line:",
+        ]
+        for stat in after.compare_to(before, "lineno")[:30]:
+            lines.append(str(stat))
+        with open(os.path.join(PROFILER.output_dir, f"memory_{label}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def memory_checkpoint(label: str):
+    """tracemalloc diff around a block (index loading, result accumulation)."""
+    if not PROFILER.enabled:
+        return _NULL
+    return _memory_checkpoint(label)
+
+
+def _patch_json_decode() -> None:
+    # JSON decode happens inside every client's resp.json(); wrap it once here
+    # rather than touching each call site. Only done when profiling is on.
+    import requests
+
+    original = requests.Response.json
+
+    def json_profiled(self, *args, **kwargs):
+        with profile_stage("json_decode"):
+            return original(self, *args, **kwargs)
+
+    requests.Response.json = json_profiled
+
+
+def enable(output_dir: str, sample_interval: float = 0.005) -> None:
+    if PROFILER.enabled:
+        return
+    PROFILER.start(output_dir, sample_interval)
+    _patch_json_decode()
+
+
+def write_reports() -> None:
+    PROFILER.write_reports()
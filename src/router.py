@@ -8,7 +8,17 @@ import re
 import time
 from typing import Any, Dict, Optional, Tuple
 
-import requests
+from src.heuristics import ENGINE, Cues
+from src.profiling import profile_stage
+from src.vnpt_client import (
+    CircuitOpenError,
+    breaker_for,
+    credential_headers,
+    http_post,
+    record_result,
+    select_model,
+    singleflight,
+)
 
 # Optional: dotenv fallback (safe if not installed / not provided)
 try:
@@ -37,19 +47,8 @@ def _get_env_trim(key: str) -> str:
 
 
 def _headers_for(model: str) -> Dict[str, str]:
-    if model == "large":
-        return {
-            "Authorization": _get_env_trim("AUTH_LARGE"),
-            "Token-id": _get_env_trim("TOKEN_ID_LARGE"),
-            "Token-key": _get_env_trim("TOKEN_KEY_LARGE"),
-            "Content-Type": "application/json",
-        }
-    return {
-        "Authorization": _get_env_trim("AUTH_SMALL"),
-        "Token-id": _get_env_trim("TOKEN_ID_SMALL"),
-        "Token-key": _get_env_trim("TOKEN_KEY_SMALL"),
-        "Content-Type": "application/json",
-    }
+    # First key of the model's credential pool; http_post spreads calls over all keys.
+    return credential_headers("large" if model == "large" else "small")
 
 
 def _endpoint_and_model_id(model: str) -> Tuple[str, str]:
@@ -81,21 +80,18 @@ VALID_CLASS_NAMES_FINAL = {"RAG", "STEM", "Reasoning"}
 VALID_SUBTYPES = {"PC", "MD", "Compulsory", "NA"}
 
 
-# ------------------ RAG-IN-QUESTION HEURISTIC ONLY ------------------
-RAG_IN_QUESTION_PATTERNS = [
-    r"\bđoạn thông tin\b",
-]
+# ------------------ HEURISTIC CUES (NO LLM) ------------------
+# Rules live in src/heuristics.py (ROUTE_RULES); one scan per question.
+def route_cues(question: str, choices: Any = None) -> Cues:
+    with profile_stage("router_cues"):
+        return ENGINE.scan(question or "", choices if isinstance(choices, list) else ())
 
 
 def is_rag_in_question(question: str) -> bool:
     """Detect RAG only when a passage/table/data is INCLUDED in the question."""
     if not question:
         return False
-    q_l = question.lower()
-    for pat in RAG_IN_QUESTION_PATTERNS:
-        if re.search(pat, q_l, flags=re.IGNORECASE | re.MULTILINE):
-            return True
-    return False
+    return route_cues(question).route() == "RAG"
 
 
 # ------------------ LLM PROMPT (VI ONLY, JSON) ------------------
@@ -240,6 +236,7 @@ def _is_safety_or_policy_400(decoded_error: Dict[str, Any]) -> bool:
 
 
 # ------------------ VNPT CHAT COMPLETION ------------------
+@singleflight
 def vnpt_chat_completion(
     user_content: str,
     model: str,
@@ -251,13 +248,11 @@ def vnpt_chat_completion(
     """
     VNPT OpenAI-style chat completions. Returns assistant content.
     Retries on 429/5xx and certain 4xx wrapped errors.
+    Each attempt goes through the per-endpoint circuit breakers: once `model`'s
+    breaker opens, remaining attempts fail over (large -> small) without sleeping,
+    and CircuitOpenError is raised if no endpoint is available.
     """
-    endpoint, model_id = _endpoint_and_model_id(model)
-    headers = _headers_for(model)
-    _ensure_auth_headers_present(headers, model=model)
-
     payload: Dict[str, Any] = {
-        "model": model_id,
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_content},
@@ -274,67 +269,94 @@ def vnpt_chat_completion(
     last_err: Optional[Exception] = None
 
     for attempt in range(max_retries):
-        try:
-            resp = requests.post(endpoint, headers=headers, json=payload, timeout=timeout)
+        current = select_model(model)
+        if current is None:
+            raise CircuitOpenError(f"All endpoints short-circuited for model={model}. Last error: {last_err}")
 
-            if resp.status_code == 429 or resp.status_code >= 500:
+        def _backoff() -> None:
+            # No point sleeping if the next attempt will fail over anyway.
+            if breaker_for(current).is_available():
                 time.sleep(2.0 * (attempt + 1))
-                continue
 
-            if resp.status_code >= 400:
-                try:
-                    data = resp.json()
-                except Exception:
-                    raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+        try:
+            endpoint, model_id = _endpoint_and_model_id(current)
+            headers = _headers_for(current)
+            _ensure_auth_headers_present(headers, model=current)
+        except RuntimeError:
+            # Missing env var / auth header: a configuration mistake, not an
+            # endpoint failure, so it must not count towards opening the breaker.
+            breaker_for(current).release()
+            raise
+        payload["model"] = model_id
 
-                decoded = _try_decode_vnpt_error_payload(data)
-                if decoded and _is_safety_or_policy_400(decoded):
-                    raise ValueError("SAFETY_REFUSAL_400")
+        try:
+            resp = http_post(endpoint, headers=headers, json=payload, timeout=timeout)
+        except Exception as e:
+            record_result(current, None)
+            last_err = e
+            _backoff()
+            continue
 
-                time.sleep(2.0 * (attempt + 1))
-                continue
+        record_result(current, resp.status_code)
 
+        if resp.status_code == 429 or resp.status_code >= 500:
+            last_err = RuntimeError(f"HTTP {resp.status_code}")
+            _backoff()
+            continue
+
+        if resp.status_code >= 400:
             try:
                 data = resp.json()
             except Exception:
-                time.sleep(2.0 * (attempt + 1))
-                continue
-
-            if isinstance(data, dict) and "choices" in data and data["choices"]:
-                return data["choices"][0]["message"]["content"]
+                raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
 
             decoded = _try_decode_vnpt_error_payload(data)
             if decoded and _is_safety_or_policy_400(decoded):
                 raise ValueError("SAFETY_REFUSAL_400")
 
-            time.sleep(2.0 * (attempt + 1))
+            last_err = RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            _backoff()
             continue
 
-        except ValueError as ve:
-            last_err = ve
-            raise
+        try:
+            data = resp.json()
         except Exception as e:
             last_err = e
-            time.sleep(2.0 * (attempt + 1))
+            _backoff()
+            continue
+
+        if isinstance(data, dict) and "choices" in data and data["choices"]:
+            return data["choices"][0]["message"]["content"]
+
+        decoded = _try_decode_vnpt_error_payload(data)
+        if decoded and _is_safety_or_policy_400(decoded):
+            raise ValueError("SAFETY_REFUSAL_400")
+
+        last_err = RuntimeError(f"HTTP {resp.status_code} without choices: {resp.text[:200]}")
+        _backoff()
 
     raise RuntimeError(f"VNPT API call failed after retries. Last error: {last_err}")
 
 
 # ------------------ LLM CLASSIFY ONE ------------------
-def llm_classify(question: str, choices: Any, model: str) -> Tuple[Optional[str], str, str]:
+def _llm_route(
+    question: str, choices: Any, model: str, system_prompt: str
+) -> Tuple[Optional[str], str, str, str]:
     """
-    Return (label_name_or_none, subtype, status)
+    Return (label_name_or_none, subtype, status, raw)
     status: "ok" | "safety" | "fail"
     """
+    raw = ""
     try:
         user_content = format_mcq_for_llm(question, choices)
         raw = vnpt_chat_completion(
             user_content=user_content,
             model=model,
-            system_prompt=SYSTEM_PROMPT_VI_JSON,
+            system_prompt=system_prompt,
         )
 
-        label4_digit, subtype = extract_label4_and_subtype(raw)
+        with profile_stage("router_parse"):
+            label4_digit, subtype = extract_label4_and_subtype(raw)
 
         if label4_digit and label4_digit in LABEL4_TO_CLASS:
             label_name = LABEL4_TO_CLASS[label4_digit]
@@ -350,17 +372,48 @@ def llm_classify(question: str, choices: Any, model: str) -> Tuple[Optional[str]
                 if subtype not in {"PC", "MD", "Compulsory"}:
                     subtype = "MD"
 
-            return label_name, subtype, "ok"
+            return label_name, subtype, "ok", raw
 
-        return None, "NA", "fail"
+        return None, "NA", "fail", raw
 
     except ValueError as ve:
         if "SAFETY_REFUSAL" in str(ve):
-            return None, "NA", "safety"
-        return None, "NA", "fail"
+            return None, "NA", "safety", raw
+        return None, "NA", "fail", raw
 
     except Exception:
-        return None, "NA", "fail"
+        return None, "NA", "fail", raw
+
+
+def llm_classify(question: str, choices: Any, model: str) -> Tuple[Optional[str], str, str]:
+    """
+    Return (label_name_or_none, subtype, status)
+    status: "ok" | "safety" | "fail"
+    """
+    label_name, subtype, status, _ = _llm_route(question, choices, model, SYSTEM_PROMPT_VI_JSON)
+    return label_name, subtype, status
+
+
+def _finalize_route(cues: Cues, label_name: Optional[str], subtype: str, status: str) -> Tuple[str, str]:
+    if label_name:
+        # Enforce: RAG must be in-question; otherwise convert to Reasoning/MD
+        if label_name == "RAG" and cues.route() != "RAG":
+            return "Reasoning", "MD"
+
+        # subtype rules
+        if label_name != "Reasoning":
+            return label_name, "NA"
+
+        if subtype not in {"PC", "MD", "Compulsory"}:
+            subtype = "MD"
+        return "Reasoning", subtype
+
+    # Fallbacks
+    if status == "safety":
+        return "Reasoning", "PC"
+    if cues.has("stem"):
+        return "STEM", "NA"
+    return "Reasoning", "MD"
 
 
 def classify_one(
@@ -378,27 +431,88 @@ def classify_one(
     """
     q = question or ""
 
-    # 1) RAG-in-question heuristic ONLY (NO LLM)
-    if is_rag_in_question(q):
-        return "RAG", "NA"
+    # 1) Heuristic fast path (NO LLM): RAG-in-question and any other routed cue
+    cues = route_cues(q, choices)
+    route = cues.route()
+    if route:
+        return route, "NA"
 
-    # 2) LLM classify
+    # 2) LLM classify (+ 3) fallbacks)
     label_name, subtype, status = llm_classify(q, choices, model=model)
+    return _finalize_route(cues, label_name, subtype, status)
 
-    if label_name:
-        # Enforce: RAG must be in-question; otherwise convert to Reasoning/MD
-        if label_name == "RAG" and not is_rag_in_question(q):
-            return "Reasoning", "MD"
 
-        # subtype rules
-        if label_name != "Reasoning":
-            return label_name, "NA"
+# ------------------ FUSED ROUTE + ANSWER ------------------
+FUSED_ANSWER_RULES_VI = """
+Ngoài ra trả thêm 2 trường "answer" và "confidence":
+- Nếu label4="2", hoặc label4="4" với subtype="Compulsory": "answer" là chữ cái của đáp án đúng trong CHOICES.
+  "confidence"="high" chỉ khi bạn chắc chắn đáp án đúng mà không cần tra cứu thêm; nếu không thì "low".
+- Các trường hợp khác: "answer"="NA", "confidence"="low".
+""".strip()
 
-        if subtype not in {"PC", "MD", "Compulsory"}:
-            subtype = "MD"
-        return "Reasoning", subtype
+SYSTEM_PROMPT_VI_JSON_FUSED = (
+    SYSTEM_PROMPT_VI_JSON.replace(
+        '{"label4":"1|2|3|4","subtype":"PC|MD|Compulsory|NA"}',
+        '{"label4":"1|2|3|4","subtype":"PC|MD|Compulsory|NA","answer":"A|B|C|D|...|NA","confidence":"high|low"}',
+    ).replace(
+        "Chỉ trả về JSON, không thêm bất kỳ chữ nào khác.",
+        FUSED_ANSWER_RULES_VI + "\n\nChỉ trả về JSON, không thêm bất kỳ chữ nào khác.",
+    )
+)
 
-    # 3) Fallbacks
-    if status == "safety":
-        return "Reasoning", "PC"
-    return "Reasoning", "MD"
+
+def extract_fused_answer(raw: str, n_choices: int) -> Tuple[Optional[str], bool]:
+    """Parse (answer_letter_or_none, high_confidence) from the fused router JSON."""
+    if not raw:
+        return None, False
+    s = raw.strip()
+
+    answer, confidence = "", ""
+    try:
+        obj = json.loads(s)
+        if isinstance(obj, dict):
+            answer = str(obj.get("answer", "")).strip().upper()
+            confidence = str(obj.get("confidence", "")).strip().lower()
+    except Exception:
+        m = re.search(r'"answer"\s*:\s*"([A-Z]|NA)"', s, flags=re.IGNORECASE)
+        answer = m.group(1).upper() if m else ""
+        m2 = re.search(r'"confidence"\s*:\s*"(high|low)"', s, flags=re.IGNORECASE)
+        confidence = m2.group(1).lower() if m2 else ""
+
+    if len(answer) != 1 or not ("A" <= answer <= "Z"):
+        return None, False
+    if ord(answer) - ord("A") >= max(1, n_choices):
+        return None, False
+    return answer, confidence == "high"
+
+
+def classify_and_answer(
+    question: str,
+    choices: Any,
+    model: str = "large",
+) -> Tuple[str, str, Optional[str]]:
+    """
+    Fused variant of classify_one: one router call that also proposes an answer.
+
+    Returns:
+      (label, subtype, answer)
+        answer is a letter only for high-confidence Reasoning/Compulsory
+        questions (the caller may skip the solver); None otherwise.
+    """
+    q = question or ""
+
+    cues = route_cues(q, choices)
+    route = cues.route()
+    if route:
+        return route, "NA", None
+
+    label_name, subtype, status, raw = _llm_route(q, choices, model, SYSTEM_PROMPT_VI_JSON_FUSED)
+    label, subtype = _finalize_route(cues, label_name, subtype, status)
+
+    if label != "Reasoning" or subtype != "Compulsory":
+        return label, subtype, None
+
+    n_choices = len(choices) if isinstance(choices, list) else 0
+    with profile_stage("router_parse"):
+        answer, high_conf = extract_fused_answer(raw, n_choices)
+    return label, subtype, answer if high_conf else None
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run history: every predict.py run is appended to a local SQLite store
+(configuration, per-qid route / answer / latency, aggregate stats), so
+regressions after changing prompts, retrieval or concurrency show up run
+over run.
+
+    python -m src.run_history list                 # recent runs
+    python -m src.run_history show -1              # one run (id, or -1 = latest)
+    python -m src.run_history diff -2 -1           # latency shifts, changed answers
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+# Store read by the CLI below; predict.py records only with --history / RUN_HISTORY_DB.
+RUN_HISTORY_DB = (os.getenv("RUN_HISTORY_DB") or "runs.sqlite").strip()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    wall_s REAL NOT NULL,
+    label TEXT,
+    git_rev TEXT,
+    n_questions INTEGER NOT NULL,
+    config TEXT NOT NULL,
+    stats TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS questions (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    qid TEXT NOT NULL,
+    route TEXT,
+    subtype TEXT,
+    answer TEXT,
+    latency REAL,
+    error TEXT,
+    PRIMARY KEY (run_id, qid)
+);
+"""
+
+
+# ------------------ STORE ------------------
+def connect(path: str = RUN_HISTORY_DB) -> sqlite3.Connection:
+    # Shards of one run may write concurrently: wait on the lock, don't fail.
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    return s[max(0, math.ceil(q / 100.0 * len(s)) - 1)]
+
+
+def _route_name(job: dict) -> str:
+    label = job.get("label") or "?"
+    return f"Reasoning/{job.get('subtype')}" if label == "Reasoning" else label
+
+
+def _latency_stats(latencies: List[float]) -> Dict[str, float]:
+    return {
+        "n": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else float("nan"),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "max": max(latencies) if latencies else float("nan"),
+    }
+
+
+def aggregate(jobs: List[dict]) -> Dict:
+    by_route: Dict[str, List[float]] = {}
+    for j in jobs:
+        by_route.setdefault(_route_name(j), []).append(float(j.get("elapsed", 0.0)))
+    return {
+        "all": _latency_stats([x for xs in by_route.values() for x in xs]),
+        "routes": {r: _latency_stats(xs) for r, xs in sorted(by_route.items())},
+        "errors": sum(1 for j in jobs if j.get("error")),
+    }
+
+
+def git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def record_run(
+    jobs: List[dict],
+    config: Dict,
+    started: float,
+    wall_s: float,
+    extra_stats: Optional[Dict] = None,
+    label: Optional[str] = None,
+    path: str = RUN_HISTORY_DB,
+) -> int:
+    """Store one run; returns its id."""
+    stats = aggregate(jobs)
+    stats.update(extra_stats or {})
+    conn = connect(path)
+    try:
+        with conn:
+            cur = conn.execute(
+                "INSERT INTO runs (started, wall_s, label, git_rev, n_questions, config, stats) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (started, wall_s, label, git_rev(), len(jobs),
+                 json.dumps(config, sort_keys=True, default=str), json.dumps(stats, sort_keys=True)),
+            )
+            run_id = cur.lastrowid
+            conn.executemany(
+                "INSERT OR REPLACE INTO questions (run_id, qid, route, subtype, answer, latency, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id, str(j["qid"]), j.get("label"), j.get("subtype"), j.get("answer"),
+                     float(j.get("elapsed", 0.0)), j.get("error"))
+                    for j in jobs
+                ],
+            )
+    finally:
+        conn.close()
+    return run_id
+
+
+def resolve_run(conn: sqlite3.Connection, ref: str) -> int:
+    """Run id from "12", or "-1" (latest), "-2" (the one before), ..."""
+    n = int(ref)
+    if n == 0:
+        raise ValueError("❌ runs are numbered from 1 (or -1 = latest)")
+    if n > 0:
+        if conn.execute("SELECT 1 FROM runs WHERE id = ?", (n,)).fetchone() is None:
+            raise ValueError(f"❌ no run {n}")
+        return n
+    row = conn.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?", (-n - 1,)).fetchone()
+    if row is None:
+        raise ValueError(f"❌ no run {ref} (only {conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]} recorded)")
+    return row[0]
+
+
+def load_run(conn: sqlite3.Connection, run_id: int) -> Dict:
+    started, wall_s, label, rev, n, config, stats = conn.execute(
+        "SELECT started, wall_s, label, git_rev, n_questions, config, stats FROM runs WHERE id = ?", (run_id,)
+    ).fetchone()
+    questions = {
+        qid: {"route": route, "subtype": subtype, "answer": answer, "latency": latency, "error": error}
+        for qid, route, subtype, answer, latency, error in conn.execute(
+            "SELECT qid, route, subtype, answer, latency, error FROM questions WHERE run_id = ?", (run_id,)
+        )
+    }
+    return {
+        "id": run_id, "started": started, "wall_s": wall_s, "label": label, "git_rev": rev,
+        "n_questions": n, "config": json.loads(config), "stats": json.loads(stats), "questions": questions,
+    }
+
+
+# ------------------ REPORTS ------------------
+def _when(ts: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+
+
+def _config_diff(a: Dict, b: Dict) -> List[str]:
+    keys = sorted(set(a) | set(b))
+    return [f"{k}: {a.get(k)!r} -> {b.get(k)!r}" for k in keys if a.get(k) != b.get(k)]
+
+
+def _fmt(x: float) -> str:
+    return "-" if x is None or (isinstance(x, float) and math.isnan(x)) else f"{x:.3f}"
+
+
+def print_list(conn: sqlite3.Connection, limit: int = 20) -> None:
+    rows = conn.execute(
+        "SELECT id, started, wall_s, n_questions, git_rev, label, stats FROM runs ORDER BY id DESC LIMIT ?", (limit,)
+    ).fetchall()
+    print(f"{'id':>5} {'started':<16} {'n':>6} {'wall_s':>8} {'p50_s':>7} {'p95_s':>7} {'rev':<9} label")
+    for run_id, started, wall_s, n, rev, label, stats in rows:
+        s = json.loads(stats)["all"]
+        print(f"{run_id:>5} {_when(started):<16} {n:>6} {wall_s:>8.1f} {_fmt(s['p50']):>7} {_fmt(s['p95']):>7} {rev or '-':<9} {label or ''}")
+
+
+def print_run(run: Dict) -> None:
+    print(f"🗃️ run {run['id']} ({_when(run['started'])}, {run['n_questions']} questions, {run['wall_s']:.1f}s wall, rev {run['git_rev'] or '-'})")
+    for k, v in sorted(run["config"].items()):
+        print(f"   {k} = {v!r}")
+    print(f"   {'route':<20} {'n':>5} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8}")
+    for route, s in list(run["stats"]["routes"].items()) + [("all", run["stats"]["all"])]:
+        print(f"   {route:<20} {s['n']:>5} {_fmt(s['mean']):>8} {_fmt(s['p50']):>8} {_fmt(s['p95']):>8} {_fmt(s['max']):>8}")
+    for k, v in sorted(run["stats"].items()):
+        if k not in ("all", "routes"):
+            print(f"   {k}: {v}")
+
+
+def print_diff(a: Dict, b: Dict, top: int = 10) -> None:
+    print(f"🗃️ run {a['id']} -> run {b['id']}")
+    changes = _config_diff(a["config"], b["config"])
+    print("   config: " + ("; ".join(changes) if changes else "unchanged"))
+    print(f"   wall: {a['wall_s']:.1f}s -> {b['wall_s']:.1f}s")
+
+    # Latency distribution per route (route as recorded in each run).
+    ra, rb = a["stats"]["routes"], b["stats"]["routes"]
+    print(f"   {'route':<20} {'n':>9} {'p50':>17} {'p95':>17} {'Δp95':>8}")
+    for route in sorted(set(ra) | set(rb)) + ["all"]:
+        sa = a["stats"]["all"] if route == "all" else ra.get(route, {})
+        sb = b["stats"]["all"] if route == "all" else rb.get(route, {})
+        n = f"{sa.get('n', 0)}->{sb.get('n', 0)}"
+        p50 = f"{_fmt(sa.get('p50'))}->{_fmt(sb.get('p50'))}"
+        p95 = f"{_fmt(sa.get('p95'))}->{_fmt(sb.get('p95'))}"
+        delta = sb["p95"] - sa["p95"] if sa.get("n") and sb.get("n") else float("nan")
+        print(f"   {route:<20} {n:>9} {p50:>17} {p95:>17} {_fmt(delta):>8}")
+
+    shared = sorted(set(a["questions"]) & set(b["questions"]))
+    qa, qb = a["questions"], b["questions"]
+    changed = [q for q in shared if qa[q]["answer"] != qb[q]["answer"]]
+    rerouted = [q for q in shared if (qa[q]["route"], qa[q]["subtype"]) != (qb[q]["route"], qb[q]["subtype"])]
+    only = len(set(a["questions"]) ^ set(b["questions"]))
+    print(f"   {len(shared)} shared qids ({only} in one run only): {len(changed)} answers changed, {len(rerouted)} re-routed")
+    for q in changed[:top]:
+        route = qb[q]["route"] if qa[q]["route"] == qb[q]["route"] else f"{qa[q]['route']}->{qb[q]['route']}"
+        print(f"     {q:<16} {qa[q]['answer']} -> {qb[q]['answer']}  ({route})")
+    if len(changed) > top:
+        print(f"     ... {len(changed) - top} more")
+
+    slower = sorted(shared, key=lambda q: qb[q]["latency"] - qa[q]["latency"], reverse=True)[:top]
+    slower = [q for q in slower if qb[q]["latency"] > qa[q]["latency"]]
+    if slower:
+        print("   slowest regressions:")
+        for q in slower:
+            print(
+                f"     {q:<16} {qa[q]['latency']:>8.3f}s -> {qb[q]['latency']:>8.3f}s "
+                f"(+{qb[q]['latency'] - qa[q]['latency']:.3f}s, {qb[q]['route']})"
+            )
+
+
+# ------------------ CLI ------------------
+def main(argv=None):
+    p = argparse.ArgumentParser(description="predict.py run history")
+    p.add_argument("--db", default=RUN_HISTORY_DB, help="SQLite run store")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    ls = sub.add_parser("list", help="recent runs")
+    ls.add_argument("--limit", type=int, default=20)
+    show = sub.add_parser("show", help="one run's configuration and latency per route")
+    show.add_argument("run", help="run id, or -1 for the latest, -2 for the one before, ...")
+    diff = sub.add_parser("diff", help="compare two runs")
+    diff.add_argument("base", help="run id or -N")
+    diff.add_argument("new", nargs="?", default="-1", help="run id or -N (default: latest)")
+    diff.add_argument("--top", type=int, default=10, help="changed answers / regressions listed")
+    args = p.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        raise SystemExit(f"❌ no run history at {args.db}")
+    conn = connect(args.db)
+    try:
+        if args.cmd == "list":
+            print_list(conn, args.limit)
+        elif args.cmd == "show":
+            print_run(load_run(conn, resolve_run(conn, args.run)))
+        else:
+            print_diff(load_run(conn, resolve_run(conn, args.base)), load_run(conn, resolve_run(conn, args.new)), args.top)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cost model + longest-job-first helpers for the concurrent pipeline.
+
+Each routed question gets an estimated solve time from its route and prompt
+size, so the executor can start the long STEM chain-of-thought / big RAG
+prompts first and let cheap jobs (PC validator, 5-token Reasoning answers)
+fill the gaps. After the run, report_cost_model() compares the estimates with
+the measured solve times and the makespan with its lower bound.
+"""
+from __future__ import annotations
+import math
+from typing import Dict, List
+
+from src.RAG import RAG_answerer
+from src.RAG.RAG_answerer import split_qna
+from src.STEM.stem_module import build_cot_prompt
+
+# ------------------ COST MODEL ------------------
+# Vietnamese text averages ~3.5 characters per token on the VNPT tokenizer.
+CHARS_PER_TOKEN = 3.5
+
+# Seconds: fixed request overhead, prompt processing and generation per token.
+REQUEST_OVERHEAD = 0.4
+PREFILL_PER_TOKEN = 0.0003
+DECODE_PER_TOKEN = 0.02
+EMBED_CALL = 0.15
+
+# Typical generated tokens per route (the caps are 1000 / 2048 / 5).
+EXPECTED_OUTPUT_TOKENS = {"RAG": 300, "STEM": 600, "Reasoning": 3}
+
+_RAG_PROMPT_CHARS = 1500       # instructions of build_RAG_prompt
+_REASONING_PROMPT_CHARS = 600  # instructions of build_prompt / PC validator
+_REASONING_CONTEXT_CHARS = 8000
+
+
+def _tokens(chars: int) -> float:
+    return chars / CHARS_PER_TOKEN
+
+
+def _llm_call(prompt_chars: int, output_tokens: int) -> float:
+    return REQUEST_OVERHEAD + _tokens(prompt_chars) * PREFILL_PER_TOKEN + output_tokens * DECODE_PER_TOKEN
+
+
+def estimate_cost(job: Dict) -> float:
+    """Estimated solve time (seconds) of a routed job; excludes routing."""
+    question, choices = job["question"], job["choices"]
+    choices_chars = sum(len(str(c)) for c in choices)
+
+    if job.get("router_answer"):
+        return 0.0
+
+    if job["label"] == "RAG":
+        context, q = split_qna(question)
+        chunk_chars = RAG_answerer.RAG_CHUNK_TOKENS * CHARS_PER_TOKEN
+        step_chars = max(1.0, chunk_chars - RAG_answerer.RAG_CHUNK_OVERLAP_TOKENS * CHARS_PER_TOKEN)
+        # Only the prefiltered chunks are embedded, however long the passage.
+        n_chunks = min(RAG_answerer.RAG_PREFILTER_K, max(1, math.ceil(len(context) / step_chars))) if context.strip() else 0
+        # The top-k chunks end up in the prompt, not the whole passage.
+        prompt_chars = _RAG_PROMPT_CHARS + min(len(context), RAG_answerer.RAG_TOP_K * chunk_chars) + len(q) + choices_chars
+        return (n_chunks + 1) * EMBED_CALL + _llm_call(prompt_chars, EXPECTED_OUTPUT_TOKENS["RAG"])
+
+    if job["label"] == "STEM":
+        prompt_chars = len(build_cot_prompt(question, choices))
+        return _llm_call(prompt_chars, EXPECTED_OUTPUT_TOKENS["STEM"])
+
+    prompt_chars = _REASONING_PROMPT_CHARS + len(question) + choices_chars
+    if job["subtype"] != "PC":
+        prompt_chars += _REASONING_CONTEXT_CHARS
+    return _llm_call(prompt_chars, EXPECTED_OUTPUT_TOKENS["Reasoning"])
+
+
+# ------------------ REPORT ------------------
+def _ranks(values: List[float]) -> List[float]:
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0.0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2.0
+        i = j + 1
+    return ranks
+
+
+def spearman(xs: List[float], ys: List[float]) -> float:
+    if len(xs) < 2:
+        return float("nan")
+    rx, ry = _ranks(xs), _ranks(ys)
+    mx, my = sum(rx) / len(rx), sum(ry) / len(ry)
+    cov = sum((a - mx) * (b - my) for a, b in zip(rx, ry))
+    vx = math.sqrt(sum((a - mx) ** 2 for a in rx))
+    vy = math.sqrt(sum((b - my) ** 2 for b in ry))
+    if vx == 0 or vy == 0:
+        return float("nan")
+    return cov / (vx * vy)
+
+
+def report_cost_model(jobs: List[Dict], workers: int, wall_time: float) -> None:
+    """Print estimate-vs-actual per route and makespan vs its lower bound."""
+    timed = [j for j in jobs if "est_cost" in j and "solve_time" in j]
+    if not timed:
+        return
+
+    print("📐 cost model (estimated vs actual solve seconds)")
+    print(f"   {'route':<20} {'n':>5} {'est_mean':>9} {'act_mean':>9} {'act/est':>8}")
+    groups: Dict[str, List[Dict]] = {}
+    for j in timed:
+        name = j["label"] if j["label"] != "Reasoning" else f"Reasoning/{j['subtype']}"
+        groups.setdefault(name, []).append(j)
+    for name in sorted(groups):
+        g = groups[name]
+        est = sum(j["est_cost"] for j in g) / len(g)
+        act = sum(j["solve_time"] for j in g) / len(g)
+        ratio = act / est if est > 0 else float("nan")
+        print(f"   {name:<20} {len(g):>5} {est:>9.3f} {act:>9.3f} {ratio:>8.2f}")
+
+    rho = spearman([j["est_cost"] for j in timed], [j["solve_time"] for j in timed])
+    print(f"   rank correlation (Spearman): {rho:.3f}")
+
+    actual = [j["solve_time"] for j in timed]
+    bound = max(sum(actual) / max(1, workers), max(actual))
+    print(f"   solve makespan lower bound: {bound:.2f}s, run wall time: {wall_time:.2f}s")
@@ -0,0 +1,1045 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for talking to the VNPT endpoints (small / large / embedding).
+
+The solver modules keep their own prompt + payload code; this module holds the
+state that has to be shared across them within one process.
+"""
+from __future__ import annotations
+import base64
+import functools
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Pattern, Sequence, Tuple
+
+import numpy as np
+import requests
+import requests.adapters
+
+
+# ------------------ ENV ------------------
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float((os.environ.get(key) or "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_flag(key: str) -> bool:
+    return (os.environ.get(key) or "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+# ------------------ CONNECTION POOL ------------------
+# One keep-alive pool per host shared by every module, so TCP/TLS setup is paid
+# once per connection instead of once per request.
+HTTP_POOL_SIZE = int(_env_float("HTTP_POOL_SIZE", 32))
+
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=8, pool_maxsize=HTTP_POOL_SIZE
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _SESSION = session
+    return _SESSION
+
+
+def _reset_after_fork() -> None:
+    # A forked worker must not share the parent's pooled sockets.
+    global _SESSION, _SESSION_LOCK
+    _SESSION = None
+    _SESSION_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def http_post(url: str, **kwargs: Any) -> requests.Response:
+    """
+    Drop-in for requests.post that reuses pooled connections. With a cassette
+    active (see use_cassette) responses are recorded to / replayed from it.
+
+    The credential headers are replaced by the least-loaded key of the
+    model's CredentialPool; a 401 / 403 / 429 is retried once on each other
+    key that is available right now.
+    """
+    pool = credential_pool(_payload_model(kwargs.get("json")))
+    if pool is None:
+        return _post_once(url, **kwargs)
+
+    tried: List[Credential] = []
+    cred = pool.acquire()  # never None: a pool holds at least one key
+    while True:
+        tried.append(cred)
+        try:
+            resp = _post_once(url, **dict(kwargs, headers=cred.apply(kwargs.get("headers"))))
+        finally:
+            pool.release(cred)
+        if resp.status_code not in _CREDENTIAL_ERRORS:
+            return resp
+        pool.reject(cred, resp.status_code)
+        cred = pool.acquire(exclude=tried) if pool.has_available(exclude=tried) else None
+        if cred is None:
+            return resp
+        resp.close()
+
+
+def _post_once(url: str, **kwargs: Any) -> requests.Response:
+    cassette = _CASSETTE
+    if cassette is not None and cassette.mode == "replay":
+        resp = cassette.replay(kwargs.get("json"))
+        LEDGER.observe(kwargs.get("json"), kwargs.get("headers"), resp)
+        return resp
+
+    t0 = time.perf_counter()
+    try:
+        resp = http_session().post(url, **kwargs)
+    except Exception as e:
+        if cassette is not None:
+            cassette.record_error(kwargs.get("json"), e, time.perf_counter() - t0)
+        raise
+    if cassette is not None:
+        cassette.record(kwargs.get("json"), resp, time.perf_counter() - t0)
+    LEDGER.observe(kwargs.get("json"), kwargs.get("headers"), resp)
+    return resp
+
+
+def prewarm_connections(urls: List[str], per_host: int = 2, timeout: float = 10.0) -> int:
+    """
+    Open `per_host` pooled connections to each endpoint ahead of the first real
+    call (any HTTP status is fine - only the TCP/TLS handshake matters).
+    Returns how many warm-up requests got a response.
+    """
+    if _CASSETTE is not None and _CASSETTE.mode == "replay":
+        return 0
+    targets = [u for u in dict.fromkeys(urls) if u]
+    ok = 0
+    ok_lock = threading.Lock()
+
+    def _touch(url: str) -> None:
+        nonlocal ok
+        try:
+            http_session().head(url, timeout=timeout)
+        except Exception:
+            return
+        with ok_lock:
+            ok += 1
+
+    threads = [threading.Thread(target=_touch, args=(u,), daemon=True) for u in targets for _ in range(per_host)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return ok
+
+
+# ------------------ RECORD / REPLAY ------------------
+class Cassette:
+    """
+    JSONL (optionally .gz) log of every request/response pair sent through
+    http_post: chat and embedding payloads, status code, body and latency.
+
+    Entries are keyed by the request payload (minus the "stream" flag and any
+    auth headers), so a recorded run can be replayed offline and
+    deterministically. Repeated identical requests replay their recordings in
+    order; the last one is reused once exhausted.
+    """
+
+    def __init__(self, path: str, mode: str, replay_latency: bool = False):
+        if mode not in {"record", "replay"}:
+            raise ValueError(f"cassette mode must be record|replay, got {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        if mode == "replay":
+            self._load()
+        else:
+            # Start a fresh cassette for this recording.
+            with self._open("w"):
+                pass
+
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    @staticmethod
+    def key(payload: Any) -> str:
+        if isinstance(payload, dict):
+            payload = {k: v for k, v in payload.items() if k != "stream"}
+        return request_key(payload)
+
+    def _load(self) -> None:
+        with self._open("r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self._entries.setdefault(entry["key"], []).append(entry)
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            with self._open("a") as f:
+                f.write(line + "\n")
+
+    def record(self, payload: Any, resp: requests.Response, latency: float) -> None:
+        body = resp.content  # also consumes streamed bodies so they can be replayed
+        self._append({
+            "key": self.key(payload),
+            "status": resp.status_code,
+            "content_type": resp.headers.get("Content-Type", ""),
+            "body": body.decode("utf-8", errors="replace"),
+            "latency": round(latency, 4),
+        })
+
+    def record_error(self, payload: Any, err: Exception, latency: float) -> None:
+        self._append({"key": self.key(payload), "error": str(err), "latency": round(latency, 4)})
+
+    def replay(self, payload: Any) -> requests.Response:
+        key = self.key(payload)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise requests.ConnectionError(f"cassette miss for request {key[:12]}")
+            i = self._cursor.get(key, 0)
+            self._cursor[key] = i + 1
+            entry = entries[min(i, len(entries) - 1)]
+
+        if self.replay_latency:
+            time.sleep(entry.get("latency", 0.0))
+        if "error" in entry:
+            raise requests.ConnectionError(entry["error"])
+
+        resp = requests.Response()
+        resp.status_code = entry["status"]
+        resp.headers["Content-Type"] = entry.get("content_type", "")
+        resp.encoding = "utf-8"
+        resp._content = entry["body"].encode("utf-8")
+        resp._content_consumed = True
+        return resp
+
+
+_CASSETTE: Optional[Cassette] = None
+
+
+def use_cassette(path: str, mode: str, replay_latency: bool = False) -> Cassette:
+    """Route every http_post through a record / replay cassette."""
+    global _CASSETTE
+    _CASSETTE = Cassette(path, mode, replay_latency=replay_latency)
+    return _CASSETTE
+
+
+def clear_cassette() -> None:
+    """Send http_post straight to the endpoints again."""
+    global _CASSETTE
+    _CASSETTE = None
+
+
+# ------------------ CIRCUIT BREAKER ------------------
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Consecutive endpoint failures before the breaker opens.
+CB_FAILURE_THRESHOLD = int(_env_float("CB_FAILURE_THRESHOLD", 3))
+# Seconds an open breaker waits before letting one probe request through.
+CB_RECOVERY_TIMEOUT = _env_float("CB_RECOVERY_TIMEOUT", 30.0)
+
+# Where traffic goes while a model's breaker is open. A model with no (healthy)
+# failover is served by the caller's local fallback (heuristic / default answer).
+FAILOVER_MODELS: Dict[str, Tuple[str, ...]] = {
+    "large": ("small",),
+    "small": (),
+    "embed": (),
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when every candidate endpoint for a call is short-circuited."""
+
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker for one endpoint.
+
+    closed    -> requests flow; `failure_threshold` consecutive failures open it
+    open      -> requests are rejected until `recovery_timeout` has elapsed
+    half_open -> a single probe is let through; success closes, failure re-opens
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CB_FAILURE_THRESHOLD,
+        recovery_timeout: float = CB_RECOVERY_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _transition(self, new_state: str) -> None:
+        if new_state == self._state:
+            return
+        print(f"[circuit] {self.name}: {self._state} -> {new_state}")
+        self._state = new_state
+        if new_state == OPEN:
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+        elif new_state == CLOSED:
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        """True if a call may be sent now (claims the probe slot when half-open)."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def is_available(self) -> bool:
+        """Non-claiming check used to decide whether to keep retrying an endpoint."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                return time.monotonic() - self._opened_at >= self.recovery_timeout
+            return not self._probe_in_flight
+
+    def release(self) -> None:
+        """Give back a claimed probe slot when no call was sent (outcome unknown)."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._transition(OPEN)
+                return
+            self._failures += 1
+            if self._state == CLOSED and self._failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def breaker_for(model: str) -> CircuitBreaker:
+    with _BREAKERS_LOCK:
+        cb = _BREAKERS.get(model)
+        if cb is None:
+            cb = CircuitBreaker(model)
+            _BREAKERS[model] = cb
+        return cb
+
+
+def failover_chain(model: str) -> Iterator[str]:
+    """
+    Yield `model` and then its failover models, skipping endpoints whose breaker
+    is open. Iterate lazily: taking an item claims the half-open probe slot.
+    """
+    for m in (model,) + FAILOVER_MODELS.get(model, ()):
+        if breaker_for(m).allow_request():
+            yield m
+
+
+def select_model(model: str) -> Optional[str]:
+    """First model from `failover_chain`, or None if all are short-circuited."""
+    return next(failover_chain(model), None)
+
+
+def is_endpoint_failure(status_code: Optional[int]) -> bool:
+    """
+    Failures that say something about endpoint health (not about the request).
+    A 429 is a capacity limit, handled by LEDGER, not a failure.
+    """
+    return status_code is None or status_code >= 500
+
+
+def should_fail_over(status_code: Optional[int]) -> bool:
+    """Worth trying the next endpoint of the failover chain: a failure or a rate limit."""
+    return status_code == 429 or is_endpoint_failure(status_code)
+
+
+def record_result(model: str, status_code: Optional[int]) -> None:
+    """
+    Feed one HTTP outcome (None = transport error / timeout) into the breaker.
+    A 429 counts neither way, so a burst of rate limits leaves it closed.
+    """
+    cb = breaker_for(model)
+    if status_code == 429:
+        cb.release()
+    elif is_endpoint_failure(status_code):
+        cb.record_failure()
+    else:
+        cb.record_success()
+
+
+# ------------------ STREAMING (SSE) ------------------
+# Opt-in: send long chain-of-thought calls with "stream": true and hang up as
+# soon as the caller's final-answer marker has been generated.
+STREAM_COMPLETIONS = _env_flag("VNPT_STREAM")
+# Optional JSONL file receiving every streamed transcript (incl. early-stopped ones).
+STREAM_LOG_PATH = (os.environ.get("VNPT_STREAM_LOG") or "").strip()
+
+_STREAM_LOG_LOCK = threading.Lock()
+
+
+def _log_stream(model_id: str, text: str, stopped_early: bool) -> None:
+    if not STREAM_LOG_PATH:
+        return
+    line = json.dumps(
+        {"model": model_id, "stopped_early": stopped_early, "text": text},
+        ensure_ascii=False,
+    )
+    with _STREAM_LOG_LOCK:
+        with open(STREAM_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def _delta_text(event: Dict[str, Any]) -> str:
+    try:
+        choice = event["choices"][0]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    delta = choice.get("delta") or choice.get("message") or {}
+    return delta.get("content") or ""
+
+
+def stream_chat_completion(
+    api_url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    stop_pattern: Optional[Pattern[str]] = None,
+    timeout: int = 60,
+) -> Tuple[int, str, bool]:
+    """
+    Streaming variant of the OpenAI-style chat call.
+
+    Returns (status_code, content, stopped_early). Content is accumulated from
+    the SSE deltas; once `stop_pattern` matches the text so far the connection
+    is closed and the partial text (reasoning + marker) is returned. Endpoints
+    that ignore "stream" and answer with plain JSON are handled transparently.
+    For non-200 responses content is the raw response body.
+    Transport errors propagate to the caller.
+    """
+    body = dict(payload, stream=True)
+    resp = http_post(api_url, headers=headers, json=body, timeout=timeout, stream=True)
+    try:
+        if resp.status_code != 200:
+            return resp.status_code, resp.text, False
+
+        ctype = (resp.headers.get("Content-Type") or "").lower()
+        if "text/event-stream" not in ctype:
+            try:
+                text = resp.json()["choices"][0]["message"]["content"]
+            except Exception:
+                text = resp.text
+            return resp.status_code, text, False
+
+        parts: List[str] = []
+        scanned = 0
+        stopped_early = False
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                piece = _delta_text(json.loads(data))
+            except ValueError:
+                continue
+            if not piece:
+                continue
+            parts.append(piece)
+            if stop_pattern is not None:
+                text = "".join(parts)
+                # Only rescan the tail: a marker can straddle two deltas.
+                if stop_pattern.search(text, max(0, scanned - 32)):
+                    stopped_early = True
+                    break
+                scanned = len(text)
+
+        text = "".join(parts)
+        _log_stream(str(payload.get("model", "")), text, stopped_early)
+        return resp.status_code, text, stopped_early
+    finally:
+        resp.close()
+
+
+# ------------------ IN-FLIGHT COALESCING (SINGLEFLIGHT) ------------------
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Deduplicate identical concurrent calls: the first caller for a key runs
+    `fn`, later callers with the same key block and receive the same result
+    (or exception). Nothing is kept once the call finishes - this is not a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+
+_FLIGHT = SingleFlight()
+
+
+def request_key(*parts: Any) -> str:
+    """Stable key for a request made of JSON-able parts (model, payload, ...)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def singleflight(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorator: identical in-flight calls of `fn` (same arguments, so same model +
+    payload) share one network round trip.
+    """
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        key = request_key(name, args, kwargs)
+        return _FLIGHT.do(key, lambda: fn(*args, **kwargs))
+
+    return wrapper
+
+
+def coalesced_calls() -> int:
+    """How many calls were served by joining an identical in-flight request."""
+    return _FLIGHT.coalesced
+
+
+# ------------------ QUOTA LEDGER ------------------
+# Provider quota window and (optional) per-credential budgets inside it.
+# 0 = unknown: only observed 429s throttle a credential.
+QUOTA_WINDOW_SEC = _env_float("QUOTA_WINDOW_SEC", 3600.0)
+# Cooldown after a 429 when the response has no Retry-After header.
+QUOTA_COOLDOWN_SEC = _env_float("QUOTA_COOLDOWN_SEC", 60.0)
+
+_MODEL_ALIASES = {
+    "vnptai_hackathon_small": "small",
+    "vnptai_hackathon_large": "large",
+    "vnptai_hackathon_embedding": "embed",
+}
+_TOTAL_TOKENS_RE = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+
+
+def _payload_model(payload: Any) -> str:
+    """"small" / "large" / "embed" for a chat or embedding payload ("" if unknown)."""
+    if not isinstance(payload, dict):
+        return ""
+    model = str(payload.get("model", ""))
+    return _MODEL_ALIASES.get(model, model)
+
+
+class QuotaExceededError(RuntimeError):
+    """A model's quota is exhausted; the caller should reschedule, not answer."""
+
+
+class _QuotaAccount:
+    __slots__ = ("events", "throttled_until", "held_until", "throttle_events", "requests", "tokens")
+
+    def __init__(self):
+        self.events: Deque[Tuple[float, int]] = deque()
+        self.throttled_until = 0.0
+        self.held_until = 0.0  # left out by its pool (auth error); not a quota wait
+        self.throttle_events = 0
+        self.requests = 0
+        self.tokens = 0
+
+
+class QuotaLedger:
+    """
+    Sliding-window request / token consumption per (model, credential), fed by
+    every http_post. Knows when a credential was throttled (429), predicts when
+    a configured budget will run out, and tells the scheduler how long a model
+    stays unavailable so work for other models can continue meanwhile.
+    """
+
+    def __init__(self, window: float = QUOTA_WINDOW_SEC):
+        self.window = window
+        self._lock = threading.Lock()
+        self._accounts: Dict[Tuple[str, str], _QuotaAccount] = {}
+
+    @staticmethod
+    def _limits(model: str) -> Tuple[int, int]:
+        key = model.upper()
+        return (
+            int(_env_float(f"QUOTA_{key}_REQUESTS", 0)),
+            int(_env_float(f"QUOTA_{key}_TOKENS", 0)),
+        )
+
+    def _account(self, model: str, credential: str) -> _QuotaAccount:
+        acc = self._accounts.get((model, credential))
+        if acc is None:
+            acc = _QuotaAccount()
+            self._accounts[(model, credential)] = acc
+        return acc
+
+    def _trim(self, acc: _QuotaAccount, now: float) -> None:
+        while acc.events and now - acc.events[0][0] > self.window:
+            acc.events.popleft()
+
+    def record(
+        self,
+        model: str,
+        credential: str,
+        status_code: int,
+        tokens: int,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        now = time.monotonic()
+        with self._lock:
+            acc = self._account(model, credential)
+            self._trim(acc, now)
+            if status_code == 429:
+                acc.throttle_events += 1
+                acc.throttled_until = max(acc.throttled_until, now + (retry_after or QUOTA_COOLDOWN_SEC))
+                return
+            acc.events.append((now, tokens))
+            acc.requests += 1
+            acc.tokens += tokens
+
+    def observe(self, payload: Any, headers: Optional[Dict[str, str]], resp: requests.Response) -> None:
+        """Account one http_post round trip (model / credential read from the request)."""
+        if not isinstance(payload, dict):
+            return
+        model = _payload_model(payload)
+        credential = str((headers or {}).get("Token-id") or "")
+
+        tokens = 0
+        if resp.status_code == 200 and not payload.get("stream"):
+            m = _TOTAL_TOKENS_RE.search(resp.content[-512:])
+            if m:
+                tokens = int(m.group(1))
+        if not tokens:
+            tokens = int(len(json.dumps(payload.get("messages") or payload.get("input") or "", ensure_ascii=False)) / 3.5)
+
+        retry_after = None
+        try:
+            retry_after = float(resp.headers.get("Retry-After") or 0) or None
+        except ValueError:
+            pass
+        self.record(model, credential, resp.status_code, tokens, retry_after)
+
+    def register(self, model: str, credential: str) -> None:
+        """Track a credential before its first request (it counts as available)."""
+        with self._lock:
+            self._account(model, credential)
+
+    def hold(self, model: str, credential: str, seconds: float) -> None:
+        """
+        Keep a credential out of use for `seconds` (e.g. after an auth error).
+        Only key selection sees it: a model whose keys are all held is not
+        throttled, so its callers fail fast instead of waiting for quota.
+        """
+        with self._lock:
+            acc = self._account(model, credential)
+            acc.held_until = max(acc.held_until, time.monotonic() + seconds)
+
+    def credential_load(self, model: str, credential: str) -> Tuple[float, int]:
+        """(seconds until usable, requests in the window) for one credential."""
+        now = time.monotonic()
+        with self._lock:
+            acc = self._accounts.get((model, credential))
+            if acc is None:
+                return 0.0, 0
+            self._trim(acc, now)
+            wait = max(self._wait_for(model, acc, now), acc.held_until - now)
+            return wait, len(acc.events)
+
+    def _wait_for(self, model: str, acc: _QuotaAccount, now: float) -> float:
+        wait = max(0.0, acc.throttled_until - now)
+        max_req, max_tok = self._limits(model)
+        if max_req and len(acc.events) >= max_req:
+            wait = max(wait, acc.events[0][0] + self.window - now)
+        if max_tok and sum(t for _, t in acc.events) >= max_tok:
+            wait = max(wait, acc.events[0][0] + self.window - now)
+        return wait
+
+    def available_in(self, model: str) -> float:
+        """Seconds until some credential of `model` can be used again (0 = now)."""
+        now = time.monotonic()
+        with self._lock:
+            waits = []
+            for (m, _), acc in self._accounts.items():
+                if m != model:
+                    continue
+                self._trim(acc, now)
+                waits.append(self._wait_for(model, acc, now))
+        return min(waits) if waits else 0.0
+
+    def is_throttled(self, model: str) -> bool:
+        return self.available_in(model) > 0.0
+
+    def predict_exhaustion(self, model: str) -> Optional[float]:
+        """
+        Seconds until the configured budget of `model` runs out at the current
+        consumption rate (None when no budget is configured or nothing was used).
+        """
+        max_req, max_tok = self._limits(model)
+        if not max_req and not max_tok:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            etas = []
+            for (m, _), acc in self._accounts.items():
+                if m != model or not acc.events:
+                    continue
+                self._trim(acc, now)
+                span = max(1.0, now - acc.events[0][0])
+                used_req = len(acc.events)
+                used_tok = sum(t for _, t in acc.events)
+                if max_req:
+                    etas.append(max(0.0, (max_req - used_req) / (used_req / span)))
+                if max_tok and used_tok:
+                    etas.append(max(0.0, (max_tok - used_tok) / (used_tok / span)))
+        return min(etas) if etas else None
+
+    def totals(self) -> Dict[str, Tuple[int, int]]:
+        """model -> (successful requests, tokens) since process start, all credentials."""
+        out: Dict[str, Tuple[int, int]] = {}
+        with self._lock:
+            for (model, _), acc in self._accounts.items():
+                req, tok = out.get(model, (0, 0))
+                out[model] = (req + acc.requests, tok + acc.tokens)
+        return out
+
+    def summary(self) -> List[str]:
+        now = time.monotonic()
+        lines = []
+        with self._lock:
+            for (model, cred), acc in sorted(self._accounts.items()):
+                self._trim(acc, now)
+                cred_tag = (cred[:6] + "…") if cred else "-"
+                lines.append(
+                    f"{model:<6} cred={cred_tag:<8} requests={acc.requests} tokens~{acc.tokens} "
+                    f"in_window={len(acc.events)} throttled={acc.throttle_events}x"
+                )
+        return lines
+
+
+LEDGER = QuotaLedger()
+
+
+def raise_if_quota_exhausted(model: str, statuses: List[Optional[int]]) -> None:
+    """
+    Call after a failover loop that got no answer: raise QuotaExceededError when
+    rate limits (not endpoint health) are the reason, so the question can be
+    rescheduled instead of defaulting to an answer.
+    """
+    if statuses and all(s == 429 for s in statuses):
+        raise QuotaExceededError("RATE_LIMIT_REACHED")
+    if not statuses and LEDGER.is_throttled(model):
+        raise QuotaExceededError("RATE_LIMIT_REACHED")
+
+
+# ------------------ CREDENTIAL POOL ------------------
+# Several keys per model multiply the provider quota. Keys come from the base
+# AUTH_<M> / TOKEN_ID_<M> / TOKEN_KEY_<M> triple, numbered triples
+# (AUTH_<M>_1, TOKEN_ID_<M>_1, TOKEN_KEY_<M>_1, ...) and VNPT_CREDENTIALS_FILE,
+# a JSON file {"small": [{"Authorization": ..., "Token-id": ..., "Token-key": ...}], ...}.
+# Rate-limit state is per key in LEDGER; the pool adds in-flight counts.
+CREDENTIALS_FILE = (os.environ.get("VNPT_CREDENTIALS_FILE") or "").strip()
+# How long a key that got 401 / 403 is left out while other keys remain.
+CREDENTIAL_COOLDOWN_SEC = _env_float("CREDENTIAL_COOLDOWN_SEC", 300.0)
+_MAX_NUMBERED_CREDENTIALS = 64
+_CREDENTIAL_ERRORS = (401, 403, 429)
+_CREDENTIAL_HEADERS = ("Authorization", "Token-id", "Token-key")
+
+
+class Credential:
+    __slots__ = ("headers", "in_flight")
+
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = headers
+        self.in_flight = 0
+
+    @property
+    def id(self) -> str:
+        return self.headers["Token-id"]
+
+    def apply(self, headers: Optional[Dict[str, str]]) -> Dict[str, str]:
+        """The caller's headers with this key's credentials."""
+        out = dict(headers or {})
+        auth = self.headers["Authorization"]
+        # Callers that add "Bearer " to a raw key (embedding) keep doing so.
+        if str(out.get("Authorization") or "").lower().startswith("bearer ") and not auth.lower().startswith("bearer "):
+            auth = f"Bearer {auth}"
+        out.update(self.headers, Authorization=auth)
+        return out
+
+
+class CredentialPool:
+    """
+    The keys of one model. acquire() hands out the least-loaded usable key:
+    not throttled / held in LEDGER first, then fewest requests in flight,
+    then fewest requests in the quota window, so load spreads evenly.
+    """
+
+    def __init__(self, model: str, credentials: List[Credential]):
+        self.model = model
+        self.credentials = credentials
+        self._lock = threading.Lock()
+        for cred in credentials:
+            LEDGER.register(model, cred.id)
+
+    def __len__(self) -> int:
+        return len(self.credentials)
+
+    def _rank(self, cred: Credential) -> Tuple[float, int, int]:
+        wait, in_window = LEDGER.credential_load(self.model, cred.id)
+        return wait, cred.in_flight, in_window
+
+    def acquire(self, exclude: Sequence[Credential] = ()) -> Optional[Credential]:
+        with self._lock:
+            candidates = [c for c in self.credentials if c not in exclude]
+            if not candidates:
+                return None
+            cred = min(candidates, key=self._rank)
+            cred.in_flight += 1
+            return cred
+
+    def release(self, cred: Credential) -> None:
+        with self._lock:
+            cred.in_flight -= 1
+
+    def reject(self, cred: Credential, status_code: int) -> None:
+        """A 401 / 403 drops the key for a while (429s are held by LEDGER)."""
+        if status_code != 429 and len(self.credentials) > 1:
+            # With a single key, holding it would only delay the error.
+            LEDGER.hold(self.model, cred.id, CREDENTIAL_COOLDOWN_SEC)
+            print(f"[credentials] {self.model}: key {cred.id[:6]}… got HTTP {status_code}, "
+                  f"left out for {CREDENTIAL_COOLDOWN_SEC:.0f}s")
+
+    def has_available(self, exclude: Sequence[Credential] = ()) -> bool:
+        return any(
+            c not in exclude and LEDGER.credential_load(self.model, c.id)[0] == 0.0
+            for c in self.credentials
+        )
+
+
+def _credential(raw: Dict[str, Any]) -> Optional[Credential]:
+    # File entries may spell the keys as headers or as env-style names.
+    lowered = {str(k).lower().replace("_", "-"): str(v or "").strip() for k, v in raw.items()}
+    auth = lowered.get("authorization") or lowered.get("auth") or ""
+    token_id = lowered.get("token-id") or ""
+    token_key = lowered.get("token-key") or ""
+    if not (auth and token_id and token_key):
+        return None
+    return Credential({"Authorization": auth, "Token-id": token_id, "Token-key": token_key})
+
+
+def _load_credentials(model: str) -> List[Credential]:
+    key = model.upper()
+    raw: List[Dict[str, Any]] = []
+    for suffix in [""] + [f"_{i}" for i in range(1, _MAX_NUMBERED_CREDENTIALS + 1)]:
+        raw.append({
+            "Authorization": os.environ.get(f"AUTH_{key}{suffix}"),
+            "Token-id": os.environ.get(f"TOKEN_ID_{key}{suffix}"),
+            "Token-key": os.environ.get(f"TOKEN_KEY_{key}{suffix}"),
+        })
+    if CREDENTIALS_FILE:
+        with open(CREDENTIALS_FILE, "r", encoding="utf-8") as f:
+            raw += json.load(f).get(model) or []
+
+    out: Dict[Tuple[str, str], Credential] = {}
+    for entry in raw:
+        cred = _credential(entry)
+        if cred is not None:
+            out.setdefault((cred.id, cred.headers["Token-key"]), cred)
+    return list(out.values())
+
+
+_POOLS: Dict[str, Optional[CredentialPool]] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def credential_pool(model: str) -> Optional[CredentialPool]:
+    """The model's pool (None when it has no complete credential). Built on first use."""
+    if model not in _MODEL_ALIASES.values():
+        return None
+    pool = _POOLS.get(model)
+    if pool is None and model not in _POOLS:
+        with _POOLS_LOCK:
+            if model not in _POOLS:
+                creds = _load_credentials(model)
+                _POOLS[model] = CredentialPool(model, creds) if creds else None
+        pool = _POOLS[model]
+    return pool
+
+
+def credential_headers(model: str) -> Dict[str, str]:
+    """Request headers with the model's first key (http_post picks the actual key)."""
+    pool = credential_pool(model)
+    creds = pool.credentials[0].headers if pool is not None else dict.fromkeys(_CREDENTIAL_HEADERS, "")
+    return dict(creds, **{"Content-Type": "application/json"})
+
+
+def reset_credential_pools() -> None:
+    """Re-read the credentials on next use (after the environment changed)."""
+    with _POOLS_LOCK:
+        _POOLS.clear()
+
+
+# ------------------ EMBEDDINGS ------------------
+# base64 little-endian float32 is ~4x smaller on the wire than a JSON float list
+# and decodes straight into a NumPy buffer (no Python float per dimension).
+# Flips to "float" for the rest of the process once the endpoint rejects it.
+EMBED_MODEL = "vnptai_hackathon_embedding"
+_EMBED_ENCODING = (os.environ.get("VNPT_EMBED_ENCODING") or "base64").strip().lower()
+
+
+def decode_embedding(value: Any) -> np.ndarray:
+    """One embedding from a response: base64 string or JSON float list -> float32 vector."""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def embedding_vectors(data: Dict[str, Any]) -> List[np.ndarray]:
+    """All embeddings of a decoded response body, in input order."""
+    items = sorted(data["data"], key=lambda d: d.get("index", 0))
+    return [decode_embedding(d["embedding"]) for d in items]
+
+
+def post_embeddings(url: str, headers: Dict[str, str], inputs: Any, timeout: float = 60) -> requests.Response:
+    """
+    POST an embedding request for `inputs` (one text or a list), asking for
+    base64 output unless the endpoint already refused it; a refused base64
+    request is retried once as "float".
+    """
+    global _EMBED_ENCODING
+    encoding = _EMBED_ENCODING
+    payload = {"model": EMBED_MODEL, "input": inputs, "encoding_format": encoding}
+    resp = http_post(url, headers=headers, json=payload, timeout=timeout)
+    if encoding == "base64" and 400 <= resp.status_code < 500 and resp.status_code != 429:
+        payload["encoding_format"] = "float"
+        retry = http_post(url, headers=headers, json=payload, timeout=timeout)
+        if retry.status_code == 200:
+            # Only blame the encoding when the same request works without it.
+            _EMBED_ENCODING = "float"
+        return retry
+    return resp
+
+
+# Env-configured cassette (predict.py --record/--replay sets it explicitly).
+if (os.environ.get("VNPT_CASSETTE") or "").strip():
+    use_cassette(
+        os.environ["VNPT_CASSETTE"].strip(),
+        (os.environ.get("VNPT_CASSETTE_MODE") or "replay").strip(),
+        replay_latency=_env_flag("VNPT_REPLAY_LATENCY"),
+    )
+
+
+# ------------------ EXAMPLES ------------------
+# (HTTP outcomes fed to a fresh breaker, expected state). Regressions go here.
+BREAKER_EXAMPLES: List[Tuple[List[Optional[int]], str]] = [
+    ([429] * 20, CLOSED),                        # rate limiting is not degradation
+    ([500, None, 503], OPEN),
+    ([500, 500, 429, 429, 500], OPEN),           # 429s neither break nor reset a streak
+    ([500, 500, 200, 500], CLOSED),
+]
+
+
+if __name__ == "__main__":
+    import sys
+
+    failed = 0
+    for n, (statuses, expected) in enumerate(BREAKER_EXAMPLES):
+        name = f"example-{n}"
+        for status in statuses:
+            record_result(name, status)
+        got = breaker_for(name).state
+        if got != expected:
+            failed += 1
+            print(f"FAIL {statuses}: breaker {got}, expected {expected}")
+    print(f"{len(BREAKER_EXAMPLES) - failed}/{len(BREAKER_EXAMPLES)} examples ok")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy / latency / cost sweep over pipeline configurations.
+
+Runs a labelled dev set (private_test.json format plus an "answer" letter per
+item) through every configuration of a grid and reports accuracy, mean / p95
+per-question latency and token cost, marking the Pareto frontier.
+
+    python sweep.py --dev dev.json --grid grid.json --cassette-dir cassettes
+
+grid.json is either {"knob": [values, ...], ...} (cartesian product) or
+{"configs": [{"knob": value, ...}, ...]}; see KNOBS for the knob names. A
+baseline (current defaults) is always evaluated first.
+
+With --cassette-dir each configuration replays <dir>/<config>.jsonl.gz (with
+its recorded latency) when it exists and records it otherwise, so a grid is
+paid for once against the live API and can be re-scored offline.
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import re
+import time
+
+import predict
+from src.RAG import RAG_answerer
+from src.Reasoning import infer
+from src.STEM import stem_module
+from src.vnpt_client import LEDGER, clear_cassette, use_cassette
+
+# knob -> (module, global it overrides)
+KNOBS = {
+    "router_model": (predict, "ROUTER_MODEL"),
+    "rag_model": (RAG_answerer, "RAG_MODEL"),
+    "rag_top_k": (RAG_answerer, "RAG_TOP_K"),
+    "rag_chunk_tokens": (RAG_answerer, "RAG_CHUNK_TOKENS"),
+    "rag_chunk_overlap_tokens": (RAG_answerer, "RAG_CHUNK_OVERLAP_TOKENS"),
+    "rag_prefilter_k": (RAG_answerer, "RAG_PREFILTER_K"),
+    "rag_max_tokens": (RAG_answerer, "RAG_MAX_TOKENS"),
+    "rag_group_size": (RAG_answerer, "RAG_GROUP_SIZE"),
+    "reasoning_model": (infer, "REASONING_MODEL"),
+    "retrieval_k": (infer, "RETRIEVAL_K"),
+    "shard_top_n": (infer, "SHARD_TOP_N"),
+    "reasoning_max_tokens": (infer, "REASONING_MAX_TOKENS"),
+    "stem_max_tokens": (stem_module, "STEM_MAX_TOKENS"),
+    "stem_local_solver": (stem_module, "STEM_LOCAL_SOLVER"),
+}
+# Knobs passed to the pipeline run itself rather than set on a module.
+RUN_KNOBS = {"fused_router"}
+
+RESULT_FIELDS = [
+    "config", "pareto", "accuracy", "labelled", "mean_s", "p95_s",
+    "tokens_small", "tokens_large", "tokens_embed", "cost", "wall_s", "cassette", "cassette_misses",
+]
+
+
+# -------------------------------------------------
+# Grid
+# -------------------------------------------------
+def config_name(config: dict) -> str:
+    if not config:
+        return "baseline"
+    return ",".join(f"{k}={config[k]}" for k in sorted(config))
+
+
+def load_configs(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+
+    if "configs" in spec:
+        configs = [dict(c) for c in spec["configs"]]
+    else:
+        keys = sorted(spec)
+        configs = [dict(zip(keys, values)) for values in itertools.product(*(spec[k] for k in keys))]
+
+    for config in configs:
+        unknown = set(config) - set(KNOBS) - RUN_KNOBS
+        if unknown:
+            raise ValueError(f"❌ unknown knob(s) {sorted(unknown)}; known: {sorted(KNOBS) + sorted(RUN_KNOBS)}")
+
+    # Baseline first; drop configs identical to it (or to each other).
+    defaults = {k: getattr(mod, attr) for k, (mod, attr) in KNOBS.items()}
+    out, seen = [{}], {config_name({})}
+    for config in configs:
+        config = {k: v for k, v in config.items() if defaults.get(k, False) != v}
+        name = config_name(config)
+        if name not in seen:
+            seen.add(name)
+            out.append(config)
+    return out
+
+
+# -------------------------------------------------
+# One configuration
+# -------------------------------------------------
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    return s[max(0, math.ceil(q / 100.0 * len(s)) - 1)]
+
+
+def _cassette_path(cassette_dir: str, name: str) -> str:
+    slug = re.sub(r"[^A-Za-z0-9_.=,-]+", "_", name)
+    return os.path.join(cassette_dir, f"{slug}.jsonl.gz")
+
+
+def run_config(config: dict, data: list, gold: dict, args) -> dict:
+    name = config_name(config)
+    cassette, cassette_mode = None, ""
+    if args.cassette_dir:
+        path = _cassette_path(args.cassette_dir, name)
+        if os.path.exists(path):
+            cassette = use_cassette(path, "replay", replay_latency=True)
+            cassette_mode = "replay"
+        elif args.replay_only:
+            print(f"⏭️ {name}: no cassette, skipped (--replay-only)")
+            return {}
+        else:
+            os.makedirs(args.cassette_dir, exist_ok=True)
+            cassette = use_cassette(path, "record")
+            cassette_mode = "record"
+
+    saved = {k: getattr(mod, attr) for k, (mod, attr) in KNOBS.items()}
+    for k, v in config.items():
+        if k in KNOBS:
+            mod, attr = KNOBS[k]
+            setattr(mod, attr, v)
+    # Each config pays for its own embeddings (and records them in its cassette).
+    infer.RETRIEVAL_CACHE.clear()
+    RAG_answerer.clear_passage_cache()
+    before = LEDGER.totals()
+
+    t0 = time.time()
+    try:
+        fused = bool(config.get("fused_router", False))
+        if args.pipeline == "staged":
+            jobs = predict.run_staged(data, workers=args.workers, fused=fused)
+        else:
+            jobs = predict.run_sequential(data, fused=fused)
+    finally:
+        wall = time.time() - t0
+        for k, (mod, attr) in KNOBS.items():
+            setattr(mod, attr, saved[k])
+        clear_cassette()
+
+    after = LEDGER.totals()
+    tokens = {m: after.get(m, (0, 0))[1] - before.get(m, (0, 0))[1] for m in ("small", "large", "embed")}
+    scored = [j for j in jobs if j["qid"] in gold]
+    correct = sum(1 for j in scored if j["answer"] == gold[j["qid"]])
+    latencies = [j["elapsed"] for j in jobs]
+
+    return {
+        "config": name,
+        "accuracy": correct / len(scored) if scored else float("nan"),
+        "labelled": len(scored),
+        "mean_s": sum(latencies) / len(latencies) if latencies else float("nan"),
+        "p95_s": percentile(latencies, 95),
+        "tokens_small": tokens["small"],
+        "tokens_large": tokens["large"],
+        "tokens_embed": tokens["embed"],
+        "cost": sum(tokens[m] / 1000.0 * args.price.get(m, 0.0) for m in tokens),
+        "wall_s": wall,
+        "cassette": cassette_mode,
+        "cassette_misses": cassette.misses if cassette is not None else 0,
+    }
+
+
+# -------------------------------------------------
+# Pareto frontier (max accuracy, min p95 latency, min cost)
+# -------------------------------------------------
+def _dominates(a: dict, b: dict) -> bool:
+    no_worse = a["accuracy"] >= b["accuracy"] and a["p95_s"] <= b["p95_s"] and a["cost"] <= b["cost"]
+    better = a["accuracy"] > b["accuracy"] or a["p95_s"] < b["p95_s"] or a["cost"] < b["cost"]
+    return no_worse and better
+
+
+def mark_pareto(rows: list) -> list:
+    for r in rows:
+        r["pareto"] = not any(_dominates(o, r) for o in rows if o is not r)
+    return rows
+
+
+def print_table(rows: list) -> None:
+    print(f"{'':2}{'config':<48} {'acc':>6} {'mean_s':>8} {'p95_s':>8} {'tok_small':>10} {'tok_large':>10} {'cost':>9}")
+    for r in sorted(rows, key=lambda r: (-r["accuracy"], r["p95_s"], r["cost"])):
+        mark = "* " if r["pareto"] else "  "
+        print(
+            f"{mark}{r['config'][:48]:<48} {r['accuracy']:>6.3f} {r['mean_s']:>8.2f} {r['p95_s']:>8.2f} "
+            f"{r['tokens_small']:>10} {r['tokens_large']:>10} {r['cost']:>9.2f}"
+        )
+    print("* = Pareto frontier (accuracy vs p95 latency vs cost)")
+
+
+# -------------------------------------------------
+# Main
+# -------------------------------------------------
+def parse_price(spec: str) -> dict:
+    """'large=2,small=0.5' -> {"large": 2.0, "small": 0.5} (cost per 1K tokens)."""
+    prices = {"small": 1.0, "large": 1.0, "embed": 0.0}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        try:
+            model, value = part.split("=", 1)
+            prices[model.strip()] = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"--price must look like model=value[,...], got {spec!r}")
+    return prices
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Accuracy / latency / cost sweep over pipeline configurations")
+    p.add_argument("--dev", required=True, help="labelled dev set (private_test.json format + \"answer\")")
+    p.add_argument("--grid", required=True, help="JSON grid of knob values (see KNOBS in sweep.py)")
+    p.add_argument("--output-dir", default="sweep_out", help="where sweep_results.csv is written")
+    p.add_argument("--cassette-dir", default=None, help="per-configuration record/replay cassettes")
+    p.add_argument("--replay-only", action="store_true", help="skip configurations without a cassette")
+    p.add_argument("--pipeline", choices=["sequential", "staged"], default="staged")
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument(
+        "--price", type=parse_price, default=parse_price(""),
+        help="cost per 1K tokens per model, e.g. large=2,small=0.5 (default 1 for chat models, 0 for embed)",
+    )
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    data = predict.load_items(args.dev)
+    gold = {
+        str(item["qid"]): str(item["answer"]).strip().upper()
+        for item in data if item.get("answer")
+    }
+    if not gold:
+        raise ValueError("❌ dev set has no \"answer\" labels")
+
+    configs = load_configs(args.grid)
+    print(f"🧪 {len(configs)} configurations x {len(data)} questions ({len(gold)} labelled)")
+
+    rows = []
+    for i, config in enumerate(configs, 1):
+        print(f"🧪 [{i}/{len(configs)}] {config_name(config)}")
+        row = run_config(config, data, gold, args)
+        if row:
+            rows.append(row)
+    if not rows:
+        return
+
+    mark_pareto(rows)
+    print_table(rows)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    out_path = os.path.join(args.output_dir, "sweep_results.csv")
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"✅ {out_path} written with {len(rows)} rows")
+
+
+if __name__ == "__main__":
+    main()